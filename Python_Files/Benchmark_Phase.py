@@ -0,0 +1,755 @@
+from __future__ import annotations
+from random import randint, random, sample, shuffle
+import argparse
+import contextlib
+import gc
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from itertools import islice
+
+import Final_Code
+from Final_Code import (BPlusTree, ConcurrentBPlusTree, CopyOnWriteBPlusTree, DiskBPlusTree, DurableBPlusTree, IntBPlusTree,
+                        LazyDeleteBPlusTree, PrefixBPlusTree, ReadFiles)
+
+
+def timed(function, *args, pause_gc=True):
+    """
+    Runs function(*args) once and returns (elapsed seconds, result).
+    The garbage collector is paused while timing, as timeit does, so its pauses do not skew the comparison.
+    With pause_gc=False it runs as it would in the console, collections included.
+    """
+    gc.collect()
+    if pause_gc:
+        gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+
+def make_pairs(count):
+    """
+    Builds count (document id, category) pairs in random order, the way they reach the loader.
+    """
+    pairs = [(str(doc_id), {f"Category_{doc_id % 97}"}) for doc_id in range(count)]
+    shuffle(pairs)
+    return pairs
+
+
+def insert_loop(order, pairs):
+    bpt_instance = BPlusTree(order)
+    for key, value in pairs:
+        bpt_instance.insert(key, value)
+    return bpt_instance
+
+
+def sort_and_bulk_load(order, pairs):
+    return BPlusTree(order).bulk_load(sorted((key, [value]) for key, value in pairs))
+
+
+def benchmark_bulk_load(sizes, order):
+    """
+    Compares the one-key-at-a-time insert loop against sorting plus bulk_load.
+    """
+    print(f"{'pairs':>12} {'insert loop (s)':>16} {'sort + bulk_load (s)':>21} {'speed-up':>9}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        insert_seconds, _ = timed(insert_loop, order, pairs)
+        bulk_seconds, _ = timed(sort_and_bulk_load, order, pairs)
+        print(f"{size:>12} {insert_seconds:>16.3f} {bulk_seconds:>21.3f} {insert_seconds / bulk_seconds:>8.1f}x")
+
+
+def benchmark_order_sweep(sizes, orders):
+    """
+    Reports the average insert and lookup latency for every order, so a fan-out can be picked per data size.
+    """
+    print(f"{'pairs':>12} {'order':>6} {'insert (us/key)':>16} {'lookup (us/key)':>16}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        probes = [key for key, _ in pairs]
+        shuffle(probes)
+        for order in orders:
+            insert_seconds, bpt_instance = timed(insert_loop, order, pairs)
+            lookup_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in probes])
+            print(f"{size:>12} {order:>6} {insert_seconds / size * 1e6:>16.2f} {lookup_seconds / size * 1e6:>16.2f}")
+
+
+def benchmark_retrieve_many(sizes, order, terms_per_document):
+    """
+    Reports the per-document latency of the 'P <did> -t' stem lookups: one retrieve per term against retrieve_many.
+    """
+    print(f"{'term ids':>12} {'terms/doc':>10} {'retrieve loop (us/doc)':>23} {'retrieve_many (us/doc)':>23}")
+    for size in sizes:
+        bpt_stems = BPlusTree(order).bulk_load(sorted((str(term_id), [{f"stem{term_id}"}]) for term_id in range(size)))
+        documents = [[str(randint(0, size)) for _ in range(terms_per_document)] for _ in range(200)]
+
+        loop_seconds, _ = timed(lambda: [[bpt_stems.retrieve(term) for term in document] for document in documents])
+        many_seconds, _ = timed(lambda: [bpt_stems.retrieve_many(document) for document in documents])
+        print(f"{size:>12} {terms_per_document:>10} {loop_seconds / len(documents) * 1e6:>23.1f} "
+              f"{many_seconds / len(documents) * 1e6:>23.1f}")
+
+
+def benchmark_insert_many(sizes, order, batch_sizes):
+    """
+    Reports the per-key cost of appending batches to a built tree: the insert loop against insert_many.
+    """
+    print(f"{'tree keys':>12} {'batch':>8} {'insert loop (us/key)':>21} {'insert_many (us/key)':>21}")
+    for size in sizes:
+        for batch_size in batch_sizes:
+            batches = [[(str(randint(0, 10 * size)), {"Category_X"}) for _ in range(batch_size)] for _ in range(5)]
+            loop_tree = sort_and_bulk_load(order, make_pairs(size))
+            many_tree = sort_and_bulk_load(order, make_pairs(size))
+
+            loop_seconds, _ = timed(lambda: [loop_tree.insert(key, value) for batch in batches for key, value in batch])
+            many_seconds, _ = timed(lambda: [many_tree.insert_many(batch) for batch in batches])
+            keys = 5 * batch_size
+            print(f"{size:>12} {batch_size:>8} {loop_seconds / keys * 1e6:>21.2f} {many_seconds / keys * 1e6:>21.2f}")
+
+
+class NoFingerTree(BPlusTree):
+    """
+    BPlusTree without the right-most leaf finger: every insert descends and every split is 50/50.
+    """
+    def _seek(self, key):
+        return self._findLeaf(key), False
+
+
+def leaf_fill(bpt_instance):
+    """
+    Returns the average share of key slots in use over all leaves.
+    """
+    leaves = used = 0
+    node = bpt_instance.getLeftmostLeaf()
+    while node:
+        leaves += 1
+        used += len(node.keys)
+        node = node.nextLeaf
+    return used / (leaves * (bpt_instance.order - 1))
+
+
+def benchmark_sequential_fill(sizes, order):
+    """
+    Reports insert cost and leaf fill factor for document ids ingested in increasing order.
+    """
+    print(f"{'ids':>12} {'tree':>10} {'insert (us/key)':>16} {'leaf fill':>10}")
+    for size in sizes:
+        for name, tree_class in (("descend", NoFingerTree), ("finger", BPlusTree)):
+            bpt_instance = tree_class(order)
+            seconds, _ = timed(lambda: [bpt_instance.insert(doc_id, "Category_X") for doc_id in range(size)])
+            print(f"{size:>12} {name:>10} {seconds / size * 1e6:>16.2f} {leaf_fill(bpt_instance):>10.1%}")
+
+
+def benchmark_integer_keys(sizes, order, file_name):
+    """
+    Compares memory and lookup speed of the string-keyed BPlusTree and the IntBPlusTree on document ids,
+    read from the key column of file_name when one is given.
+    """
+    if file_name:
+        _, id_tree = ReadFiles.read_tree_from_file(file_name, order)
+        if not isinstance(id_tree, IntBPlusTree):
+            print(f"The keys of {file_name} are not all integers.")
+            return
+        id_sets = [list(id_tree.keys())]
+    else:
+        id_sets = [sorted(sample(range(2286, 2286 + 4 * size), size)) for size in sizes]
+
+    print(f"{'ids':>12} {'tree':>14} {'memory (B/key)':>15} {'lookup (us/key)':>16}")
+    for doc_ids in id_sets:
+        probes = [str(doc_id) for doc_id in doc_ids]
+        shuffle(probes)
+        builders = (
+            ("BPlusTree", lambda: BPlusTree(order).bulk_load(sorted((str(doc_id), ["Category_X"]) for doc_id in doc_ids))),
+            ("IntBPlusTree", lambda: IntBPlusTree(order).bulk_load([(doc_id, ["Category_X"]) for doc_id in doc_ids])),
+        )
+        for name, build in builders:
+            tree_bytes, bpt_instance = traced_bytes(build)
+            lookup_seconds, _ = timed(lambda: [bpt_instance.retrieve(doc_id) for doc_id in probes])
+            print(f"{len(doc_ids):>12} {name:>14} {tree_bytes / len(doc_ids):>15.1f} "
+                  f"{lookup_seconds / len(doc_ids) * 1e6:>16.2f}")
+
+
+def benchmark_disk_tree(sizes, order):
+    """
+    Compares the in-memory BPlusTree with a DiskBPlusTree bulk-loaded into a page file: Python heap
+    bytes held by the tree, file size and lookup latency on an open tree.
+    """
+    print(f"{'pairs':>12} {'tree':>14} {'heap (B/key)':>13} {'file (B/key)':>13} {'lookup (us/key)':>16}")
+    for size in sizes:
+        probes = [str(randint(0, size)) for _ in range(min(size, 100_000))]
+        memory_bytes, bpt_instance = traced_bytes(sort_and_bulk_load, order, make_pairs(size))
+        lookup_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in probes])
+        print(f"{size:>12} {'BPlusTree':>14} {memory_bytes / size:>13.1f} {'-':>13} "
+              f"{lookup_seconds / len(probes) * 1e6:>16.2f}")
+        del bpt_instance
+
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.bpt")
+        with DiskBPlusTree(path, order) as disk_tree:  # Pairs are generated one at a time, in key order.
+            disk_tree.bulk_load((str(doc_id), [{f"Category_{doc_id % 97}"}]) for doc_id in sorted(range(size), key=str))
+        disk_bytes, disk_tree = traced_bytes(DiskBPlusTree, path)
+        lookup_seconds, _ = timed(lambda: [disk_tree.retrieve(key) for key in probes])
+        print(f"{size:>12} {'DiskBPlusTree':>14} {disk_bytes / size:>13.1f} {os.path.getsize(path) / size:>13.1f} "
+              f"{lookup_seconds / len(probes) * 1e6:>16.2f}")
+        disk_tree.close()
+        os.remove(path)
+
+
+def benchmark_buffer_pool(sizes, order, cache_pages):
+    """
+    Reports the buffer pool hit ratio and the p50/p99 lookup latency of a DiskBPlusTree per cache size,
+    for a skewed query mix where 90% of the lookups go to 10% of the document ids.
+    """
+    print(f"{'pairs':>12} {'cache pages':>12} {'hit ratio':>10} {'cached (KiB)':>13} {'p50 (us)':>9} {'p99 (us)':>9}")
+    for size in sizes:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.bpt")
+        with DiskBPlusTree(path, order) as disk_tree:
+            disk_tree.bulk_load((str(doc_id), [{f"Category_{doc_id % 97}"}]) for doc_id in sorted(range(size), key=str))
+
+        hot = sample(range(size), max(1, size // 10))
+        probes = [str(hot[randint(0, len(hot) - 1)] if random() < 0.9 else randint(0, size)) for _ in range(100_000)]
+        for pages in cache_pages:
+            with DiskBPlusTree(path, cache_pages=pages) as disk_tree:
+                for key in probes[:10_000]:  # Warm the pool up.
+                    disk_tree.retrieve(key)
+                disk_tree.pool.reset_counters()
+
+                latencies = []
+                for key in probes:
+                    start = time.perf_counter()
+                    disk_tree.retrieve(key)
+                    latencies.append(time.perf_counter() - start)
+                latencies.sort()
+                pool = disk_tree.pool
+                print(f"{size:>12} {pages:>12} {pool.hits / (pool.hits + pool.misses):>10.1%} {pool.bytes / 1024:>13.0f} "
+                      f"{latencies[len(latencies) // 2] * 1e6:>9.2f} {latencies[len(latencies) * 99 // 100] * 1e6:>9.2f}")
+        os.remove(path)
+
+
+def benchmark_snapshot(sizes, order, terms_per_document, file_name):
+    """
+    Compares a cold start (parsing the text file) with a warm start from its binary snapshot, on file_name
+    or on generated 'docId term:weight ...' files. The garbage collector runs as it does in the console.
+    """
+    directory = tempfile.mkdtemp()
+    if file_name:
+        files = [file_name]
+    else:
+        files = []
+        for size in sizes:
+            files.append(os.path.join(directory, f"docID_term_{size}.txt"))
+            with open(files[-1], "w") as file:
+                for doc_id in range(2286, 2286 + size):
+                    terms = " ".join(f"{randint(0, 50_000)}:0.{randint(0, 99)}" for _ in range(terms_per_document))
+                    file.write(f"{doc_id} {terms}\n")
+
+    print(f"{'file':>28} {'text (MB)':>10} {'snapshot (MB)':>14} {'parse (s)':>10} {'parse + save (s)':>17} {'load (s)':>9}")
+    for text_file in files:
+        snapshot_file = os.path.join(directory, os.path.basename(text_file) + ".snapshot")
+        parse_seconds, _ = timed(ReadFiles.read_tree_from_file, text_file, order, pause_gc=False)
+        cold_seconds, _ = timed(ReadFiles.read_tree_with_snapshot, text_file, order, snapshot_file, pause_gc=False)
+        warm_seconds, _ = timed(ReadFiles.read_tree_with_snapshot, text_file, order, snapshot_file, pause_gc=False)
+        print(f"{os.path.basename(text_file):>28} {os.path.getsize(text_file) / 2 ** 20:>10.1f} "
+              f"{os.path.getsize(snapshot_file) / 2 ** 20:>14.1f} {parse_seconds:>10.2f} {cold_seconds:>17.2f} {warm_seconds:>9.2f}")
+        os.remove(snapshot_file)
+
+
+def benchmark_stats(sizes, orders):
+    """
+    Reports BPlusTree.stats() and the per-insert / per-retrieve counters of random inserts for every order,
+    as a guide for choosing it: height, leaf fill, bytes per key, node visits, comparisons and splits.
+    """
+    print(f"{'pairs':>12} {'order':>6} {'height':>7} {'nodes':>9} {'leaf fill':>10} {'bytes/key':>10} "
+          f"{'visits/insert':>14} {'splits/insert':>14} {'comparisons/retrieve':>21}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        for order in orders:
+            bpt_instance = BPlusTree(order)
+            counters = bpt_instance.enable_counters()
+            for key, value in pairs:
+                bpt_instance.insert(key, value)
+            for key, _ in pairs[:10_000]:
+                bpt_instance.retrieve(key)
+
+            stats = bpt_instance.stats()
+            per_call = counters.per_call()
+            print(f"{size:>12} {order:>6} {stats['height']:>7} {stats['nodes']:>9} {stats['levels'][-1]['fill']:>10.2f} "
+                  f"{stats['bytes'] / size:>10.1f} {per_call['insert']['visits']:>14.2f} {per_call['insert']['splits']:>14.3f} "
+                  f"{per_call['retrieve']['comparisons']:>21.2f}")
+
+
+def benchmark_lazy_delete(sizes, order):
+    """
+    Churns the tree (delete a random key, insert a new one) and reports the delete latency percentiles of
+    BPlusTree against LazyDeleteBPlusTree whose thread is woken at 25% tombstones, and one whose thread compacts
+    every 50 ms.
+    """
+    print(f"{'pairs':>12} {'tree':>20} {'deletes/s':>10} {'p50 (us)':>9} {'p99 (us)':>9} {'p99.9 (us)':>11} {'max (us)':>10}")
+    for size in sizes:
+        pairs = sorted((key, [value]) for key, value in make_pairs(size))
+        churn = min(size, 200_000)
+        doomed = sample([key for key, _ in pairs], churn)
+        trees = {
+            "BPlusTree": lambda: BPlusTree(order),
+            "lazy, ratio 0.25": lambda: LazyDeleteBPlusTree(order, max_ratio=0.25, interval=60),
+            "lazy, background": lambda: LazyDeleteBPlusTree(order, max_ratio=1.0, interval=0.05),
+        }
+        for name, make_tree in trees.items():
+            bpt_instance = make_tree().bulk_load([(key, list(values)) for key, values in pairs])
+            latencies = []
+
+            def run():
+                clock = time.perf_counter
+                for step, key in enumerate(doomed):
+                    start = clock()
+                    bpt_instance.delete(key)
+                    latencies.append(clock() - start)
+                    bpt_instance.insert(str(size + step), "Category_0")
+
+            seconds, _ = timed(run)
+            if isinstance(bpt_instance, LazyDeleteBPlusTree):
+                bpt_instance.close()
+            latencies.sort()
+            p50, p99, p999 = (latencies[int(len(latencies) * share)] * 1e6 for share in (0.5, 0.99, 0.999))
+            print(f"{size:>12} {name:>20} {churn / sum(latencies):>10.0f} {p50:>9.1f} {p99:>9.1f} {p999:>11.1f} "
+                  f"{latencies[-1] * 1e6:>10.0f}")
+
+
+def benchmark_batch_deletes(sizes, order):
+    """
+    Purges half of the keys (one contiguous range of them) with a delete loop, delete_many and delete_range,
+    and reports the time and the merges and borrows each needed.
+    """
+    print(f"{'pairs':>12} {'method':>13} {'seconds':>9} {'merges':>9} {'borrows':>9}")
+    for size in sizes:
+        pairs = sorted((key, [value]) for key, value in make_pairs(size))
+        doomed = [key for key, _ in pairs[size // 4:size // 4 + size // 2]]
+        methods = {
+            "delete loop": lambda bpt_instance: [bpt_instance.delete(key) for key in doomed],
+            "delete_many": lambda bpt_instance: bpt_instance.delete_many(doomed),
+            "delete_range": lambda bpt_instance: bpt_instance.delete_range(doomed[0], pairs[size // 4 + size // 2][0]),
+        }
+        for name, method in methods.items():
+            bpt_instance = BPlusTree(order).bulk_load([(key, list(values)) for key, values in pairs])
+            counters = bpt_instance.enable_counters()
+            seconds, _ = timed(method, bpt_instance)
+            events = {event: sum(counts[event] for counts in counters.counts.values()) for event in ("merges", "borrows")}
+            print(f"{size:>12} {name:>13} {seconds:>9.3f} {events['merges']:>9} {events['borrows']:>9}")
+
+
+def benchmark_ranks(sizes, order):
+    """
+    Compares rank, select and the cost of random inserts with subtree counts against counting along the leaf chain.
+    """
+    print(f"{'pairs':>12} {'counts':>7} {'inserts/s':>11} {'rank (us)':>10} {'select (us)':>12}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        probes = [str(randint(0, size - 1)) for _ in range(100)]
+        for ranked in (False, True):
+            bpt_instance = BPlusTree(order)
+            if ranked:
+                bpt_instance.enable_ranks()
+            insert_seconds, _ = timed(lambda: [bpt_instance.insert(key, value) for key, value in pairs])
+
+            if ranked:
+                rank_seconds, _ = timed(lambda: [bpt_instance.rank(key) for key in probes])
+                select_seconds, _ = timed(lambda: [bpt_instance.select(randint(0, size - 1)) for _ in probes])
+            else:
+                rank_seconds, _ = timed(lambda: [sum(1 for _ in bpt_instance.keys(stop=key)) for key in probes])
+                select_seconds, _ = timed(lambda: [next(islice(bpt_instance.items(), randint(0, size - 1), None))
+                                                   for _ in probes])
+            print(f"{size:>12} {'on' if ranked else 'off':>7} {size / insert_seconds:>11.0f} "
+                  f"{rank_seconds / len(probes) * 1e6:>10.1f} {select_seconds / len(probes) * 1e6:>12.1f}")
+
+
+def benchmark_cursor(sizes, order, page_sizes):
+    """
+    Pages through the first 1000 pages of the tree three ways: re-reading items() up to the page's offset,
+    restarting items() at the last key of the previous page, and keeping one cursor open.
+    """
+    print(f"{'pairs':>12} {'page size':>10} {'offset items (ms)':>18} {'items from key (ms)':>20} {'cursor (ms)':>12}")
+    for size in sizes:
+        bpt_instance = sort_and_bulk_load(order, make_pairs(size))
+        for page_size in page_sizes:
+            pages = min(1000, size // page_size)
+
+            def by_offset():
+                for page in range(pages):
+                    list(islice(bpt_instance.items(), page * page_size, (page + 1) * page_size))
+
+            def by_key():
+                last_key = None
+                for _ in range(pages):
+                    page = list(islice(bpt_instance.items(start=last_key), 0 if last_key is None else 1,
+                                       page_size + (last_key is not None)))
+                    last_key = page[-1][0]
+
+            def by_cursor():
+                cursor = bpt_instance.cursor()
+                for _ in range(pages):
+                    page = [cursor.current()]
+                    page.extend(cursor.next() for _ in range(page_size - 1))
+                    cursor.next()
+
+            offset_seconds, _ = timed(by_offset)
+            key_seconds, _ = timed(by_key)
+            cursor_seconds, _ = timed(by_cursor)
+            print(f"{size:>12} {page_size:>10} {offset_seconds / pages * 1e3:>18.3f} {key_seconds / pages * 1e3:>20.3f} "
+                  f"{cursor_seconds / pages * 1e3:>12.3f}")
+
+
+def benchmark_bloom(sizes, order, fp_rates):
+    """
+    Compares lookup latency of missing and stored keys without and with a Bloom filter per false positive
+    rate, and reports the measured false positive rate and the filter size.
+    """
+    print(f"{'pairs':>12} {'fp rate':>8} {'miss (us)':>10} {'hit (us)':>9} {'measured fp':>12} {'avoided':>8} {'filter (B/key)':>15}")
+    for size in sizes:
+        bpt_instance = sort_and_bulk_load(order, make_pairs(size))
+        misses = [str(size + randint(0, size)) for _ in range(100_000)]
+        hits = [str(randint(0, size - 1)) for _ in range(100_000)]
+
+        for fp_rate in [None] + fp_rates:
+            if fp_rate is not None:
+                bpt_instance.enable_bloom(fp_rate)
+            miss_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in misses])
+            hit_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in hits])
+            bloom = bpt_instance.bloom
+            if bloom is None:
+                print(f"{size:>12} {'-':>8} {miss_seconds / len(misses) * 1e6:>10.2f} {hit_seconds / len(hits) * 1e6:>9.2f} "
+                      f"{'-':>12} {'-':>8} {'-':>15}")
+            else:
+                print(f"{size:>12} {fp_rate:>8} {miss_seconds / len(misses) * 1e6:>10.2f} {hit_seconds / len(hits) * 1e6:>9.2f} "
+                      f"{bloom.false_positives / len(misses):>12.4f} {bloom.avoided:>8} {len(bloom.bits) / size:>15.2f}")
+
+
+def make_rcv1_files(directory, size, terms_per_document):
+    """
+    Writes category_docId, docID_term and stem_term files shaped like RCV1 for size documents:
+    3 of 103 categories and terms_per_document of 47236 term ids per document, one stem per term id.
+    """
+    files = [os.path.join(directory, f"{name}_{size}.txt") for name in ("category_docId", "docID_term", "stem_term")]
+    with open(files[0], "w") as categories, open(files[1], "w") as terms:
+        for doc_id in range(2286, 2286 + size):
+            for category in sample(range(103), 3):
+                categories.write(f"Category_{category} {doc_id}\n")
+            document_terms = " ".join(f"{term_id}:0.{randint(0, 99)}" for term_id in sample(range(1, 47237), terms_per_document))
+            terms.write(f"{doc_id} {document_terms}\n")
+    with open(files[2], "w") as stems:
+        for term_id in range(1, 47237):
+            stems.write(f"stem{term_id % 30_000} {term_id}\n")
+    return files
+
+
+def load_console_files(files, order):
+    with contextlib.redirect_stdout(io.StringIO()):  # ReadFiles reports every file it stores.
+        return [ReadFiles.read_tree_from_file(file_name, order) for file_name in files]
+
+
+def benchmark_intern(sizes, order, terms_per_document, files):
+    """
+    Loads the three console files (category_docId, docID_term, stem_term) with and without interning the
+    tokens and reports the memory the dictionaries and trees keep, and the parse time.
+    Uses the given files, or generated RCV1-shaped ones for every size.
+    """
+    directory = tempfile.mkdtemp()
+    file_sets = [files] if files else [make_rcv1_files(directory, size, terms_per_document) for size in sizes]
+
+    print(f"{'documents':>10} {'interned':>9} {'memory (MB)':>12} {'saved (MB)':>11} {'parse (s)':>10}")
+    for file_set in file_sets:
+        with open(file_set[1]) as file:
+            documents = sum(1 for _ in file)
+        memory = {}
+        for intern_tokens in (False, True):
+            ReadFiles.intern_tokens = intern_tokens
+            try:
+                memory[intern_tokens], _ = traced_bytes(load_console_files, file_set, order)
+                seconds, _ = timed(load_console_files, file_set, order, pause_gc=False)
+            finally:
+                ReadFiles.intern_tokens = True
+            saved = (memory[False] - memory[True]) / 2 ** 20 if intern_tokens else 0
+            print(f"{documents:>10} {str(intern_tokens):>9} {memory[intern_tokens] / 2 ** 20:>12.1f} {saved:>11.1f} {seconds:>10.2f}")
+
+
+def benchmark_value_counts(sizes, order, terms_per_document, files):
+    """
+    Loads the console files with the values of every key kept as plain lists and as Postings, and reports the
+    memory kept, the load time and the time of the C <did> -c and C <did> -t counts (the old set rebuild for lists).
+    """
+    directory = tempfile.mkdtemp()
+    file_sets = [files] if files else [make_rcv1_files(directory, size, terms_per_document) for size in sizes]
+
+    print(f"{'documents':>10} {'postings':>9} {'memory (MB)':>12} {'load (s)':>9} {'C -c (us)':>10} {'C -t (us)':>10}")
+    for file_set in file_sets:
+        with open(file_set[1]) as file:
+            document_count = sum(1 for _ in file)
+        for count_values in (False, True):
+            ReadFiles.count_values = count_values
+            try:
+                memory, _ = traced_bytes(load_console_files, file_set, order)
+                seconds, loaded = timed(load_console_files, file_set, order, pause_gc=False)
+            finally:
+                ReadFiles.count_values = True
+            (_, bpt_categories), (_, bpt__term), _ = loaded
+            documents = [str(key) for key in islice(bpt__term.keys(), 0, None, 7)][:10_000]
+
+            if count_values:
+                terms_seconds, _ = timed(lambda: [bpt__term.value_count(did) for did in documents])
+                categories_seconds, _ = timed(lambda: [bpt_categories.value_count(did) for did in documents])
+            else:
+                terms_seconds, _ = timed(lambda: [len(set().union(*bpt__term.retrieve(did))) for did in documents])
+                categories_seconds, _ = timed(lambda: [len(bpt_categories.retrieve(did)) for did in documents])
+            print(f"{document_count:>10} {str(count_values):>9} {memory / 2 ** 20:>12.1f} {seconds:>9.2f} "
+                  f"{terms_seconds / len(documents) * 1e6:>10.2f} {categories_seconds / len(documents) * 1e6:>10.2f}")
+
+
+STEM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "OriginalData", "stem.termid.idf.map.txt")
+
+
+def benchmark_prefix_keys(orders, file_name):
+    """
+    Compares plain and prefix-compressed leaves on the stem vocabulary ('stem termid idf' lines, saved
+    inside a web archive): bytes per key of the bulk-loaded tree, lookup latency and insert throughput.
+    Every key maps to the same value object, so the bytes are those of the keys and the nodes.
+    """
+    with open(file_name or STEM_FILE, encoding="latin1") as file:
+        stems = sorted(set(re.findall(r"^(?:.*<pre[^>]*>)?(\S+) \d+ [\d.]+$", file.read(), re.M)))
+    probes = [stems[randint(0, len(stems) - 1)] for _ in range(100_000)]
+    shuffled = sample(stems, len(stems))
+    print(f"{len(stems)} stems, {sum(map(len, stems)) / len(stems):.1f} characters on average")
+
+    print(f"{'order':>6} {'tree':>16} {'memory (B/key)':>15} {'lookup (us/key)':>16} {'inserts/s':>10}")
+    for order in orders:
+        for tree_class in (BPlusTree, PrefixBPlusTree):
+            # The keys are copied, as they would be when read from the file, so that their bytes are counted.
+            memory_bytes, bpt_instance = traced_bytes(
+                lambda: tree_class(order).bulk_load([((stem + " ")[:-1], ()) for stem in stems]))
+            lookup_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in probes])
+
+            def insert_stems():
+                fresh_tree = tree_class(order)
+                for stem in shuffled:
+                    fresh_tree.insert(stem, ())
+
+            insert_seconds, _ = timed(insert_stems)
+            print(f"{order:>6} {tree_class.__name__:>16} {memory_bytes / len(stems):>15.1f} "
+                  f"{lookup_seconds / len(probes) * 1e6:>16.2f} {len(stems) / insert_seconds:>10.0f}")
+
+
+def benchmark_threads(sizes, order, thread_counts):
+    """
+    Runs the same work on a ConcurrentBPlusTree from 1, 2, 4, ... threads, each taking an equal share:
+    inserts, then lookups, then a mix of 90% lookups and 10% inserts and deletes.
+    Also reports how many writes per thousand fell back to latch crabbing from the root, where writers meet.
+    Scaling past one thread needs a free-threaded (no-GIL) interpreter and as many cores; with the GIL the
+    rates show the cost of the latching against the plain BPlusTree.
+    """
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"GIL {'enabled' if gil else 'disabled'}, {os.cpu_count()} CPUs")
+    print(f"{'pairs':>12} {'tree':>20} {'threads':>8} {'inserts/s':>10} {'lookups/s':>10} {'mixed ops/s':>12} "
+          f"{'crabs/1k writes':>16}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        probes = [key for key, _ in sample(pairs, min(size, 200_000))]
+        mixed = [(key, random()) for key in probes]
+
+        def run_mixed(bpt_instance, share):
+            for key, draw in share:
+                if draw < 0.9:
+                    bpt_instance.retrieve(key)
+                elif draw < 0.95:
+                    bpt_instance.insert(key, "Category_0")
+                else:
+                    bpt_instance.delete(key)
+
+        bpt_instance = BPlusTree(order)
+        insert_seconds, _ = timed(lambda: [bpt_instance.insert(key, value) for key, value in pairs])
+        lookup_seconds, _ = timed(lambda: [bpt_instance.retrieve(key) for key in probes])
+        mixed_seconds, _ = timed(run_mixed, bpt_instance, mixed)
+        print(f"{size:>12} {'BPlusTree':>20} {1:>8} {size / insert_seconds:>10.0f} {len(probes) / lookup_seconds:>10.0f} "
+              f"{len(mixed) / mixed_seconds:>12.0f} {'-':>16}")
+
+        for count in thread_counts:
+            concurrent_tree = ConcurrentBPlusTree(order)
+            crabs = [0]
+            crab = concurrent_tree._crab
+
+            def counted_crab(*args, **kwargs):
+                crabs[0] += 1
+                return crab(*args, **kwargs)
+
+            concurrent_tree._crab = counted_crab
+
+            def run_threads(work, items):
+                threads = [threading.Thread(target=work, args=(items[i::count],)) for i in range(count)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            insert_seconds, _ = timed(run_threads, lambda share: [concurrent_tree.insert(key, value) for key, value in share], pairs)
+            lookup_seconds, _ = timed(run_threads, lambda share: [concurrent_tree.retrieve(key) for key in share], probes)
+            mixed_seconds, _ = timed(run_threads, lambda share: run_mixed(concurrent_tree, share), mixed)
+            writes = size + sum(1 for _, draw in mixed if draw >= 0.9)
+            print(f"{size:>12} {'ConcurrentBPlusTree':>20} {count:>8} {size / insert_seconds:>10.0f} "
+                  f"{len(probes) / lookup_seconds:>10.0f} {len(mixed) / mixed_seconds:>12.0f} {crabs[0] * 1000 / writes:>16.1f}")
+
+
+def benchmark_copy_on_write(sizes, order):
+    """
+    Compares in-place and path-copying inserts, then measures lookups on a CopyOnWriteBPlusTree
+    with no writer and while another thread keeps inserting into it.
+    """
+    print(f"{'pairs':>12} {'tree':>22} {'inserts/s':>12} {'lookups/s idle':>15} {'lookups/s writing':>18}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        seconds, _ = timed(insert_loop, order, pairs)
+        print(f"{size:>12} {'BPlusTree':>22} {size / seconds:>12.0f} {'-':>15} {'-':>18}")
+
+        cow_tree = CopyOnWriteBPlusTree(order)
+
+        def cow_inserts(batch):
+            for key, value in batch:
+                cow_tree.insert(key, value)
+
+        seconds, _ = timed(cow_inserts, pairs)
+        probes = [str(randint(0, size)) for _ in range(100_000)]
+        idle_seconds, _ = timed(lambda: [cow_tree.retrieve(key) for key in probes])
+
+        extra = [(str(size + doc_id), {"Category_0"}) for doc_id in range(size)]
+        writer = threading.Thread(target=cow_inserts, args=(extra,))
+        writer.start()
+        busy_seconds, _ = timed(lambda: [cow_tree.retrieve(key) for key in probes])
+        writer.join()
+        print(f"{size:>12} {'CopyOnWriteBPlusTree':>22} {size / seconds:>12.0f} {len(probes) / idle_seconds:>15.0f} "
+              f"{len(probes) / busy_seconds:>18.0f}")
+
+
+def benchmark_wal(sizes, order, sync_every):
+    """
+    Compares plain BPlusTree inserts with logged DurableBPlusTree inserts per group commit size,
+    and times reopening the tree, which replays the whole log.
+    """
+    print(f"{'inserts':>12} {'sync every':>11} {'inserts/s':>12} {'fsyncs':>8} {'log (MB)':>9} {'replay (s)':>11}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        seconds, _ = timed(insert_loop, order, pairs)
+        print(f"{size:>12} {'-':>11} {size / seconds:>12.0f} {'-':>8} {'-':>9} {'-':>11}")
+
+        for group in sync_every:
+            path = os.path.join(tempfile.mkdtemp(), "benchmark.snapshot")
+            durable_tree = DurableBPlusTree(path, BPlusTree(order), sync_every=group)
+
+            def logged_inserts():
+                for key, value in pairs:
+                    durable_tree.insert(key, value)
+                durable_tree.sync()
+
+            seconds, _ = timed(logged_inserts)
+            syncs = durable_tree.log.syncs
+            durable_tree.close()
+            replay_seconds, durable_tree = timed(DurableBPlusTree, path)
+            print(f"{size:>12} {group:>11} {size / seconds:>12.0f} {syncs:>8} "
+                  f"{os.path.getsize(path + '.wal') / 2 ** 20:>9.1f} {replay_seconds:>11.2f}")
+            durable_tree.close()
+
+
+class DictNode(Final_Code.Node):
+    """
+    Node with the layout used before __slots__: a per-instance __dict__ holding order and uid too.
+    """
+    def __init__(self, *args):
+        super().__init__()
+        self.order = 0
+        self.uid = 0
+
+
+class DictLeafNode(Final_Code.LeafNode):
+    def __init__(self, *args):
+        super().__init__()
+        self.order = 0
+        self.uid = 0
+
+
+def traced_bytes(function, *args):
+    """
+    Returns the bytes still allocated by function(*args) once it returns, together with its result.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def benchmark_node_memory(sizes, order):
+    """
+    Reports the bytes per stored key for the old __dict__ node layout and the current __slots__ one.
+    """
+    print(f"{'pairs':>12} {'__dict__ nodes (B/key)':>23} {'__slots__ nodes (B/key)':>24}")
+    for size in sizes:
+        pairs = make_pairs(size)
+        BPlusTree.node_class, BPlusTree.leaf_class = DictNode, DictLeafNode
+        try:
+            dict_bytes, _ = traced_bytes(insert_loop, order, pairs)
+        finally:
+            BPlusTree.node_class, BPlusTree.leaf_class = DictNode.__base__, DictLeafNode.__base__
+        slots_bytes, _ = traced_bytes(insert_loop, order, pairs)
+        print(f"{size:>12} {dict_bytes / size:>23.1f} {slots_bytes / size:>24.1f}")
+
+
+BENCHMARKS = {
+    "bulk_load": lambda args: benchmark_bulk_load(args.sizes, args.order),
+    "order_sweep": lambda args: benchmark_order_sweep(args.sizes, args.orders),
+    "node_memory": lambda args: benchmark_node_memory(args.sizes, args.order),
+    "value_counts": lambda args: benchmark_value_counts(args.sizes, args.order, args.terms_per_document, args.files),
+    "lazy_delete": lambda args: benchmark_lazy_delete(args.sizes, args.order),
+    "batch_deletes": lambda args: benchmark_batch_deletes(args.sizes, args.order),
+    "ranks": lambda args: benchmark_ranks(args.sizes, args.order),
+    "cursor": lambda args: benchmark_cursor(args.sizes, args.order, args.page_sizes),
+    "copy_on_write": lambda args: benchmark_copy_on_write(args.sizes, args.order),
+    "bloom": lambda args: benchmark_bloom(args.sizes, args.order, args.fp_rates),
+    "buffer_pool": lambda args: benchmark_buffer_pool(args.sizes, args.order, args.cache_pages),
+    "disk_tree": lambda args: benchmark_disk_tree(args.sizes, args.order),
+    "integer_keys": lambda args: benchmark_integer_keys(args.sizes, args.order, args.file),
+    "intern": lambda args: benchmark_intern(args.sizes, args.order, args.terms_per_document, args.files),
+    "insert_many": lambda args: benchmark_insert_many(args.sizes, args.order, args.batch_sizes),
+    "stats": lambda args: benchmark_stats(args.sizes, args.orders),
+    "snapshot": lambda args: benchmark_snapshot(args.sizes, args.order, args.terms_per_document, args.file),
+    "sequential_fill": lambda args: benchmark_sequential_fill(args.sizes, args.order),
+    "retrieve_many": lambda args: benchmark_retrieve_many(args.sizes, args.order, args.terms_per_document),
+    "prefix_keys": lambda args: benchmark_prefix_keys(args.orders, args.file),
+    "threads": lambda args: benchmark_threads(args.sizes, args.order, args.threads),
+    "wal": lambda args: benchmark_wal(args.sizes, args.order, args.sync_every),
+}
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks for the BPlusTree used by the NewsAnalyzer console.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--order", type=int, default=10)
+    parser.add_argument("--orders", type=int, nargs="+", default=[10, 32, 64, 128, 256, 512, 1024])
+    parser.add_argument("--terms-per-document", type=int, default=500)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 100, 1_000, 10_000, 100_000])
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[10, 100, 1_000])
+    parser.add_argument("--cache-pages", type=int, nargs="+", default=[0, 64, 1024, 16384])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--fp-rates", type=float, nargs="+", default=[0.1, 0.01, 0.001])
+    parser.add_argument("--sync-every", type=int, nargs="+", default=[1, 16, 64, 1024])
+    parser.add_argument("--files", nargs=3, metavar=("CATEGORIES", "TERMS", "STEMS"),
+                        help="category_docId, docID_term and stem_term files, e.g. the full RCV1 ones.")
+    parser.add_argument("--file", help="Data file whose key column is used instead of generated document ids.")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = make_parser().parse_args()
+    BENCHMARKS[arguments.benchmark](arguments)
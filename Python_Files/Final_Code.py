@@ -1,11 +1,25 @@
 from __future__ import annotations
 from openpyxl.styles import Font
-from math import floor
+from array import array
+from collections import OrderedDict, deque
+from itertools import accumulate, chain, compress, islice
+from bisect import bisect_left, bisect_right
+from math import floor, log
+from operator import itemgetter
 from random import randint
+import copy
+import gc
+import heapq
 import logging
 import logging.config
 import os
 import json
+import mmap
+import pickle
+import struct
+import sys
+import threading
+import zlib
 import openpyxl
 import logging
 import logging.config
@@ -18,29 +32,37 @@ logger = logging.getLogger(__name__)
 
 
 ###########################################BplustreeStart##############################################
+_NO_KEY = object()  # Marks "no key seen yet" where None could be a real key.
+_TOMBSTONE = object()  # Takes the place of the values of a key that LazyDeleteBPlusTree deleted.
+
 class Node:
     """
     Base node object.
 
+    The order (branching factor) lives on the owning BPlusTree; __slots__ keeps nodes free of a __dict__.
+
     Attributes:
-        order (int): The maximum number of keys each node can hold (branching factor).
+        debug (bool): When True, every new node gets a uid (used by printTree).
     """
+    __slots__ = ('parent', 'keys', 'values', 'uid')
+
+    debug = False
     uidCounter = 0
 
-    def __init__(self, order):
-        self.order = order
+    def __init__(self):
         self.parent: Node = None
         self.keys = []
         self.values = []
 
         #  This is for Debugging purposes only!
-        Node.uidCounter += 1
-        self.uid = self.uidCounter
+        if Node.debug:
+            Node.uidCounter += 1
+            self.uid = Node.uidCounter
 
-    def split(self) -> Node:  # Split a full Node to two new ones.
-        left = Node(self.order)
-        right = Node(self.order)
-        mid = int(self.order // 2)
+    def split(self, order, ratio=0.5, node_class=None) -> Node:  # Split a full Node to two new ones.
+        left = type(self)()
+        right = type(self)()
+        mid = min(order - 2, max(1, int(order * ratio)))  # Both halves keep at least one key.
 
         left.parent = right.parent = self
 
@@ -71,52 +93,55 @@ class Node:
     def isEmpty(self) -> bool:
         return len(self.keys) == 0
 
-    def isFull(self) -> bool:
-        return len(self.keys) == self.order - 1
+    def isFull(self, order) -> bool:
+        return len(self.keys) == order - 1
 
-    def isNearlyUnderflow(self) -> bool:  # Used to check on keys, not data!
-        return len(self.keys) <= floor(self.order / 2)
+    def isNearlyUnderflow(self, order) -> bool:  # Used to check on keys, not data!
+        return len(self.keys) <= floor(order / 2)
 
-    def isUnderflow(self) -> bool:  # Used to check on keys, not data!
-        return len(self.keys) <= floor(self.order / 2) - 1
+    def isUnderflow(self, order) -> bool:  # Used to check on keys, not data!
+        return len(self.keys) <= floor(order / 2) - 1
 
     def isRoot(self) -> bool:
         return self.parent is None
 
 
+class CountedNode(Node):
+    """
+    Inner node of a BPlusTree with enable_ranks(): it also keeps the number of keys in its subtree.
+    """
+    __slots__ = ('count',)
+
+
 class LeafNode(Node):
-    def __init__(self, order):
-        super().__init__(order)
+    __slots__ = ('prevLeaf', 'nextLeaf')
+
+    def __init__(self):
+        super().__init__()
 
         self.prevLeaf: LeafNode = None
         self.nextLeaf: LeafNode = None
 
-    # TODO: Implement an improved version
     def add(self, key, value):
-        if not self.keys:  # Insert key if it doesn't exist
-            self.keys.append(key)
-            self.values.append([value])
-            return
-
-        for i, item in enumerate(self.keys):  # Otherwise, search key and append value.
-            if key == item:  # Key found => Append Value
-                self.values[i].append(value)  # Remember, this is a list of data. Not nodes!
-                break
+        i = bisect_left(self.keys, key)
 
-            elif key < item:  # Key not found && key < item => Add key before item.
-                self.keys = self.keys[:i] + [key] + self.keys[i:]
-                self.values = self.values[:i] + [[value]] + self.values[i:]
-                break
+        if i < len(self.keys) and self.keys[i] == key:  # Key found => Append Value
+            self.values[i].append(value)  # Remember, this is a list of data. Not nodes!
+        else:  # Key not found => Insert it in place, before the first bigger key.
+            self.keys.insert(i, key)
+            self.values.insert(i, [value])
 
-            elif i + 1 == len(self.keys):  # Key not found here. Append it after.
-                self.keys.append(key)
-                self.values.append([value])
-                break
+    def index(self, key) -> int:
+        """
+        Returns the position of key in this leaf, or -1 if the key is not stored here.
+        """
+        i = bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
 
-    def split(self) -> Node:  # Split a full leaf node. (Different method used than before!)
-        top = Node(self.order)
-        right = LeafNode(self.order)
-        mid = int(self.order // 2)
+    def split(self, order, ratio=0.5, node_class=None) -> Node:  # Split a full leaf node. (Different method used than before!)
+        top = (node_class or Node)()  # The tree's inner node class.
+        right = type(self)()
+        mid = min(order - 1, max(1, int(order * ratio)))
 
         self.parent = right.parent = top
 
@@ -124,6 +149,8 @@ class LeafNode(Node):
         right.values = self.values[mid:]
         right.prevLeaf = self
         right.nextLeaf = self.nextLeaf
+        if self.nextLeaf:
+            self.nextLeaf.prevLeaf = right
 
         top.keys = [right.keys[0]]
         top.values = [self, right]  # Setup the pointers to child nodes.
@@ -135,18 +162,367 @@ class LeafNode(Node):
         return top  # Return the 'top node'
 
 
+class IntLeafNode(LeafNode):
+    """
+    Leaf node whose keys are packed in an array of 64-bit integers instead of a list of objects.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__()
+        self.keys = array('q')
+
+
+class PrefixKeys:
+    """
+    Sorted str keys of one leaf, stored as their common prefix plus the remaining suffixes packed
+    into a single string, with the end offset of every suffix in an array.
+
+    It behaves like the list of full keys (indexing, slicing, insert, pop, append, +=, iteration),
+    so the generic leaf code works on it unchanged. search() compares the probe's suffix with the
+    packed suffixes, without rebuilding any stored key.
+    """
+    __slots__ = ('prefix', 'suffixes', 'ends')
+
+    def __init__(self, keys=()):
+        self._pack(list(keys))
+
+    def _pack(self, keys):
+        prefix = os.path.commonprefix(keys) if keys else ''
+        size = len(prefix)
+        self.prefix = prefix
+        self.suffixes = ''.join([key[size:] for key in keys])
+        self.ends = array('I', accumulate(len(key) - size for key in keys))
+
+    def _start(self, i) -> int:
+        return self.ends[i - 1] if i else 0
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        prefix, suffixes = self.prefix, self.suffixes
+        start = 0
+        for end in self.ends:
+            yield prefix + suffixes[start:end]
+            start = end
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PrefixKeys(list(self)[i])  # Recomputes the prefix, which a split may lengthen.
+        if i < 0:
+            i += len(self.ends)
+        if not 0 <= i < len(self.ends):
+            raise IndexError("PrefixKeys index out of range")
+        return self.prefix + self.suffixes[self._start(i):self.ends[i]]
+
+    def __add__(self, other):
+        return PrefixKeys(list(self) + list(other))
+
+    def __iadd__(self, other):
+        self._pack(list(self) + list(other))
+        return self
+
+    def __repr__(self):
+        return f"PrefixKeys({list(self)!r})"
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.prefix) + sys.getsizeof(self.suffixes) + sys.getsizeof(self.ends)
+
+    def search(self, key):
+        """
+        Returns (i, found): the bisect_left position of key and whether the key is stored there.
+        """
+        prefix, suffixes, ends = self.prefix, self.suffixes, self.ends
+        if not key.startswith(prefix):  # Every stored key starts with prefix, so key goes first or last.
+            return (0 if key < prefix else len(ends)), False
+
+        suffix = key[len(prefix):]
+        lo, hi = 0, len(ends)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if suffixes[(ends[mid - 1] if mid else 0):ends[mid]] < suffix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo, lo < len(ends) and suffixes[self._start(lo):ends[lo]] == suffix
+
+    def insert(self, i, key):
+        prefix = self.prefix
+        if not self.ends or not key.startswith(prefix):  # The prefix has to shrink: pack the keys again.
+            keys = list(self)
+            keys.insert(i, key)
+            self._pack(keys)
+            return
+
+        i = min(i, len(self.ends))
+        suffix = key[len(prefix):]
+        start = self._start(i)
+        self.suffixes = self.suffixes[:start] + suffix + self.suffixes[start:]
+        ends = self.ends
+        ends[i:] = array('I', [end + len(suffix) for end in ends[i:]])
+        ends.insert(i, start + len(suffix))
+
+    def append(self, key):
+        self.insert(len(self.ends), key)
+
+    def pop(self, i=-1):
+        key = self[i]
+        if i < 0:
+            i += len(self.ends)
+        start, end = self._start(i), self.ends[i]
+        self.suffixes = self.suffixes[:start] + self.suffixes[end:]
+        ends = self.ends
+        del ends[i]
+        ends[i:] = array('I', [offset - (end - start) for offset in ends[i:]])
+        return key
+
+
+class PrefixLeafNode(LeafNode):
+    """
+    Leaf node whose str keys are stored as PrefixKeys instead of a list of full strings.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__()
+        self.keys = PrefixKeys()
+
+    def add(self, key, value):
+        i, found = self.keys.search(key)
+
+        if found:
+            self.values[i].append(value)
+        else:
+            self.keys.insert(i, key)
+            self.values.insert(i, [value])
+
+    def index(self, key) -> int:
+        i, found = self.keys.search(key)
+        return i if found else -1
+
+
+class BloomFilter:
+    """
+    Bloom filter over the keys of a tree: 'key in bloom' is False only for keys that were never added.
+
+    It is sized for capacity keys at a false positive rate of fp_rate: -capacity * ln(fp_rate) / ln(2)^2
+    bits and size / capacity * ln(2) probes, all derived from hash(key) by double hashing.
+
+    Attributes:
+        count (int): Added keys that set a new bit (about the number of distinct keys).
+        avoided (int): Lookups answered as missing without descending the tree.
+        false_positives (int): Lookups that passed the filter and missed all the same.
+    """
+    __slots__ = ('capacity', 'fp_rate', 'size', 'probes', 'bits', 'count', 'avoided', 'false_positives')
+
+    MIX = 0x9E3779B97F4A7C15  # Spreads consecutive integer keys (hash(n) == n) over the whole filter.
+
+    def __init__(self, capacity, fp_rate=0.01):
+        if not 0 < fp_rate < 1:
+            raise ValueError("fp_rate must be in the range (0, 1).")
+        self.capacity = max(1, capacity)
+        self.fp_rate = fp_rate
+        self.size = max(64, int(-self.capacity * log(fp_rate) / log(2) ** 2))
+        self.probes = max(1, round(self.size / self.capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = self.avoided = self.false_positives = 0
+
+    def add(self, key):
+        mixed = (hash(key) * BloomFilter.MIX) & 0xFFFFFFFFFFFFFFFF
+        position, step = mixed >> 32, mixed & 0xFFFFFFFF | 1
+        bits, size = self.bits, self.size
+        new = False
+        for _ in range(self.probes):
+            position %= size
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+            position += step
+        self.count += new
+
+    def __contains__(self, key):
+        mixed = (hash(key) * BloomFilter.MIX) & 0xFFFFFFFFFFFFFFFF
+        position, step = mixed >> 32, mixed & 0xFFFFFFFF | 1
+        bits, size = self.bits, self.size
+        for _ in range(self.probes):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+
+class TreeCounters:
+    """
+    Counts the work a BPlusTree does, per operation: counts[operation][event].
+
+    The operations are insert, upsert, insert_many, retrieve, retrieve_many, items, seek, delete, delete_value,
+    delete_many and delete_range. The events are
+    calls, visits (nodes searched), comparisons (key comparisons made by the binary searches),
+    splits, merges and borrows.
+    """
+    EVENTS = ('calls', 'visits', 'comparisons', 'splits', 'merges', 'borrows')
+
+    def __init__(self):
+        self.counts = {}
+        self.current = None
+
+    def start(self, operation):
+        current = self.counts.get(operation)
+        if current is None:
+            current = self.counts[operation] = dict.fromkeys(TreeCounters.EVENTS, 0)
+        current['calls'] += 1
+        self.current = current
+
+    def visit(self, node: Node):
+        self.current['visits'] += 1
+        self.current['comparisons'] += len(node.keys).bit_length()  # Steps of a bisect over the keys.
+
+    def count(self, event, amount=1):
+        self.current[event] += amount
+
+    def per_call(self) -> dict:
+        """
+        Returns the average of every event per call of each operation.
+        """
+        return {operation: {event: value / events['calls'] for event, value in events.items() if event != 'calls'}
+                for operation, events in self.counts.items()}
+
+    def reset_counters(self):
+        self.counts = {}
+        self.current = None
+
+
+class Postings(list):
+    """
+    The values stored under one key, as a list that counts the distinct items in them on every change.
+
+    A stored value is a single item or a collection of items (a set of categories, a list of term ids).
+    distinct() returns how many different items the key holds in O(1), without rebuilding them as a set.
+    The stored collections must not be changed in place once they are in.
+    """
+    __slots__ = ('counts',)  # Item -> number of stored values holding it.
+
+    COLLECTIONS = (list, set, frozenset, tuple)
+
+    def __init__(self, values=()):
+        super().__init__()
+        self.counts = {}
+        self.extend(values)
+
+    def __reduce__(self):  # Pickle and copy through __init__, so that the counts are rebuilt.
+        return type(self), (list(self),)
+
+    @staticmethod
+    def _items(value):
+        return value if isinstance(value, Postings.COLLECTIONS) else (value,)
+
+    @staticmethod
+    def count_distinct(values) -> int:
+        """
+        Returns the number of distinct items in values: O(1) for Postings, a pass over them otherwise.
+        """
+        if isinstance(values, Postings):
+            return values.distinct()
+        return len(set(chain.from_iterable(map(Postings._items, values))))
+
+    def distinct(self) -> int:
+        if self.counts is None:
+            return len(self._items(self[0]))
+        return len(self.counts)
+
+    def _add(self, value):
+        if self.counts is None:  # A second value: count the first one's items after all.
+            self.counts = dict.fromkeys(self._items(self[0]), 1)
+        elif not self and len(set(self._items(value))) == len(self._items(value)):
+            # Most keys only ever hold one value, with no repeated items: its length is the count.
+            self.counts = None
+            return
+
+        counts = self.counts
+        for item in self._items(value):
+            counts[item] = counts.get(item, 0) + 1
+
+    def _discard(self, value):
+        counts = self.counts
+        if counts is None:  # The only value is gone.
+            self.counts = {}
+            return
+
+        for item in self._items(value):
+            if counts[item] == 1:
+                del counts[item]
+            else:
+                counts[item] -= 1
+
+    def _recount(self):
+        values = list(self)
+        super().clear()
+        self.counts = {}
+        self.extend(values)
+
+    def append(self, value):
+        self._add(value)
+        super().append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def insert(self, i, value):
+        self._add(value)
+        super().insert(i, value)
+
+    def pop(self, i=-1):
+        value = super().pop(i)
+        self._discard(value)
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._discard(value)
+
+    def clear(self):
+        super().clear()
+        self.counts = {}
+
+    def __setitem__(self, i, value):
+        super().__setitem__(i, value)
+        self._recount()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self._recount()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._recount()
+        return self
+
+
 class BPlusTree(object):
+    node_class = Node
+    leaf_class = LeafNode
+    SEQUENTIAL_SPLIT_RATIO = 0.9  # Share of keys kept on the left when splitting during in-order appends.
+
     def __init__(self, order=5):
-        self.root: Node = LeafNode(order)  # First node must be leaf (to store data).
+        self.root: Node = self.leaf_class()  # First node must be leaf (to store data).
         self.order: int = order
+        self._finger: LeafNode = None  # Right-most leaf seen last, checked before descending.
+        self.bloom: BloomFilter = None  # Set by enable_bloom().
+        self.counters: TreeCounters = None  # Set by enable_counters().
+        self.ranked = False  # Set by enable_ranks(): inner nodes keep the number of keys below them.
 
     @staticmethod
     def _find(node: Node, key):
-        for i, item in enumerate(node.keys):
-            if key < item:
-                return node.values[i], i
-            elif i + 1 == len(node.keys):
-                return node.values[i + 1], i + 1  # return right-most node/pointer.
+        i = bisect_right(node.keys, key)  # First key bigger than ours, or the right-most pointer.
+        return node.values[i], i
 
     @staticmethod
     def _mergeUp(parent: Node, child: Node, index):
@@ -157,226 +533,3464 @@ class BPlusTree(object):
             if isinstance(c, Node):
                 c.parent = parent
 
-        for i, item in enumerate(parent.keys):
-            if pivot < item:
-                parent.keys = parent.keys[:i] + [pivot] + parent.keys[i:]
-                parent.values = parent.values[:i] + child.values + parent.values[i:]
-                break
+        i = bisect_right(parent.keys, pivot)
+        parent.keys.insert(i, pivot)
+        parent.values[i:i] = child.values
 
-            elif i + 1 == len(parent.keys):
-                parent.keys += [pivot]
-                parent.values += child.values
-                break
+    def _seek(self, key):
+        """
+        Returns (leaf, sequential) for an insert of key. A key that does not go before the last key of the
+        cached right-most leaf is an in-order append and skips the descent from the root.
+        """
+        finger = self._finger
+        if finger is not None and finger.nextLeaf is None and finger.keys and not key < finger.keys[-1]:
+            if self.counters is not None:
+                self.counters.visit(finger)
+            return finger, True
+
+        node = self._findLeaf(key)
+        if node.nextLeaf is None:
+            self._finger = node
+        return node, False
+
+    def insert(self, key, value):
+        if self.counters is not None:
+            self.counters.start('insert')
+        node, sequential = self._seek(key)
+
+        # Node is now guaranteed a LeafNode!
+        size = len(node.keys)
+        node.add(key, value)
+        if self.ranked and len(node.keys) > size:
+            self._countUp(node, 1)
+        self._splitUp(node, sequential)
+        if self.bloom is not None:
+            self._remember(key)
+
+    def upsert(self, key, value, merge=None):
+        """
+        Stores value under key with a single descent.
+
+        A new key stores value exactly as given (no list wrapping). For an existing key the
+        stored value becomes merge(current, value), or value itself when merge is None.
+        BPlusTree.merge_extend and BPlusTree.merge_update are the list and set policies.
+        """
+        if self.counters is not None:
+            self.counters.start('upsert')
+        node, sequential = self._seek(key)
+        i = bisect_left(node.keys, key)
+
+        if i < len(node.keys) and node.keys[i] == key:
+            node.values[i] = merge(node.values[i], value) if merge else value
+        else:
+            node.keys.insert(i, key)
+            node.values.insert(i, value)
+            if self.ranked:
+                self._countUp(node, 1)
+            self._splitUp(node, sequential)
+            if self.bloom is not None:
+                self._remember(key)
+
+    @staticmethod
+    def merge_extend(current: list, value) -> list:
+        current.extend(value)
+        return current
+
+    @staticmethod
+    def merge_update(current: set, value) -> set:
+        current.update(value)
+        return current
+
+    def _splitUp(self, node: Node, sequential=False):
+        # In-order appends split the right-most nodes unevenly, so the nodes left behind stay nearly full.
+        ratio = self.SEQUENTIAL_SPLIT_RATIO if sequential else 0.5
+        leaf = node
+
+        while len(node.keys) == self.order:  # 1 over full
+            if self.counters is not None:
+                self.counters.count('splits')
+            if not node.isRoot():
+                parent = node.parent
+                node = node.split(self.order, ratio, self.node_class)  # Split & Set node as the 'top' node.
+                if self.ranked:
+                    self._recount(*node.values)  # The parent's count does not change.
+                jnk, index = self._find(parent, node.keys[0])
+                self._mergeUp(parent, node, index)
+                node = parent
+            else:
+                node = node.split(self.order, ratio, self.node_class)  # Split & Set node as the 'top' node.
+                if self.ranked:
+                    self._recount(*node.values, node)
+                self.root = node  # Re-assign (first split must change the root!)
+
+        if leaf is self._finger and leaf.nextLeaf is not None:
+            self._finger = leaf.nextLeaf  # The new right half is now the right-most leaf.
+
+    def insert_many(self, pairs):
+        """
+        Inserts a batch of (key, value) pairs, like calling insert for each of them in turn.
+
+        The batch is sorted once and merged into the existing leaves one leaf at a time. A leaf
+        that overflows is split only once, into as many leaves as it needs, and the parents
+        are then split the same way level by level.
+        """
+        if self.counters is not None:
+            self.counters.start('insert_many')
+        batch = sorted(pairs, key=itemgetter(0))
+        if not batch:
+            return
+
+        if isinstance(self.root, LeafNode) and self.root.isEmpty():
+            grouped = []
+            for key, value in batch:
+                if grouped and grouped[-1][0] == key:
+                    grouped[-1][1].append(value)
+                else:
+                    grouped.append((key, [value]))
+            self.bulk_load(grouped)
+            return
+
+        overfull = []
+        batch_keys = [key for key, _ in batch]
+        self._insertBatch(self.root, batch, batch_keys, 0, len(batch), overfull)
+
+        while overfull:
+            parents = {}
+            for node in overfull:
+                if len(node.keys) >= self.order:
+                    parent = self._splitMany(node)
+                    parents[id(parent)] = parent
+            overfull = list(parents.values())
+
+        if self.bloom is not None:
+            for key in batch_keys:
+                self._remember(key)
+
+    def _insertBatch(self, node: Node, batch, batch_keys, start, end, overfull):
+        """
+        Hands batch[start:end] down to the children of node, splitting the sorted batch at the separators.
+        Leaves that go over capacity are collected in overfull and split afterwards.
+        """
+        if self.counters is not None:
+            self.counters.visit(node)
+        if isinstance(node, LeafNode):
+            if end - start <= 8:  # A few keys: in-place inserts are cheaper than rebuilding the leaf.
+                for key, value in batch[start:end]:
+                    node.add(key, value)
+            else:
+                self._mergeIntoLeaf(node, batch[start:end])
+            if len(node.keys) >= self.order:
+                overfull.append(node)
+            return
+
+        keys = node.keys
+        while start < end:
+            i = bisect_right(keys, batch_keys[start])
+            stop = end if i == len(keys) else bisect_left(batch_keys, keys[i], start, end)
+            self._insertBatch(node.values[i], batch, batch_keys, start, stop, overfull)
+            start = stop
+        if self.ranked:
+            self._recount(node)
+
+    @staticmethod
+    def _mergeIntoLeaf(leaf: LeafNode, batch):
+        keys, values = leaf.keys[:0], []  # Same container type as the leaf's keys.
+        i = 0
+        for key, value in batch:
+            while i < len(leaf.keys) and leaf.keys[i] < key:
+                keys.append(leaf.keys[i])
+                values.append(leaf.values[i])
+                i += 1
+
+            if keys and keys[-1] == key:
+                values[-1].append(value)
+            elif i < len(leaf.keys) and leaf.keys[i] == key:
+                keys.append(key)
+                values.append(leaf.values[i])
+                values[-1].append(value)
+                i += 1
+            else:
+                keys.append(key)
+                values.append([value])
+
+        leaf.keys = keys + leaf.keys[i:]
+        leaf.values = values + leaf.values[i:]
+
+    def _splitMany(self, node: Node) -> Node:
+        """
+        Splits an overfull node into as many nodes as it needs at once and returns their parent.
+        """
+        isLeaf = isinstance(node, LeafNode)
+        if isLeaf:
+            sizes = self._pack_sizes(len(node.keys), self.order - 1, floor(self.order / 2))
+        else:
+            sizes = self._pack_sizes(len(node.values), self.order, -(-self.order // 2))
+        if self.counters is not None:
+            self.counters.count('splits', len(sizes) - 1)
+
+        parent = node.parent
+        index = self._childIndex(node) if parent is not None else 0
+        keys, values = node.keys, node.values
+        pieces = [node]
+        separators = []
+
+        position = sizes[0]
+        node.keys = keys[:position] if isLeaf else keys[:position - 1]
+        node.values = values[:position]
+        for size in sizes[1:]:
+            piece = type(node)() if isLeaf else self.node_class()
+            if isLeaf:
+                piece.keys = keys[position:position + size]
+                separators.append(piece.keys[0])
+            else:
+                piece.keys = keys[position:position + size - 1]
+                separators.append(keys[position - 1])  # Pushed up between the two pieces.
+                for child in values[position:position + size]:
+                    child.parent = piece
+            piece.values = values[position:position + size]
+            pieces.append(piece)
+            position += size
+
+        if isLeaf:
+            lastLeaf = node.nextLeaf
+            for left, right in zip(pieces, pieces[1:]):
+                left.nextLeaf, right.prevLeaf = right, left
+            pieces[-1].nextLeaf = lastLeaf
+            if lastLeaf:
+                lastLeaf.prevLeaf = pieces[-1]
+
+        if parent is None:  # Splitting the root grows the tree by one level.
+            parent = self.root = self.node_class()
+            parent.values = [node]
+        parent.keys[index:index] = separators
+        parent.values[index + 1:index + 1] = pieces[1:]
+        for piece in pieces:
+            piece.parent = parent
+        if self.ranked:
+            self._recount(*pieces, parent)
+
+        return parent
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        """
+        Builds the tree bottom-up from (key, values) pairs sorted by key.
+
+        The leaves are packed up to fill_factor of their capacity and the internal
+        levels are built on top of them in one linear pass, so no key ever walks
+        down from the root. Any previous content of the tree is discarded.
+        """
+        if not 0 < fill_factor <= 1:
+            raise ValueError("fill_factor must be in the range (0, 1].")
+
+        self._finger = None
+        items = sorted_items if isinstance(sorted_items, list) else list(sorted_items)
+        if self.bloom is not None:
+            self._buildBloom(self.bloom.fp_rate, [key for key, _ in items])
+        if not items:
+            self.root = self.leaf_class()
+            return self
+
+        leaf_capacity = self.order - 1
+        min_leaf_keys = floor(self.order / 2)
+        per_leaf = max(min_leaf_keys, min(leaf_capacity, int(leaf_capacity * fill_factor)))
+
+        level = []
+        lows = []  # Smallest key of every node in the current level.
+        previous_key = _NO_KEY
+        position = 0
+        for size in self._pack_sizes(len(items), per_leaf, min_leaf_keys):
+            leaf = self.leaf_class()
+            for key, values in items[position:position + size]:
+                if previous_key is not _NO_KEY and not previous_key < key:
+                    raise ValueError("bulk_load expects items sorted by strictly increasing key.")
+                leaf.keys.append(key)
+                leaf.values.append(values)
+                previous_key = key
+            position += size
+
+            if level:
+                leaf.prevLeaf = level[-1]
+                level[-1].nextLeaf = leaf
+            level.append(leaf)
+            lows.append(leaf.keys[0])
+
+        min_children = -(-self.order // 2)
+        per_node = max(min_children, min(self.order, int(self.order * fill_factor)))
+        while len(level) > 1:
+            parents = []
+            parent_lows = []
+            position = 0
+            for size in self._pack_sizes(len(level), per_node, min_children):
+                node = self.node_class()
+                node.values = level[position:position + size]
+                node.keys = lows[position + 1:position + size]  # First key of every right subtree.
+                for child in node.values:
+                    child.parent = node
+                if self.ranked:
+                    self._recount(node)
+                parents.append(node)
+                parent_lows.append(lows[position])
+                position += size
+            level, lows = parents, parent_lows
+
+        self.root = level[0]
+        self.root.parent = None
+        return self
+
+    @staticmethod
+    def _pack_sizes(total, per_node, min_size):
+        """
+        Splits total entries into node sizes of at most per_node entries each, spread
+        evenly so that no node (other than a lone root) ends up under min_size.
+        """
+        count = max(1, -(-total // per_node))
+        while count > 1 and total // count < min_size:
+            count -= 1
+        base, extra = divmod(total, count)
+        return [base + 1] * extra + [base] * (count - extra)
+
+    def _findLeaf(self, key) -> LeafNode:
+        node = self.root
+        counters = self.counters
+
+        while not isinstance(node, LeafNode):
+            if counters is not None:
+                counters.visit(node)
+            node, index = self._find(node, key)
+
+        if counters is not None:
+            counters.visit(node)  # The leaf is searched by the caller.
+        return node
+
+    def retrieve(self, key):
+        if self.counters is not None:
+            self.counters.start('retrieve')
+        bloom = self.bloom
+        if bloom is not None and key not in bloom:
+            bloom.avoided += 1
+            return None
+
+        node = self._findLeaf(key)
+        i = node.index(key)
+        if i < 0 and bloom is not None:
+            bloom.false_positives += 1
+        return node.values[i] if i >= 0 else None
+
+    def retrieve_many(self, keys):
+        """
+        Retrieves the values of every key in keys, returned in the same order (None for missing keys).
+
+        The probes are sorted and answered in one left-to-right sweep of the leaf chain. A key beyond
+        the current leaf and its successor is found from the leaf's parent when that covers it, and
+        from the root otherwise: climbing further costs as much as the descent it saves.
+        """
+        if self.counters is not None:
+            self.counters.start('retrieve_many')
+        keys = list(keys)
+        bloom = self.bloom
+        if bloom is None:
+            return self._retrieveSorted(keys)
+
+        present = [key in bloom for key in keys]
+        found = self._retrieveSorted(list(compress(keys, present)))
+        bloom.avoided += present.count(False)
+        bloom.false_positives += found.count(None)
+        found = iter(found)
+        return [next(found) if hit else None for hit in present]
+
+    def _retrieveSorted(self, keys):  # retrieve_many without the Bloom filter.
+        results = [None] * len(keys)
+        if not keys:
+            return results
+
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        node = self._findLeaf(keys[order[0]])
+        node_keys = node.keys
+        last = node_keys[-1] if node_keys else None  # Only the root leaf can be empty.
+        counters = self.counters
+
+        for position in order:
+            key = keys[position]
+            if last is not None and last < key:  # Past this leaf: step to the next one or climb and descend again.
+                nextLeaf = node.nextLeaf
+                if nextLeaf is not None and not nextLeaf.keys[-1] < key:
+                    node = nextLeaf
+                else:  # Descend from the parent when it covers key, else from the root.
+                    parent = node.parent
+                    node = parent if parent is not None and key < parent.keys[-1] else self.root
+                    while not isinstance(node, LeafNode):
+                        node = node.values[bisect_right(node.keys, key)]
+                node_keys = node.keys
+                last = node_keys[-1]
+                if counters is not None:
+                    counters.count('visits')
+
+            if counters is not None:
+                counters.count('comparisons', len(node_keys).bit_length())
+            i = bisect_left(node_keys, key)
+            if i < len(node_keys) and node_keys[i] == key:
+                results[position] = node.values[i]
+
+        return results
+
+    def cursor(self, key=None) -> Cursor:
+        """
+        Returns a Cursor on the first key >= key, or on the first key of the tree when key is None.
+        """
+        return Cursor(self, key)
+
+    def _locate(self, key):
+        """
+        Returns (leaf, index) of the first key >= key.
+        """
+        if self.counters is not None:
+            self.counters.start('seek')
+        node = self._findLeaf(key)
+        return node, bisect_left(node.keys, key)
+
+    def enable_bloom(self, fp_rate=0.01):
+        """
+        Puts a BloomFilter with the given false positive rate in front of retrieve and retrieve_many,
+        so that most lookups of missing keys return without descending the tree.
+
+        Inserts add their keys to the filter, which is rebuilt from the keys for twice as many when
+        it fills up, and by bulk_load. Deleted keys stay in it (as false positives) until a rebuild.
+        """
+        self.bloom = None  # A new filter starts with new counters.
+        self._buildBloom(fp_rate, list(self.keys()))
+        return self
+
+    def _buildBloom(self, fp_rate, keys, capacity=0):
+        bloom = BloomFilter(max(1024, len(keys), capacity), fp_rate)
+        for key in keys:
+            bloom.add(key)
+        if self.bloom is not None:
+            bloom.avoided, bloom.false_positives = self.bloom.avoided, self.bloom.false_positives
+        self.bloom = bloom
+
+    def _remember(self, key):
+        self.bloom.add(key)
+        if self.bloom.count > self.bloom.capacity:
+            self._buildBloom(self.bloom.fp_rate, list(self.keys()), 2 * self.bloom.count)
+
+    def items(self, start=None, stop=None, reverse=False):
+        """
+        Lazily yields (key, values) pairs with start <= key < stop, in key order or reversed.
+
+        The start (or stop, when reversed) key is looked up once and the rest is streamed
+        along the leaf chain. The tree must not be modified while the generator is in use.
+        """
+        if self.counters is not None:
+            self.counters.start('items')
+        if not reverse:
+            if start is None:
+                node, i = self.getLeftmostLeaf(), 0
+            else:
+                node = self._findLeaf(start)
+                i = bisect_left(node.keys, start)
+
+            while node:
+                keys, values = node.keys, node.values
+                while i < len(keys):
+                    if stop is not None and not keys[i] < stop:
+                        return
+                    yield keys[i], values[i]
+                    i += 1
+                node, i = node.nextLeaf, 0
+        else:
+            if stop is None:
+                node = self.getRightmostLeaf()
+                i = len(node.keys) - 1
+            else:
+                node = self._findLeaf(stop)
+                i = bisect_left(node.keys, stop) - 1
+
+            while node:
+                keys, values = node.keys, node.values
+                while i >= 0:
+                    if start is not None and keys[i] < start:
+                        return
+                    yield keys[i], values[i]
+                    i -= 1
+                node = node.prevLeaf
+                i = len(node.keys) - 1 if node else -1
+
+    def prefix_scan(self, prefix, limit=None):
+        """
+        Lazily yields the (key, values) pairs whose string key starts with prefix, in key order.
+
+        Seeks to the first key >= prefix and stops at the first key that does not match,
+        so the cost is O(log n + matches) instead of a pass over every key.
+        """
+        if limit is not None and limit <= 0:
+            return
+        for count, (key, values) in enumerate(self.items(start=prefix), 1):
+            if not key.startswith(prefix):
+                return
+            yield key, values
+            if count == limit:
+                return
+
+    def keys(self, start=None, stop=None, reverse=False):
+        """
+        Lazily yields the keys with start <= key < stop. See items().
+        """
+        for key, _ in self.items(start, stop, reverse):
+            yield key
+
+    def values(self, start=None, stop=None, reverse=False):
+        """
+        Lazily yields the stored values of the keys with start <= key < stop. See items().
+        """
+        for _, values in self.items(start, stop, reverse):
+            yield values
+
+    def save(self, path):
+        """
+        Writes the order, keys and values of the tree to path as a BinarySnapshot.
+        """
+        BinarySnapshot.save(path, self._snapshot())
+
+    @classmethod
+    def load(cls, path) -> BPlusTree:
+        """
+        Reads a tree written by save() back with a single bulk_load. A tree saved from an
+        IntBPlusTree comes back as one.
+        """
+        return cls._fromSnapshot(BinarySnapshot.load(path))
+
+    def _snapshot(self) -> dict:
+        return {'order': self.order, 'int_keys': isinstance(self, IntBPlusTree),
+                'keys': list(self.keys()), 'values': list(self.values())}
+
+    @classmethod
+    def _fromSnapshot(cls, snapshot) -> BPlusTree:
+        enabled = gc.isenabled()
+        gc.disable()  # The nodes are all new and reachable: collecting while building them is wasted work.
+        try:
+            tree_class = IntBPlusTree if snapshot['int_keys'] else BPlusTree
+            if issubclass(cls, tree_class):
+                tree_class = cls
+            return tree_class(snapshot['order']).bulk_load(list(zip(snapshot['keys'], snapshot['values'])))
+        except (KeyError, TypeError) as error:
+            raise ValueError(f"The snapshot does not hold a tree: {error}") from error
+        finally:
+            if enabled:
+                gc.enable()
+
+    def enable_counters(self) -> TreeCounters:
+        """
+        Starts counting splits, merges, borrows, node visits and key comparisons per operation
+        and returns the TreeCounters. Set tree.counters = None to stop.
+        """
+        self.counters = TreeCounters()
+        return self.counters
+
+    def stats(self) -> dict:
+        """
+        Returns the shape of the tree without printing it: height, node and leaf counts, and for every
+        level from the root down its nodes, keys, fill factor (keys / capacity) and bytes.
+
+        Bytes are an estimate (sys.getsizeof) of the nodes, their key and pointer containers and the keys
+        stored in the leaves; the values the leaves point to are not included.
+        """
+        levels = []
+        level = [self.root]
+        while level:
+            keys = sum(len(node.keys) for node in level)
+            size = sum(sys.getsizeof(node) + sys.getsizeof(node.keys) + sys.getsizeof(node.values) for node in level)
+            if isinstance(level[0], LeafNode):
+                size += sum(sys.getsizeof(key) for node in level if isinstance(node.keys, list) for key in node.keys)
+            levels.append({'nodes': len(level), 'keys': keys, 'fill': keys / (len(level) * (self.order - 1)), 'bytes': size})
+            level = [child for node in level if not isinstance(node, LeafNode) for child in node.values]
+
+        return {'height': len(levels), 'nodes': sum(level['nodes'] for level in levels), 'leaves': levels[-1]['nodes'],
+                'keys': levels[-1]['keys'], 'bytes': sum(level['bytes'] for level in levels), 'levels': levels}
+
+    def enable_ranks(self):
+        """
+        Makes every inner node keep the number of keys in its subtree, for rank, select and count_range
+        in O(log n). The inner nodes become CountedNodes, so trees without ranks do not pay for the
+        count; the counts are built once here and then kept up to date by every write.
+        """
+        self.node_class = CountedNode
+        self.root = self._counted(self.root)
+        level = [self.root]
+        levels = []
+        while not isinstance(level[0], LeafNode):
+            levels.append(level)
+            for node in level:
+                node.values = [self._counted(child) for child in node.values]
+            level = [child for node in level for child in node.values]
+        for level in reversed(levels):  # Bottom-up, so every child is counted before its parent.
+            self._recount(*level)
+        self.ranked = True
+        return self
+
+    @staticmethod
+    def _counted(node: Node) -> Node:
+        if isinstance(node, (LeafNode, CountedNode)):
+            return node
+        counted = CountedNode()
+        counted.parent, counted.keys, counted.values = node.parent, node.keys, node.values
+        for child in counted.values:
+            child.parent = counted
+        return counted
+
+    @staticmethod
+    def _size(node: Node) -> int:
+        return len(node.keys) if isinstance(node, LeafNode) else node.count
+
+    @staticmethod
+    def _recount(*nodes: Node):
+        for node in nodes:
+            if not isinstance(node, LeafNode):
+                node.count = sum(map(BPlusTree._size, node.values))
+
+    @staticmethod
+    def _countUp(node: Node, amount):
+        node = node.parent
+        while node is not None:
+            node.count += amount
+            node = node.parent
+
+    def _checkRanked(self):
+        if not self.ranked:
+            raise ValueError("Subtree counts are off: call enable_ranks() first.")
+
+    def rank(self, key) -> int:
+        """
+        Returns the number of keys smaller than key.
+        """
+        self._checkRanked()
+        node = self.root
+        rank = 0
+        while not isinstance(node, LeafNode):
+            i = bisect_right(node.keys, key)
+            rank += sum(map(self._size, node.values[:i]))
+            node = node.values[i]
+        return rank + bisect_left(node.keys, key)
+
+    def select(self, i):
+        """
+        Returns the (key, values) pair of the i-th smallest key, counting from 0 (negative i counts from the end).
+        """
+        self._checkRanked()
+        node = self.root
+        total = self._size(node)
+        if i < 0:
+            i += total
+        if not 0 <= i < total:
+            raise IndexError("select index out of range")
+
+        while not isinstance(node, LeafNode):
+            for child in node.values:
+                size = self._size(child)
+                if i < size:
+                    break
+                i -= size
+            node = child
+        return node.keys[i], node.values[i]
+
+    def count_range(self, lo=None, hi=None) -> int:
+        """
+        Returns the number of keys with lo <= key < hi, with None for an open end, like items(lo, hi).
+        """
+        self._checkRanked()
+        high = self._size(self.root) if hi is None else self.rank(hi)
+        low = 0 if lo is None else self.rank(lo)
+        return max(0, high - low)
+
+    def value_count(self, key):
+        """
+        Returns the number of distinct items stored under key, or None when the key is missing.
+        Values kept as Postings answer without building a set of their items.
+        """
+        values = self.retrieve(key)
+        return None if values is None else Postings.count_distinct(values)
+
+    def value_count_range(self, lo=None, hi=None) -> int:
+        """
+        Returns the sum of value_count over the keys with lo <= key < hi (the categories of a range of documents).
+        """
+        return sum(map(Postings.count_distinct, self.values(lo, hi)))
+
+    def delete(self, key):
+        if self.counters is not None:
+            self.counters.start('delete')
+        return self._deleteFrom(self._findLeaf(key), key)
+
+    def delete_value(self, key, value):
+        """
+        Removes one occurrence of value from the values of key, and the key once it holds no values.
+        Returns False when the key or the value is not stored.
+        """
+        if self.counters is not None:
+            self.counters.start('delete_value')
+        return self._deleteFrom(self._findLeaf(key), key, value)
+
+    def _deleteFrom(self, node: LeafNode, key, value=_NO_KEY):
+        index = node.index(key)
+        if index < 0:
+            return False
+
+        if value is _NO_KEY:
+            node.values[index].pop()  # Remove the last inserted data.
+        else:
+            try:
+                node.values[index].remove(value)
+            except (ValueError, KeyError):  # Not in the list (or set) of values.
+                return False
+
+        if len(node.values[index]) == 0:
+            node.values.pop(index)  # Remove the list element.
+            node.keys.pop(index)
+            if self.ranked:
+                self._countUp(node, -1)
+
+            while node.isUnderflow(self.order) and not node.isRoot():
+                parent = node.parent
+                parentIndex = self._childIndex(node)
+                prevSibling = parent.values[parentIndex - 1] if parentIndex > 0 else None
+                nextSibling = parent.values[parentIndex + 1] if parentIndex + 1 < len(parent.values) else None
+
+                # Borrow attempt, then merge whenever the two nodes fit into one.
+                if prevSibling and not prevSibling.isNearlyUnderflow(self.order):
+                    self._borrowLeft(node, prevSibling, parentIndex)
+                    event = 'borrows'
+                elif nextSibling and not nextSibling.isNearlyUnderflow(self.order):
+                    self._borrowRight(node, nextSibling, parentIndex)
+                    event = 'borrows'
+                elif prevSibling and self._canMerge(prevSibling, node):
+                    self._mergeOnDelete(prevSibling, node)
+                    event = 'merges'
+                elif nextSibling and self._canMerge(node, nextSibling):
+                    self._mergeOnDelete(node, nextSibling)
+                    event = 'merges'
+                elif prevSibling:  # Even-order inner nodes may not fit into one: share a key instead.
+                    self._borrowLeft(node, prevSibling, parentIndex)
+                    event = 'borrows'
+                else:
+                    self._borrowRight(node, nextSibling, parentIndex)
+                    event = 'borrows'
+                if self.counters is not None:
+                    self.counters.count(event)
+                if self.ranked:  # Keys moved between the two siblings only; the parent's count holds.
+                    self._recount(*(sibling for sibling in (prevSibling, node, nextSibling) if sibling is not None))
+
+                node = parent
+
+            if node.isRoot() and not isinstance(node, LeafNode) and len(node.values) == 1:
+                self.root = node.values[0]
+                self.root.parent = None
+        return True
+
+    def delete_many(self, keys):
+        """
+        Deletes every key in keys with all of its values and returns how many of them were stored.
+
+        The keys are sorted once and handed down the tree like insert_many, each leaf dropping its share
+        in one pass. The nodes left underfull are then rebalanced together, level by level (_rebalanceMany).
+        """
+        if self.counters is not None:
+            self.counters.start('delete_many')
+        batch = sorted(set(keys))
+        touched = []
+        removed = self._deleteBatch(self.root, batch, 0, len(batch), touched) if batch else 0
+        self._rebalanceMany(touched)
+        return removed
+
+    def _deleteBatch(self, node: Node, batch, start, end, touched) -> int:
+        if self.counters is not None:
+            self.counters.visit(node)
+        if isinstance(node, LeafNode):
+            dropped = set(batch[start:end])
+            keys, values = node.keys[:0], []  # Same container type as the leaf's keys.
+            for key, value in zip(node.keys, node.values):
+                if key not in dropped:
+                    keys.append(key)
+                    values.append(value)
+            removed = len(node.keys) - len(keys)
+            if removed:
+                node.keys, node.values = keys, values
+                touched.append(node)
+            return removed
+
+        removed = 0
+        keys = node.keys
+        while start < end:
+            i = bisect_right(keys, batch[start])
+            stop = end if i == len(keys) else bisect_left(batch, keys[i], start, end)
+            removed += self._deleteBatch(node.values[i], batch, start, stop, touched)
+            start = stop
+        if self.ranked:
+            self._recount(node)
+        return removed
+
+    def delete_range(self, lo=None, hi=None):
+        """
+        Deletes every key with lo <= key < hi (None for an open end) with all of its values, and returns
+        how many keys went.
+
+        Only the leaves at the two ends of the range are searched. The subtrees between them are cut out
+        of their parents whole, and just the nodes along the two ends are rebalanced afterwards.
+        """
+        if self.counters is not None:
+            self.counters.start('delete_range')
+        if lo is not None and hi is not None and not lo < hi:
+            return 0
+
+        first = self.getLeftmostLeaf() if lo is None else self._findLeaf(lo)
+        last = self.getRightmostLeaf() if hi is None else self._findLeaf(hi)
+        start = 0 if lo is None else bisect_left(first.keys, lo)
+        stop = len(last.keys) if hi is None else bisect_left(last.keys, hi)
+
+        if first is last:
+            removed = stop - start
+            if removed:
+                first.keys, first.values = first.keys[:start] + first.keys[stop:], first.values[:start] + first.values[stop:]
+                if self.ranked:
+                    self._countUp(first, -removed)
+                self._rebalanceMany([first])
+            return removed
+
+        removed = len(first.keys) - start + stop
+        first.keys, first.values = first.keys[:start], first.values[:start]
+        last.keys, last.values = last.keys[stop:], last.values[stop:]
+        leaf = first.nextLeaf
+        while leaf is not last:  # Emptied, so that a cursor left on them seeks again.
+            removed += len(leaf.keys)
+            leaf.keys, leaf.values = leaf.keys[:0], []
+            leaf = leaf.nextLeaf
+        first.nextLeaf, last.prevLeaf = last, first
+
+        self._cutBetween(first, last)
+        self._rebalanceMany([first, last])
+        return removed
+
+    def _cutBetween(self, first: Node, last: Node):
+        """
+        Removes every subtree between the paths of first and last (two nodes of one level) from their parents.
+        """
+        left, right = first, last
+        while left.parent is not right.parent:
+            for node, keep_left in ((left, True), (right, False)):
+                parent = node.parent
+                i = next(i for i, child in enumerate(parent.values) if child is node)
+                if keep_left:  # Drop everything right of the path...
+                    parent.keys, parent.values = parent.keys[:i], parent.values[:i + 1]
+                else:  # ...or left of it.
+                    parent.keys, parent.values = parent.keys[i:], parent.values[i:]
+            left, right = left.parent, right.parent
+            if self.ranked:
+                self._recount(left, right)
+
+        parent = left.parent
+        i = next(i for i, child in enumerate(parent.values) if child is left)
+        j = next(j for j, child in enumerate(parent.values) if child is right)
+        parent.keys = parent.keys[:i] + parent.keys[j - 1:]  # keys[j - 1] now separates left from right.
+        parent.values = parent.values[:i + 1] + parent.values[j:]
+        if self.ranked:
+            while parent is not None:
+                self._recount(parent)
+                parent = parent.parent
+
+    def _rebalanceMany(self, nodes):
+        """
+        Rebalances nodes of one level that may have lost any number of keys, then their parents, level by level,
+        so that every touched node is fixed once instead of once per deleted key. An underflowing node is merged
+        into a sibling, and the result split again (_splitMany) if it no longer fits in one node.
+        """
+        self._finger = None  # The right-most leaf may have been merged away.
+        while nodes:
+            parents = {}
+            for node in nodes:
+                parent = node.parent
+                if parent is None or not any(child is node for child in parent.values):
+                    continue  # The root, or merged into a sibling already.
+                node = self._fixUnderflow(node)
+                if node.parent is not None:
+                    parents[id(node.parent)] = node.parent
+            nodes = list(parents.values())
+
+        while not isinstance(self.root, LeafNode) and len(self.root.values) == 1:
+            self.root = self.root.values[0]
+            self.root.parent = None
+
+    def _fixUnderflow(self, node: Node) -> Node:
+        """
+        Merges node with siblings until it holds enough keys, and returns the node its keys ended up in.
+        """
+        while not node.isRoot() and node.isUnderflow(self.order):
+            parent = node.parent
+            if len(parent.values) == 1:  # No sibling: give the parent some first.
+                if parent.isRoot():
+                    self.root, node.parent = node, None
+                    break
+                self._fixUnderflow(parent)
+                continue
+
+            index = next(i for i, child in enumerate(parent.values) if child is node)
+            if index > 0:
+                node = parent.values[index - 1]
+                self._mergeOnDelete(node, parent.values[index])
+            else:
+                self._mergeOnDelete(node, parent.values[1])
+            if self.counters is not None:
+                self.counters.count('merges')
+            if self.ranked:
+                self._recount(node)
+            if len(node.keys) >= self.order:  # Too big for one node: split it evenly instead.
+                self._splitMany(node)
+        return node
+
+    @staticmethod
+    def _childIndex(node: Node) -> int:
+        """
+        Returns the position of node inside its parent's pointers.
+        """
+        parent = node.parent
+        if node.keys:
+            return bisect_right(parent.keys, node.keys[0])
+        return next(i for i, child in enumerate(parent.values) if child is node)  # Emptied node.
+
+    def _canMerge(self, l_node: Node, r_node: Node) -> bool:
+        separator = 0 if isinstance(l_node, LeafNode) else 1  # Inner merges pull down the parent key.
+        return len(l_node.keys) + len(r_node.keys) + separator < self.order
+
+    @staticmethod
+    def _borrowLeft(node: Node, sibling: Node, parentIndex):
+        if isinstance(node, LeafNode):  # Leaf Redistribution
+            key = sibling.keys.pop(-1)
+            data = sibling.values.pop(-1)
+            node.keys.insert(0, key)
+            node.values.insert(0, data)
+
+            node.parent.keys[parentIndex - 1] = key  # Update Parent (-1 is important!)
+        else:  # Inner Node Redistribution (Push-Through)
+            parent_key = node.parent.keys[parentIndex - 1]
+            sibling_key = sibling.keys.pop(-1)
+            data: Node = sibling.values.pop(-1)
+            data.parent = node
+
+            node.parent.keys[parentIndex - 1] = sibling_key
+            node.keys.insert(0, parent_key)
+            node.values.insert(0, data)
+
+    @staticmethod
+    def _borrowRight(node: LeafNode, sibling: LeafNode, parentIndex):
+        if isinstance(node, LeafNode):  # Leaf Redistribution
+            key = sibling.keys.pop(0)
+            data = sibling.values.pop(0)
+            node.keys.append(key)
+            node.values.append(data)
+            node.parent.keys[parentIndex] = sibling.keys[0]  # Update Parent
+        else:  # Inner Node Redistribution (Push-Through)
+            parent_key = node.parent.keys[parentIndex]
+            sibling_key = sibling.keys.pop(0)
+            data: Node = sibling.values.pop(0)
+            data.parent = node
+
+            node.parent.keys[parentIndex] = sibling_key
+            node.keys.append(parent_key)
+            node.values.append(data)
+
+    @staticmethod
+    def _mergeOnDelete(l_node: Node, r_node: Node):
+        parent = l_node.parent
+
+        index = BPlusTree._childIndex(l_node)  # Separator between the two nodes.
+        parent_key = parent.keys.pop(index)
+        parent.values.pop(index + 1)
+
+        if isinstance(l_node, LeafNode) and isinstance(r_node, LeafNode):
+            l_node.nextLeaf = r_node.nextLeaf  # Change next leaf pointer
+            if r_node.nextLeaf:
+                r_node.nextLeaf.prevLeaf = l_node
+        else:
+            l_node.keys.append(parent_key)
+            for r_node_child in r_node.values:
+                r_node_child.parent = l_node
+
+        l_node.keys += r_node.keys
+        l_node.values += r_node.values
+        r_node.keys, r_node.values = [], []  # r_node is gone; an emptied leaf can no longer pass as a finger.
+
+    @staticmethod
+    def getPrevSibling(node: Node) -> Node:
+        if node.isRoot():
+            return None
+        index = BPlusTree._childIndex(node)
+        return node.parent.values[index - 1] if index - 1 >= 0 else None
+
+    @staticmethod
+    def getNextSibling(node: Node) -> Node:
+        if node.isRoot():
+            return None
+        index = BPlusTree._childIndex(node)
+
+        return node.parent.values[index + 1] if index + 1 < len(node.parent.values) else None
+
+    def printTree(self):
+        if self.root.isEmpty():
+            print('The bpt+ Tree is empty!')
+            return
+        queue = deque([(self.root, 0)])  # Node, Height
+
+        while queue:
+            node, height = queue.popleft()
+
+            if not isinstance(node, LeafNode):
+                queue.extend((child, height + 1) for child in node.values)
+            print('Level ' + str(height), '|'.join(map(str, node.keys)), ' -->\t current -> ', getattr(node, 'uid', None),
+                  '\t parent -> ',
+                  getattr(node.parent, 'uid', None))
+
+    def getLeftmostLeaf(self):
+        if not self.root:
+            return None
+
+        node = self.root
+        while not isinstance(node, LeafNode):
+            node = node.values[0]
+
+        return node
+
+    def getRightmostLeaf(self):
+        if not self.root:
+            return None
+
+        node = self.root
+        while not isinstance(node, LeafNode):
+            node = node.values[-1]
+
+        return node
+
+    def showAllData(self):
+        for node_data in self.values():
+            print('[{}]'.format(', '.join(map(str, node_data))), end=' -> ')
+        print('Last node')
+
+    def showAllDataReverse(self):
+        for node_data in self.values(reverse=True):
+            print('[{}]'.format(', '.join(map(str, node_data))), end=' <- ')
+        print()
+
+    @staticmethod
+    def intersperse(lst, item):
+        result = [item] * (len(lst) * 2)
+        result[0::2] = lst
+        return result
+
+
+class Cursor:
+    """
+    Position in a BPlusTree, kept as a leaf and an offset into it, for paging through the keys in order.
+
+    next() and prev() step along the leaf chain in O(1), and skip(n) jumps whole leaves, so a page
+    costs O(page size) after one seek. Moving past either end leaves the cursor off the tree:
+    current() is None until it moves back. The cursor remembers its key; if a write has moved or
+    removed that key since, the next call seeks it again (the first key after it, if removed).
+    """
+    __slots__ = ('tree', 'leaf', 'index', 'key')
+
+    def __init__(self, tree: BPlusTree, key=None):
+        self.tree = tree
+        if key is None:
+            self._place(tree.getLeftmostLeaf(), 0)
+        else:
+            self.seek(key)
+
+    def _place(self, leaf: LeafNode, index):
+        while leaf is not None and index >= len(leaf.keys):
+            index -= len(leaf.keys)
+            leaf = leaf.nextLeaf
+            if leaf is None:
+                index = 1  # After the last key.
+        while leaf is not None and index < 0:
+            leaf = leaf.prevLeaf
+            if leaf is None:
+                index = -1  # Before the first key.
+            else:
+                index += len(leaf.keys)
+
+        self.leaf, self.index = leaf, index
+        self.key = leaf.keys[index] if leaf is not None else _NO_KEY
+
+    def _revalidate(self):
+        leaf, index = self.leaf, self.index
+        if leaf is not None and not (index < len(leaf.keys) and leaf.keys[index] == self.key):
+            self.seek(self.key)
+
+    def seek(self, key):
+        """
+        Moves to the first key >= key and returns its (key, values), or None when every key is smaller.
+        """
+        self._place(*self.tree._locate(key))
+        return self.current()
+
+    def current(self):
+        """
+        Returns the (key, values) pair at the cursor, or None when it is off the tree.
+        """
+        self._revalidate()
+        return (self.key, self.leaf.values[self.index]) if self.leaf is not None else None
+
+    def next(self):
+        leaf, index = self.leaf, self.index + 1
+        if leaf is not None and index < len(leaf.keys) and leaf.keys[index - 1] == self.key:  # Within the leaf.
+            self.index, self.key = index, leaf.keys[index]
+            return self.key, leaf.values[index]
+        return self.skip(1)
+
+    def prev(self):
+        return self.skip(-1)
+
+    def skip(self, n):
+        """
+        Moves n keys forward (backwards when n is negative) and returns the (key, values) pair there.
+        """
+        self._revalidate()
+        if self.leaf is not None:
+            self._place(self.leaf, self.index + n)
+        elif self.index < 0:  # Re-enter from before the first key...
+            self._place(self.tree.getLeftmostLeaf(), n - 1)
+        else:  # ...or from after the last one.
+            last = self.tree.getRightmostLeaf()
+            self._place(last, len(last.keys) + n)
+        return self.current()
+
+
+class IntBPlusTree(BPlusTree):
+    """
+    BPlusTree for integer keys such as document ids, with the leaf keys stored in array('q').
+
+    Keys are compared as numbers, so 9 sorts before 10 and id ranges scan in numeric order.
+    Keys given as text are converted with int(); text that is not a number is never found.
+    """
+    leaf_class = IntLeafNode
+
+    @staticmethod
+    def _probe(key):
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            return None
+
+    def insert(self, key, value):
+        super().insert(int(key), value)
+
+    def upsert(self, key, value, merge=None):
+        super().upsert(int(key), value, merge)
+
+    def insert_many(self, pairs):
+        super().insert_many([(int(key), value) for key, value in pairs])
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        return super().bulk_load([(int(key), values) for key, values in sorted_items], fill_factor)
+
+    def retrieve(self, key):
+        key = self._probe(key)
+        return None if key is None else super().retrieve(key)
+
+    def retrieve_many(self, keys):
+        probes = [self._probe(key) for key in keys]
+        found = iter(super().retrieve_many([probe for probe in probes if probe is not None]))
+        return [None if probe is None else next(found) for probe in probes]
+
+    def delete(self, key):
+        key = self._probe(key)
+        return False if key is None else super().delete(key)
+
+    def delete_value(self, key, value):
+        key = self._probe(key)
+        return False if key is None else super().delete_value(key, value)
+
+    def delete_many(self, keys):
+        return super().delete_many([key for key in map(self._probe, keys) if key is not None])
+
+    def delete_range(self, lo=None, hi=None):
+        return super().delete_range(None if lo is None else int(lo), None if hi is None else int(hi))
+
+    def items(self, start=None, stop=None, reverse=False):
+        start = None if start is None else int(start)
+        stop = None if stop is None else int(stop)
+        return super().items(start, stop, reverse)
+
+    def _locate(self, key):
+        return super()._locate(int(key))
+
+    def rank(self, key) -> int:
+        return super().rank(int(key))
+
+    def count_range(self, lo=None, hi=None) -> int:
+        return super().count_range(None if lo is None else int(lo), None if hi is None else int(hi))
+
+
+class PrefixBPlusTree(BPlusTree):
+    """
+    BPlusTree for str keys with long shared prefixes (stems, terms). Each leaf stores its keys'
+    common prefix once and packs the suffixes, at the cost of slower inserts.
+    """
+    leaf_class = PrefixLeafNode
+
+    def upsert(self, key, value, merge=None):
+        if self.counters is not None:
+            self.counters.start('upsert')
+        node, sequential = self._seek(key)
+        i, found = node.keys.search(key)
+
+        if found:
+            node.values[i] = merge(node.values[i], value) if merge else value
+        else:
+            node.keys.insert(i, key)
+            node.values.insert(i, value)
+            if self.ranked:
+                self._countUp(node, 1)
+            self._splitUp(node, sequential)
+            if self.bloom is not None:
+                self._remember(key)
+
+    def _locate(self, key):
+        if self.counters is not None:
+            self.counters.start('seek')
+        node = self._findLeaf(key)
+        return node, node.keys.search(key)[0]
+
+
+class _LiveCursor(Cursor):
+    """
+    Cursor of a LazyDeleteBPlusTree: it steps over tombstones, and so moves one key at a time.
+    """
+    __slots__ = ('step',)
+
+    def __init__(self, tree: LazyDeleteBPlusTree, key=None):
+        self.step = 1  # Direction to leave a tombstone in.
+        with tree.lock:
+            super().__init__(tree, key)
+
+    def _place(self, leaf: LeafNode, index):
+        super()._place(leaf, index)
+        while self.leaf is not None and self.leaf.values[self.index] is _TOMBSTONE:
+            super()._place(self.leaf, self.index + self.step)
+
+    def seek(self, key):
+        with self.tree.lock:
+            return super().seek(key)
+
+    def current(self):
+        with self.tree.lock:
+            self._revalidate()
+            if self.leaf is not None and self.leaf.values[self.index] is _TOMBSTONE:  # Deleted since: move on.
+                self._place(self.leaf, self.index)
+            return super().current()
+
+    def next(self):
+        return self.skip(1)
+
+    def skip(self, n):
+        with self.tree.lock:
+            self.step = -1 if n < 0 else 1
+            try:
+                for _ in range(abs(n)):
+                    super().skip(self.step)
+            finally:
+                self.step = 1
+            return self.current()
+
+
+class LazyDeleteBPlusTree(BPlusTree):
+    """
+    BPlusTree whose deletes only mark keys as deleted. When the last value of a key goes, a tombstone takes
+    the place of its values: the delete is one descent, with no borrowing or merging. Reads skip tombstones.
+
+    compact() then removes the tombstoned keys in one batch (delete_many: one pass over their leaves and one
+    rebalance per touched subtree). Deletes never run it: once tombstones make up more than max_ratio of the
+    keys, needs_compaction() turns true and a delete only wakes the background thread, if there is one. The
+    thread runs when an interval is given: every interval seconds and whenever woken, unless a scan is open.
+    Every call takes the tree's lock, so the thread can run alongside them; it compacts chunk leaves at a
+    time, letting go of the lock in between. close() stops it. Without a thread, call compact() when
+    needs_compaction() says so.
+
+    rank, select and count_range need enable_ranks(). The subtree counts include the tombstones, so these
+    step over them one by one: they take time in the number of tombstones, not O(log n).
+    """
+
+    def __init__(self, order=5, max_ratio=0.25, interval=None, chunk=256):
+        if not 0 < max_ratio <= 1:
+            raise ValueError("max_ratio must be in the range (0, 1].")
+        super().__init__(order)
+        self.max_ratio = max_ratio
+        self.chunk = chunk
+        self.tombstoned = set()  # Keys whose values are a tombstone.
+        self.total = 0  # Keys in the tree, tombstones included.
+        self._swept = _NO_KEY  # Key the next chunk starts at, _NO_KEY for the first leaf.
+        self.compactions = 0
+        self.lock = threading.RLock()
+        self._scans = 0  # items() generators not finished yet.
+
+        self.closed = threading.Event()
+        self.wake = threading.Event()  # Set by the delete that takes the tombstones past max_ratio.
+        self.compactor = None
+        if interval is not None:
+            self.compactor = threading.Thread(target=self._compactLoop, args=(interval,), daemon=True)
+            self.compactor.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _compactLoop(self, interval):
+        while not self.closed.is_set():
+            self.wake.wait(interval)
+            self.wake.clear()
+            pending = True
+            while pending and not self.closed.is_set():
+                with self.lock:
+                    pending = not self._scans and self.tombstoned
+                    if pending:
+                        self.compact(self.chunk)
+
+    def close(self):
+        self.closed.set()
+        self.wake.set()
+        if self.compactor is not None:
+            self.compactor.join()
+
+    def needs_compaction(self) -> bool:
+        """
+        Returns whether tombstones make up more than max_ratio of the keys.
+        """
+        return len(self.tombstoned) > self.max_ratio * self.total
+
+    def compact(self, limit=None):
+        """
+        Removes the tombstoned keys from the tree and returns how many went. With a limit, only the
+        tombstones of the next limit leaves go, at most about limit of them, from where the last one stopped.
+        """
+        with self.lock:
+            if not self.tombstoned:
+                return 0
+            if limit is None or limit >= len(self.tombstoned):
+                keys, self.tombstoned = self.tombstoned, set()
+            else:
+                keys = self._sweep(limit)
+                self.tombstoned.difference_update(keys)
+            self.compactions += 1
+            removed = super().delete_many(keys)
+            self.total -= removed
+            return removed
+
+    def _sweep(self, limit):
+        # Neighbouring keys share leaves, so a chunk taken leaf by leaf is cheap to delete in one batch.
+        leaf = self.getLeftmostLeaf() if self._swept is _NO_KEY else self._findLeaf(self._swept)
+        keys = []
+        for _ in range(limit):
+            keys.extend(key for key, values in zip(leaf.keys, leaf.values) if values is _TOMBSTONE)
+            leaf = leaf.nextLeaf
+            if leaf is None or len(keys) >= limit:
+                break
+        self._swept = _NO_KEY if leaf is None else leaf.keys[0]  # Wrap around after the last leaf.
+        return keys
+
+    def _revive(self, key, values, operation):
+        # A tombstoned key is still in its leaf: only its values change.
+        if self.counters is not None:
+            self.counters.start(operation)
+        self.tombstoned.discard(key)
+        node = self._findLeaf(key)
+        node.values[node.index(key)] = values
+
+    def insert(self, key, value):
+        with self.lock:
+            if key in self.tombstoned:
+                self._revive(key, [value], 'insert')
+                return
+            if self.counters is not None:
+                self.counters.start('insert')
+            node, sequential = self._seek(key)
+            size = len(node.keys)
+            node.add(key, value)
+            if len(node.keys) > size:
+                self.total += 1
+                if self.ranked:
+                    self._countUp(node, 1)
+            self._splitUp(node, sequential)
+            if self.bloom is not None:
+                self._remember(key)
+
+    def upsert(self, key, value, merge=None):
+        with self.lock:
+            if key in self.tombstoned:
+                self._revive(key, value, 'upsert')
+                return
+            if self.counters is not None:
+                self.counters.start('upsert')
+            node, sequential = self._seek(key)
+            i = bisect_left(node.keys, key)
+
+            if i < len(node.keys) and node.keys[i] == key:
+                node.values[i] = merge(node.values[i], value) if merge else value
+            else:
+                node.keys.insert(i, key)
+                node.values.insert(i, value)
+                self.total += 1
+                if self.ranked:
+                    self._countUp(node, 1)
+                self._splitUp(node, sequential)
+                if self.bloom is not None:
+                    self._remember(key)
+
+    def insert_many(self, pairs):
+        pairs = list(pairs)
+        with self.lock:
+            for key in {key for key, _ in pairs} & self.tombstoned:
+                self._revive(key, [], 'insert_many')  # insert_many appends to it.
+            super().insert_many(pairs)
+
+    def _insertBatch(self, node: Node, batch, batch_keys, start, end, overfull):
+        if not isinstance(node, LeafNode):
+            return super()._insertBatch(node, batch, batch_keys, start, end, overfull)
+        size = len(node.keys)
+        super()._insertBatch(node, batch, batch_keys, start, end, overfull)
+        self.total += len(node.keys) - size
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        with self.lock:
+            self.tombstoned = set()
+            super().bulk_load(sorted_items, fill_factor)
+            self.total = 0
+            leaf = self.getLeftmostLeaf()
+            while leaf is not None:
+                self.total += len(leaf.keys)
+                leaf = leaf.nextLeaf
+            return self
+
+    def retrieve(self, key):
+        with self.lock:
+            return None if key in self.tombstoned else super().retrieve(key)
+
+    def retrieve_many(self, keys):
+        with self.lock:
+            return [None if values is _TOMBSTONE else values for values in super().retrieve_many(keys)]
+
+    def items(self, start=None, stop=None, reverse=False):
+        with self.lock:
+            self._scans += 1
+        try:
+            for key, values in super().items(start, stop, reverse):
+                if values is not _TOMBSTONE:
+                    yield key, values
+        finally:
+            with self.lock:
+                self._scans -= 1
+
+    def cursor(self, key=None) -> Cursor:
+        return _LiveCursor(self, key)
+
+    def delete(self, key):
+        with self.lock:
+            if self.counters is not None:
+                self.counters.start('delete')
+            return key not in self.tombstoned and self._bury(self._findLeaf(key), key, _NO_KEY)
+
+    def delete_value(self, key, value):
+        with self.lock:
+            if self.counters is not None:
+                self.counters.start('delete_value')
+            return key not in self.tombstoned and self._bury(self._findLeaf(key), key, value)
+
+    def _bury(self, node: LeafNode, key, value):
+        index = node.index(key)
+        if index < 0:
+            return False
+
+        if value is _NO_KEY:
+            node.values[index].pop()  # Remove the last inserted data.
+        else:
+            try:
+                node.values[index].remove(value)
+            except (ValueError, KeyError):
+                return False
+
+        if len(node.values[index]) == 0:
+            node.values[index] = _TOMBSTONE
+            self.tombstoned.add(key)
+            if self.compactor is not None and self.needs_compaction():
+                self.wake.set()
+        return True
+
+    def delete_many(self, keys):
+        keys = set(keys)
+        with self.lock:
+            buried = keys & self.tombstoned
+            self.tombstoned -= buried
+            removed = super().delete_many(keys)
+            self.total -= removed
+            return removed - len(buried)
+
+    def delete_range(self, lo=None, hi=None):
+        with self.lock:
+            buried = {key for key in self.tombstoned if (lo is None or not key < lo) and (hi is None or key < hi)}
+            self.tombstoned -= buried
+            removed = super().delete_range(lo, hi)
+            self.total -= removed
+            return removed - len(buried)
+
+    def rank(self, key) -> int:
+        with self.lock:
+            return super().rank(key) - sum(1 for buried in self.tombstoned if buried < key)
+
+    def select(self, i):
+        with self.lock:
+            self._checkRanked()
+            live = self.total - len(self.tombstoned)
+            if i < 0:
+                i += live
+            if not 0 <= i < live:
+                raise IndexError("select index out of range")
+            for buried in sorted(self.tombstoned):  # Each one at or before the i-th live key moves it one on.
+                if super().rank(buried) > i:
+                    break
+                i += 1
+            return super().select(i)
+
+    def count_range(self, lo=None, hi=None) -> int:
+        with self.lock:
+            self._checkRanked()
+            high = self.total - len(self.tombstoned) if hi is None else self.rank(hi)
+            low = 0 if lo is None else self.rank(lo)
+            return max(0, high - low)
+
+    def stats(self) -> dict:
+        """
+        See BPlusTree.stats; keys include the tombstones, which are also counted on their own.
+        """
+        with self.lock:
+            stats = super().stats()
+            stats['tombstones'] = len(self.tombstoned)
+            return stats
+
+
+class LatchedNode(Node):
+    """
+    Inner node of a ConcurrentBPlusTree. Writers hold its latch while they change it; the version is odd
+    while they hold it and moves on every time they release it after a change, so readers that took no
+    latch can tell whether what they read still stands.
+    """
+    __slots__ = ('latch', 'version')
+
+    def __init__(self):
+        super().__init__()
+        self.latch = threading.Lock()
+        self.version = 0
+
+
+class LatchedLeafNode(LeafNode):
+    __slots__ = ('latch', 'version')
+
+    def __init__(self):
+        super().__init__()
+        self.latch = threading.Lock()
+        self.version = 0
+
+
+class ConcurrentBPlusTree(BPlusTree):
+    """
+    BPlusTree that several threads can insert into, delete from and retrieve from at the same time.
+
+    Reads take no latch (optimistic lock coupling): they descend reading the version of every node
+    before and after using it, and start over from the root if a writer changed a node in between.
+    A reader that meets a node being changed waits on its latch instead of spinning.
+
+    Writers descend the same way and latch only the leaf, as long as it is safe: an insert cannot
+    split it, a delete cannot make it underflow. Otherwise they start over with latch crabbing:
+    latches taken top-down, hand over hand, those above a safe child released again (nothing above
+    it can change), and for deletes the siblings of an unsafe child latched too, which borrowing and
+    merging touch. The root pointer has its own latch, kept for as long as the root itself may change.
+    Writers therefore only meet on the root when a split or merge may reach it.
+
+    Scans (items, keys, values, prefix_scan), insert_many, delete_many, delete_range and bulk_load are
+    not latched: run them while no other thread updates the tree.
+    """
+    node_class = LatchedNode
+    leaf_class = LatchedLeafNode
+
+    def __init__(self, order=5):
+        super().__init__(order)
+        self._rootLatch = threading.Lock()
+
+    def enable_bloom(self, fp_rate=0.01):
+        raise ValueError("A Bloom filter cannot follow concurrent writers: two threads may set bits of the same byte.")
+
+    def enable_counters(self):
+        raise ValueError("TreeCounters are not thread-safe.")
+
+    def enable_ranks(self):
+        raise ValueError("Subtree counts cannot follow concurrent writers: they change above the latched nodes.")
+
+    def _optimistic(self, key):
+        """
+        Descends to the leaf of key without latching and returns (leaf, version, parent, parent version):
+        the versions the two nodes had when the path to them was last seen unchanged. parent is None
+        when the leaf is the root.
+        """
+        while True:
+            node = self.root
+            version = node.version
+            if node is not self.root:  # Replaced before its version was read.
+                continue
+            parent = parentVersion = None
+            try:
+                while not version & 1 and not isinstance(node, LeafNode):
+                    child = node.values[bisect_right(node.keys, key)]
+                    childVersion = child.version
+                    if node.version != version:
+                        break  # The child may not be the one for key any more.
+                    parent, parentVersion, node, version = node, version, child, childVersion
+                else:
+                    if not version & 1:
+                        return node, version, parent, parentVersion
+                    node.latch.acquire()  # A writer is changing the node: wait for it.
+                    node.latch.release()
+            except IndexError:  # Read the keys and pointers of a node halfway through a change.
+                pass
+
+    @staticmethod
+    def _acquire(node: Node, held):
+        node.latch.acquire()
+        node.version += 1
+        held.append(node)
+
+    @staticmethod
+    def _release(held, changed=True):
+        for node in held:
+            node.version += 1 if changed else -1  # Unchanged nodes get their version back: readers go on.
+            node.latch.release()
+        held.clear()
+
+    def _crab(self, key, isSafe, siblings=False):
+        """
+        Latches the path down to the leaf of key and returns (leaf, nodes still latched, whether the
+        root latch is still held). isSafe(node, key) tells whether node absorbs the update without changing its parent.
+        """
+        self._rootLatch.acquire()
+        rootHeld = True
+        held = []
+        node = self.root
+        self._acquire(node, held)
+        if isSafe(node, key):
+            self._rootLatch.release()
+            rootHeld = False
+
+        while not isinstance(node, LeafNode):
+            parent = node
+            node, index = self._find(parent, key)
+            self._acquire(node, held)
+            if isSafe(node, key):
+                if rootHeld:
+                    self._rootLatch.release()
+                    rootHeld = False
+                above = held[:-1]
+                del held[:-1]
+                self._release(above, changed=False)
+            elif siblings:
+                if index > 0:
+                    self._acquire(parent.values[index - 1], held)
+                if index + 1 < len(parent.values):
+                    self._acquire(parent.values[index + 1], held)
+        return node, held, rootHeld
+
+    def _update(self, key, isSafe, change, *args, siblings=False):
+        """
+        Runs change(leaf, key, *args) on the leaf of key and returns its result. The leaf is latched alone
+        when it is safe; else its parent, the leaf (and its siblings for deletes) when the parent is
+        safe; else the path is latched by crabbing from the root.
+        """
+        leaf, version, parent, parentVersion = self._optimistic(key)
+        held = []
+        self._acquire(leaf, held)
+        if leaf.version == version + 1 and isSafe(leaf, key):
+            try:
+                return change(leaf, key, *args)
+            finally:
+                self._release(held)
+        self._release(held, changed=False)
+
+        if parent is not None:
+            self._acquire(parent, held)
+            if parent.version == parentVersion + 1 and isSafe(parent, key):
+                try:
+                    leaf, index = self._find(parent, key)
+                    self._acquire(leaf, held)
+                    if siblings and not isSafe(leaf, key):
+                        if index > 0:
+                            self._acquire(parent.values[index - 1], held)
+                        if index + 1 < len(parent.values):
+                            self._acquire(parent.values[index + 1], held)
+                    return change(leaf, key, *args)
+                finally:
+                    self._release(held)
+            self._release(held, changed=False)
+
+        leaf, held, rootHeld = self._crab(key, isSafe, siblings)
+        try:
+            return change(leaf, key, *args)
+        finally:
+            self._release(held)
+            if rootHeld:
+                self._rootLatch.release()
+
+    def _insertSafe(self, node: Node, key) -> bool:
+        return len(node.keys) < self.order - 1
+
+    def _deleteSafe(self, node: Node, key) -> bool:
+        if isinstance(node, LeafNode):  # A delete that leaves the key in place (or finds none) never underflows.
+            i = node.index(key)
+            if i < 0 or len(node.values[i]) > 1:
+                return True
+        if node.isRoot():  # Only an inner root that loses its last key is replaced.
+            return isinstance(node, LeafNode) or len(node.keys) > 1
+        return not node.isNearlyUnderflow(self.order)
+
+    def _insertInto(self, leaf: LeafNode, key, value):
+        leaf.add(key, value)
+        self._splitUp(leaf)
+
+    def _upsertInto(self, leaf: LeafNode, key, value, merge):
+        i = bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            leaf.values[i] = merge(leaf.values[i], value) if merge else value
+        else:
+            leaf.keys.insert(i, key)
+            leaf.values.insert(i, value)
+            self._splitUp(leaf)
+
+    def insert(self, key, value):
+        self._update(key, self._insertSafe, self._insertInto, value)
+
+    def upsert(self, key, value, merge=None):
+        self._update(key, self._insertSafe, self._upsertInto, value, merge)
+
+    def delete(self, key):
+        return self._update(key, self._deleteSafe, self._deleteFrom, siblings=True)
+
+    def delete_value(self, key, value):
+        return self._update(key, self._deleteSafe, self._deleteFrom, value, siblings=True)
+
+    def retrieve(self, key):
+        while True:
+            leaf, version, _, _ = self._optimistic(key)
+            try:
+                i = leaf.index(key)
+                values = leaf.values[i] if i >= 0 else None
+            except IndexError:
+                continue
+            if leaf.version == version:
+                return values
+
+    def retrieve_many(self, keys):
+        return [self.retrieve(key) for key in keys]
+
+
+class TreeSnapshot:
+    """
+    Read-only view of a CopyOnWriteBPlusTree as it was when the snapshot was taken.
+
+    The nodes it reaches are never modified again, so it can be read from any thread without
+    locks while writers go on. The stored value lists are shared with the tree: treat them as read-only.
+    """
+    __slots__ = ('root', 'order')
+
+    def __init__(self, root: Node, order):
+        self.root = root
+        self.order = order
+
+    def retrieve(self, key):
+        node = self.root
+        while not isinstance(node, LeafNode):
+            node = node.values[bisect_right(node.keys, key)]
+        i = node.index(key)
+        return node.values[i] if i >= 0 else None
+
+    def retrieve_many(self, keys):
+        """
+        Retrieves the values of every key in keys from the same version of the tree (None for missing keys).
+        """
+        snapshot = TreeSnapshot(self.root, self.order)
+        return [snapshot.retrieve(key) for key in keys]
+
+    def items(self, start=None, stop=None, reverse=False):
+        """
+        Lazily yields (key, values) pairs with start <= key < stop, in key order or reversed.
+
+        There is no leaf chain to follow (leaves are shared between versions), so the
+        generator walks down the version it started on and only visits the leaves in range.
+        """
+        for leaf in self._leaves(self.root, start, stop, reverse):
+            keys, values = leaf.keys, leaf.values
+            lo = 0 if start is None else bisect_left(keys, start)
+            hi = len(keys) if stop is None else bisect_left(keys, stop)
+            for i in (range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)):
+                yield keys[i], values[i]
+
+    @staticmethod
+    def _leaves(node: Node, start, stop, reverse):
+        if isinstance(node, LeafNode):
+            yield node
+            return
+        lo = 0 if start is None else bisect_right(node.keys, start)
+        hi = len(node.keys) if stop is None else bisect_left(node.keys, stop)
+        for i in (range(hi, lo - 1, -1) if reverse else range(lo, hi + 1)):
+            yield from TreeSnapshot._leaves(node.values[i], start, stop, reverse)
+
+    def keys(self, start=None, stop=None, reverse=False):
+        for key, _ in self.items(start, stop, reverse):
+            yield key
+
+    def values(self, start=None, stop=None, reverse=False):
+        for _, values in self.items(start, stop, reverse):
+            yield values
+
+
+class CopyOnWriteBPlusTree(TreeSnapshot):
+    """
+    B+ tree that never changes a node in place (path copying).
+
+    insert/upsert/delete copy the nodes from the root down to the leaf they change, share every
+    other node with the previous version and then publish the new root in one assignment. Readers
+    never see a half-done split or merge: each read call works on the root it started with, and
+    snapshot() hands out that root for queries that make several calls. Writers are serialised
+    by a lock. Nodes have no parent pointers or leaf chain, since one node can sit in many versions.
+    """
+    __slots__ = ('lock',)
+
+    def __init__(self, order=5):
+        super().__init__(LeafNode(), order)
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> TreeSnapshot:
+        return TreeSnapshot(self.root, self.order)
+
+    def insert(self, key, value):
+        self._update(key, lambda current: [value] if current is _NO_KEY else current + [value])
+
+    def upsert(self, key, value, merge=None):
+        """
+        See BPlusTree.upsert. merge is given a copy of the current value, which older snapshots still hold.
+        """
+        if merge is None:
+            self._update(key, lambda current: value)
+        else:
+            self._update(key, lambda current: value if current is _NO_KEY else merge(copy.copy(current), value))
+
+    def _update(self, key, new_value):
+        with self.lock:
+            node, split = self._insert(self.root, key, new_value)
+            if split:
+                node = self._node(Node, [split[0]], [node, split[1]])
+            self.root = node
+
+    def _insert(self, node: Node, key, new_value):
+        """
+        Returns the copy of node with new_value(current value, or _NO_KEY) stored under key,
+        and (separator, right node) when the copy had to be split.
+        """
+        if isinstance(node, LeafNode):
+            keys, values = node.keys[:], node.values[:]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                values[i] = new_value(values[i])
+            else:
+                keys.insert(i, key)
+                values.insert(i, new_value(_NO_KEY))
+        else:
+            i = bisect_right(node.keys, key)
+            child, split = self._insert(node.values[i], key, new_value)
+            keys, values = node.keys, node.values[:]
+            values[i] = child
+            if split:
+                keys = keys[:]
+                keys.insert(i, split[0])
+                values.insert(i + 1, split[1])
+
+        if len(keys) < self.order:
+            return self._node(type(node), keys, values), None
+
+        mid = len(keys) // 2
+        if isinstance(node, LeafNode):
+            return (self._node(type(node), keys[:mid], values[:mid]),
+                    (keys[mid], self._node(type(node), keys[mid:], values[mid:])))
+        return (self._node(Node, keys[:mid], values[:mid + 1]),
+                (keys[mid], self._node(Node, keys[mid + 1:], values[mid + 1:])))
+
+    def delete(self, key):
+        """
+        Removes the last inserted value of key, like BPlusTree.delete. Returns False if key is not stored.
+        """
+        with self.lock:
+            node = self._delete(self.root, key)
+            if node is None:
+                return False
+            if not isinstance(node, LeafNode) and not node.keys:
+                node = node.values[0]  # The root lost its last separator: its only child takes over.
+            self.root = node
+            return True
+
+    def _delete(self, node: Node, key):
+        """
+        Returns the copy of node without the last value of key, or None when key is not stored.
+        An underflowing child is merged with or refilled from a sibling, both copied.
+        """
+        if isinstance(node, LeafNode):
+            i = node.index(key)
+            if i < 0:
+                return None
+            keys, values = node.keys, node.values[:]
+            if len(values[i]) > 1:
+                values[i] = copy.copy(values[i])  # Any container upsert stored: older snapshots keep the original.
+                values[i].pop()
+            else:
+                keys = keys[:]
+                del keys[i], values[i]
+            return self._node(type(node), keys, values)
+
+        i = bisect_right(node.keys, key)
+        child = self._delete(node.values[i], key)
+        if child is None:
+            return None
+
+        keys, values = node.keys, node.values[:]
+        values[i] = child
+        if len(child.keys) < (self.order - 1) // 2:
+            keys = keys[:]
+            self._rebalance(keys, values, i - 1 if i > 0 else i)
+        return self._node(Node, keys, values)
+
+    def _rebalance(self, keys, values, i):
+        """
+        Merges values[i] and values[i + 1] into one node, or shares their keys evenly when they do not fit.
+        """
+        left, right = values[i], values[i + 1]
+        kind = type(left)
+        if isinstance(left, LeafNode):
+            merged_keys, merged_values = left.keys + right.keys, left.values + right.values
+            if len(merged_keys) < self.order:
+                values[i:i + 2] = [self._node(kind, merged_keys, merged_values)]
+                del keys[i]
+                return
+            mid = len(merged_keys) // 2
+            keys[i] = merged_keys[mid]
+            values[i:i + 2] = [self._node(kind, merged_keys[:mid], merged_values[:mid]),
+                               self._node(kind, merged_keys[mid:], merged_values[mid:])]
+        else:
+            merged_keys, merged_values = left.keys + [keys[i]] + right.keys, left.values + right.values
+            if len(merged_keys) < self.order:
+                values[i:i + 2] = [self._node(kind, merged_keys, merged_values)]
+                del keys[i]
+                return
+            mid = len(merged_keys) // 2
+            keys[i] = merged_keys[mid]
+            values[i:i + 2] = [self._node(kind, merged_keys[:mid], merged_values[:mid + 1]),
+                               self._node(kind, merged_keys[mid + 1:], merged_values[mid + 1:])]
+
+    @staticmethod
+    def _node(kind, keys, values) -> Node:
+        node = kind()
+        node.keys = keys
+        node.values = values
+        return node
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        """
+        Replaces the content with (key, values) pairs sorted by key. See BPlusTree.bulk_load.
+        """
+        root = BPlusTree(self.order).bulk_load(sorted_items, fill_factor).root
+        nodes = [root]
+        for node in nodes:  # Drop the links that would tie old versions to new ones.
+            node.parent = None
+            if isinstance(node, LeafNode):
+                node.prevLeaf = node.nextLeaf = None
+            else:
+                nodes.extend(node.values)
+        with self.lock:
+            self.root = root
+        return self
+
+
+class _StringIds(dict):
+    """
+    String table of a snapshot being written: looking up a new string gives it the next id.
+    """
+    __slots__ = ()
+
+    def __missing__(self, text):
+        self[text] = number = len(self)
+        return number
+
+
+class BinarySnapshot:
+    """
+    Compact, versioned binary format for trees and the dictionaries returned by ReadFiles.
+
+    A value made of None, bool, int, float, str, list, tuple, set and dict is flattened into one tag
+    byte per item plus arrays of integers (as narrow as they allow) and floats. Every distinct string
+    is written once in a string table. Lists and sets holding only strings or only small integers are
+    stored as one run of numbers, so they are read back with one slice rather than item by item. A list, set or dict
+    reached twice (the keys dictionary and a tree sharing a term list) is written once and referred to
+    afterwards, so it is shared again once loaded.
+    """
+    MAGIC = b'NABPSNAP'
+    VERSION = 1
+    HEADER = struct.Struct('<8sH')
+    SECTION = struct.Struct('<cQ')  # Array typecode, length in bytes.
+
+    (NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, TUPLE, SET, DICT,
+     STR_LIST, STR_SET, INT_LIST, INT_SET, REF, WIDE_INT,
+     STR_LISTS, STR_SETS, DICT_STR_LISTS, DICT_STR_SETS, NESTED_STR_LISTS, NESTED_STR_SETS) = range(22)
+    STR_TYPE = {str}
+    SMALL_INT = 2 ** 31  # Integers from -SMALL_INT up to SMALL_INT go with the other numbers.
+
+    @staticmethod
+    def save(path, value):
+        """
+        Writes value to path. The file is replaced only once it has been written completely.
+        """
+        strings = _StringIds()  # Dicts keep insertion order, so the ids follow the table.
+        tags, numbers, wide, floats = array('B'), array('q'), array('q'), array('d')
+        BinarySnapshot._encode(value, strings, {}, tags, numbers, wide, floats)
+
+        sections = [array('B', ''.join(strings).encode('utf-8', 'surrogatepass')),
+                    BinarySnapshot._narrow(array('q', map(len, strings))), tags, BinarySnapshot._narrow(numbers), wide, floats]
+        with open(path + '.tmp', 'wb') as file:
+            file.write(BinarySnapshot.HEADER.pack(BinarySnapshot.MAGIC, BinarySnapshot.VERSION))
+            for section in sections:
+                if sys.byteorder == 'big':  # Snapshots are always little-endian.
+                    section.byteswap()
+                file.write(BinarySnapshot.SECTION.pack(section.typecode.encode(), len(section) * section.itemsize))
+                file.write(section.tobytes())
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _stringContainers(items, containers, seen=None):
+        """
+        Returns list (or set) when items are distinct lists (or sets) of strings not written before, else None.
+        """
+        run = None
+        seen = set() if seen is None else seen
+        for item in items:
+            kind = type(item)
+            if (kind is not list and kind is not set) or (run is not None and kind is not run):
+                return None
+            if id(item) in containers or id(item) in seen or not set(map(type, item)) <= BinarySnapshot.STR_TYPE:
+                return None
+            run = kind
+            seen.add(id(item))
+        return run
+
+    @staticmethod
+    def _nestedStringContainers(items, containers):
+        """
+        Returns list (or set) when items are distinct, non-empty lists whose items pass _stringContainers
+        with that same answer, else None.
+        """
+        run = None
+        seen = set()
+        for item in items:
+            if (type(item) is not list and type(item) is not Postings) or not item or id(item) in containers or id(item) in seen:
+                return None
+            seen.add(id(item))
+            kind = BinarySnapshot._stringContainers(item, containers, seen)
+            if kind is None or (run is not None and kind is not run):
+                return None
+            run = kind
+        return run
+
+    @staticmethod
+    def _writeLengths(numbers, lengths):
+        """
+        Writes a column of container lengths, or just a marker when they are all 1.
+        """
+        if lengths.count(1) == len(lengths):
+            numbers.append(1)
+        else:
+            numbers.append(0)
+            numbers.extend(lengths)
+
+    @staticmethod
+    def _narrow(numbers: array) -> array:
+        """
+        Returns numbers in the smallest signed integer array that holds all of them.
+        """
+        low, high = min(numbers, default=0), max(numbers, default=0)
+        for typecode in ('b', 'h', 'i'):
+            limit = 2 ** (8 * array(typecode).itemsize - 1)
+            if -limit <= low and high < limit:
+                return array(typecode, numbers)
+        return numbers
+
+    @staticmethod
+    def _encode(value, strings, containers, tags, numbers, wide, floats):
+        kind = type(value)
+        if kind is Postings:  # Read back as a list; ReadFiles counts it again.
+            kind = list
+        if kind is str:
+            tags.append(BinarySnapshot.STR)
+            numbers.append(strings[value])
+            return
+        if kind is int:
+            if -BinarySnapshot.SMALL_INT <= value < BinarySnapshot.SMALL_INT:
+                tags.append(BinarySnapshot.INT)
+                numbers.append(value)
+            else:  # One large number (a timestamp) would otherwise widen the whole array.
+                tags.append(BinarySnapshot.WIDE_INT)
+                wide.append(value)
+            return
+
+        if kind is list or kind is set or kind is dict:
+            index = containers.get(id(value))
+            if index is not None:  # Seen before: refer to it.
+                tags.append(BinarySnapshot.REF)
+                numbers.append(index)
+                return
+            containers[id(value)] = len(containers)
+
+        if kind is list or kind is dict:
+            items = value if kind is list else value.values()
+            run = BinarySnapshot._stringContainers(items, containers)
+            if run is not None and (kind is list or all(type(key) is str for key in value)):
+                # Columns: the count, the keys of a dict, every item's length, then all the strings.
+                if kind is list:
+                    tags.append(BinarySnapshot.STR_LISTS if run is list else BinarySnapshot.STR_SETS)
+                    numbers.append(len(value))
+                else:
+                    tags.append(BinarySnapshot.DICT_STR_LISTS if run is list else BinarySnapshot.DICT_STR_SETS)
+                    numbers.append(len(value))
+                    numbers.extend(map(strings.__getitem__, value))
+                BinarySnapshot._writeLengths(numbers, [len(item) for item in items])
+                for item in items:
+                    containers[id(item)] = len(containers)
+                    numbers.extend(map(strings.__getitem__, item))
+                return
+
+            run = BinarySnapshot._nestedStringContainers(value, containers) if kind is list else None
+            if run is not None:  # A list of such runs (the values of a tree): one more column of lengths.
+                tags.append(BinarySnapshot.NESTED_STR_LISTS if run is list else BinarySnapshot.NESTED_STR_SETS)
+                numbers.append(len(value))
+                BinarySnapshot._writeLengths(numbers, [len(item) for item in value])
+                BinarySnapshot._writeLengths(numbers, [len(inner) for item in value for inner in item])
+                for item in value:
+                    containers[id(item)] = len(containers)
+                    for inner in item:
+                        containers[id(inner)] = len(containers)
+                        numbers.extend(map(strings.__getitem__, inner))
+                return
+
+        if kind is list or kind is set or kind is tuple:
+            numbers.append(len(value))
+            if kind is not tuple and set(map(type, value)) <= BinarySnapshot.STR_TYPE:
+                tags.append(BinarySnapshot.STR_LIST if kind is list else BinarySnapshot.STR_SET)
+                numbers.extend(map(strings.__getitem__, value))
+            elif kind is not tuple and all(type(item) is int and -BinarySnapshot.SMALL_INT <= item < BinarySnapshot.SMALL_INT
+                                           for item in value):
+                tags.append(BinarySnapshot.INT_LIST if kind is list else BinarySnapshot.INT_SET)
+                numbers.extend(value)
+            else:
+                tags.append(BinarySnapshot.LIST if kind is list else BinarySnapshot.SET if kind is set else BinarySnapshot.TUPLE)
+                for item in value:
+                    BinarySnapshot._encode(item, strings, containers, tags, numbers, wide, floats)
+        elif kind is dict:
+            tags.append(BinarySnapshot.DICT)
+            numbers.append(len(value))
+            for key, item in value.items():
+                BinarySnapshot._encode(key, strings, containers, tags, numbers, wide, floats)
+                BinarySnapshot._encode(item, strings, containers, tags, numbers, wide, floats)
+        elif value is None:
+            tags.append(BinarySnapshot.NONE)
+        elif kind is bool:
+            tags.append(BinarySnapshot.TRUE if value else BinarySnapshot.FALSE)
+        elif kind is float:
+            tags.append(BinarySnapshot.FLOAT)
+            floats.append(value)
+        else:
+            raise TypeError(f"{kind.__name__} values cannot be written to a snapshot.")
+
+    @staticmethod
+    def load(path):
+        """
+        Reads back the value written by save(). Raises ValueError for a file that is not a snapshot
+        of this version or is cut short.
+        """
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        try:
+            magic, version = BinarySnapshot.HEADER.unpack_from(data, 0)
+            if magic != BinarySnapshot.MAGIC or version != BinarySnapshot.VERSION:
+                raise ValueError(f"{path} is not a version {BinarySnapshot.VERSION} snapshot.")
+
+            position = BinarySnapshot.HEADER.size
+            sections = []
+            for _ in range(6):  # Strings, string lengths, tags, integers, wide integers, floats.
+                typecode, size = BinarySnapshot.SECTION.unpack_from(data, position)
+                position += BinarySnapshot.SECTION.size
+                section = array(typecode.decode(), data[position:position + size])
+                position += size
+                if sys.byteorder == 'big':
+                    section.byteswap()
+                sections.append(section)
+
+            text, lengths, tags, numbers, wide, floats = sections
+            text = text.tobytes().decode('utf-8', 'surrogatepass')
+            ends = list(accumulate(lengths))
+            # Interned, so the same string loaded from several snapshots (or files) is a single object.
+            strings = [sys.intern(text[start:end]) for start, end in zip([0] + ends, ends)]
+
+            enabled = gc.isenabled()
+            gc.disable()  # Millions of new containers would otherwise trigger full collections over and over.
+            try:
+                return BinarySnapshot._decode(strings, iter(tags), iter(numbers), iter(wide), iter(floats))
+            finally:
+                if enabled:
+                    gc.enable()
+        except (struct.error, IndexError, StopIteration) as error:
+            raise ValueError(f"{path} is not a complete snapshot.") from error
+
+    @staticmethod
+    def _decode(strings, tags, numbers, wide, floats):
+        (NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, TUPLE, SET, DICT,
+         STR_LIST, STR_SET, INT_LIST, INT_SET, REF, WIDE_INT,
+         STR_LISTS, STR_SETS, DICT_STR_LISTS, DICT_STR_SETS, NESTED_STR_LISTS, NESTED_STR_SETS) = range(22)  # Locals: faster than class lookups.
+        string = strings.__getitem__
+        containers = []  # Every list, set and dict in the order they were first written.
+
+        def readLengths(count):
+            return [1] * count if next(numbers) else list(islice(numbers, count))
+
+        def build(container, lengths):
+            if lengths.count(1) == len(lengths):  # Single strings ({category}, {stem}) are the common case.
+                texts = map(string, islice(numbers, len(lengths)))
+                return [{text} for text in texts] if container is set else [[text] for text in texts]
+            return [container(map(string, islice(numbers, length))) for length in lengths]
+
+        def read():
+            tag = next(tags)
+            if tag == LIST:
+                count = next(numbers)
+                result = []
+                containers.append(result)  # Registered before its items, as in _encode.
+                result.extend([read() for _ in range(count)])
+                return result
+            if tag == STR_SET:
+                result = set(map(string, islice(numbers, next(numbers))))
+            elif tag == STR_LIST:
+                result = list(map(string, islice(numbers, next(numbers))))
+            elif tag == STR_SETS or tag == STR_LISTS or tag == DICT_STR_SETS or tag == DICT_STR_LISTS:
+                count = next(numbers)
+                keys = list(map(string, islice(numbers, count))) if tag >= DICT_STR_LISTS else None
+                container = set if tag == STR_SETS or tag == DICT_STR_SETS else list
+                items = build(container, readLengths(count))
+                result = items if keys is None else dict(zip(keys, items))
+                containers.append(result)
+                containers.extend(items)
+                return result
+            elif tag == NESTED_STR_SETS or tag == NESTED_STR_LISTS:
+                container = set if tag == NESTED_STR_SETS else list
+                sizes = readLengths(next(numbers))
+                inner = build(container, readLengths(sum(sizes)))
+                ends = list(accumulate(sizes))
+                result = [inner[start:end] for start, end in zip([0] + ends, ends)]
+                containers.append(result)
+                for item in result:
+                    containers.append(item)
+                    containers.extend(item)
+                return result
+            elif tag == STR:
+                return strings[next(numbers)]
+            elif tag == INT:
+                return next(numbers)
+            elif tag == REF:
+                return containers[next(numbers)]
+            elif tag == INT_LIST:
+                result = list(islice(numbers, next(numbers)))
+            elif tag == INT_SET:
+                result = set(islice(numbers, next(numbers)))
+            elif tag == DICT:
+                count = next(numbers)
+                result = {}
+                containers.append(result)
+                for _ in range(count):
+                    key = read()  # Keys are written before their values.
+                    result[key] = read()
+                return result
+            elif tag == SET:
+                count = next(numbers)
+                result = set()
+                containers.append(result)
+                result.update([read() for _ in range(count)])
+                return result
+            elif tag == TUPLE:
+                return tuple([read() for _ in range(next(numbers))])
+            elif tag == WIDE_INT:
+                return next(wide)
+            elif tag == FLOAT:
+                return next(floats)
+            elif tag == NONE:
+                return None
+            elif tag == TRUE or tag == FALSE:
+                return tag == TRUE
+            else:
+                raise ValueError(f"Unknown snapshot tag {tag}.")
+            containers.append(result)
+            return result
+
+        return read()
+
+
+class PageCodec:
+    """
+    Fixed, version-independent byte format for the keys and values of DiskBPlusTree pages.
+
+    Every item is a tag byte followed by a little-endian 8-byte int or float, or by a 4-byte length
+    and the item's bytes or items. Only None, bool, int, float, str, bytes, list, tuple, set, frozenset
+    and dict are written, and decoding builds nothing else, so a damaged or crafted file cannot run
+    code the way a pickle can. Lists of strings, of bytes and of small ints (the keys, values and
+    children of a node) are written as one run, read back without a call per item.
+    """
+    (NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, TUPLE, SET, FROZENSET, DICT, WIDE_INT,
+     STR_LIST, BYTES_LIST, INT_LIST) = range(16)
+    INT_ITEM = struct.Struct('<Bq')
+    FLOAT_ITEM = struct.Struct('<Bd')
+    SIZED_ITEM = struct.Struct('<BI')  # Tag, then a length in bytes or a count of items.
+    LENGTH = struct.Struct('<I')
+    SMALL_INT = 2 ** 63
+
+    @staticmethod
+    def encode(value) -> bytes:
+        out = bytearray()
+        PageCodec._encode(value, out)
+        return bytes(out)
+
+    @staticmethod
+    def _encode(value, out):
+        kind = type(value)
+        if kind is str:
+            data = value.encode('utf-8', 'surrogatepass')
+            out += PageCodec.SIZED_ITEM.pack(PageCodec.STR, len(data))
+            out += data
+        elif kind is int:
+            if -PageCodec.SMALL_INT <= value < PageCodec.SMALL_INT:
+                out += PageCodec.INT_ITEM.pack(PageCodec.INT, value)
+            else:
+                data = value.to_bytes(value.bit_length() // 8 + 1, 'little', signed=True)
+                out += PageCodec.SIZED_ITEM.pack(PageCodec.WIDE_INT, len(data))
+                out += data
+        elif kind is list or kind is Postings:  # Postings are read back as a list.
+            text = None
+            if value and type(value[0]) is str:
+                try:
+                    text = '\0'.join(value)
+                except TypeError:  # Not only strings.
+                    pass
+            types = None if text is not None else set(map(type, value))
+            if text is not None and text.count('\0') == len(value) - 1:  # No string holds the separator.
+                data = text.encode('utf-8', 'surrogatepass')
+                out += PageCodec.SIZED_ITEM.pack(PageCodec.STR_LIST, len(value))
+                out += PageCodec.LENGTH.pack(len(data))
+                out += data
+            elif types == {bytes}:
+                out += PageCodec.SIZED_ITEM.pack(PageCodec.BYTES_LIST, len(value))
+                out += PageCodec._littleEndian(array('I', map(len, value)))  # The lengths, then all the data.
+                out += b''.join(value)
+            elif types == {int} and -PageCodec.SMALL_INT <= min(value) and max(value) < PageCodec.SMALL_INT:
+                out += PageCodec.SIZED_ITEM.pack(PageCodec.INT_LIST, len(value))
+                out += PageCodec._littleEndian(array('q', value))
+            else:
+                PageCodec._encodeItems(PageCodec.LIST, value, out)
+        elif kind is bytes:
+            out += PageCodec.SIZED_ITEM.pack(PageCodec.BYTES, len(value))
+            out += value
+        elif kind is tuple or kind is set or kind is frozenset:
+            PageCodec._encodeItems(PageCodec.TUPLE if kind is tuple else PageCodec.SET if kind is set else PageCodec.FROZENSET,
+                                   value, out)
+        elif kind is dict:
+            out += PageCodec.SIZED_ITEM.pack(PageCodec.DICT, len(value))
+            for key, item in value.items():
+                PageCodec._encode(key, out)
+                PageCodec._encode(item, out)
+        elif value is None:
+            out.append(PageCodec.NONE)
+        elif kind is bool:
+            out.append(PageCodec.TRUE if value else PageCodec.FALSE)
+        elif kind is float:
+            out += PageCodec.FLOAT_ITEM.pack(PageCodec.FLOAT, value)
+        else:
+            raise TypeError(f"{kind.__name__} values cannot be written to a page.")
+
+    @staticmethod
+    def _encodeItems(tag, items, out):
+        out += PageCodec.SIZED_ITEM.pack(tag, len(items))
+        for item in items:
+            PageCodec._encode(item, out)
+
+    @staticmethod
+    def _littleEndian(numbers: array) -> array:  # Pages are always little-endian, like snapshots.
+        if sys.byteorder == 'big':
+            numbers.byteswap()
+        return numbers
+
+    @staticmethod
+    def _numbers(typecode, data, position, count) -> array:
+        end = position + array(typecode).itemsize * count
+        if end > len(data):
+            raise IndexError("items run past the end")
+        return PageCodec._littleEndian(array(typecode, data[position:end]))
+
+    @staticmethod
+    def decode(data: bytes):
+        """
+        Reads back the value written by encode(). Raises ValueError for bytes that do not hold one.
+        """
+        try:
+            value, position = PageCodec._decode(data, 0)
+        except (struct.error, IndexError, TypeError, UnicodeDecodeError, RecursionError) as error:
+            raise ValueError(f"The page is damaged: {error}") from error
+        if position != len(data):
+            raise ValueError("The page is damaged: bytes left over after its value.")
+        return value
+
+    @staticmethod
+    def _decode(data, position):
+        tag = data[position]
+        if tag == PageCodec.INT:
+            return PageCodec.INT_ITEM.unpack_from(data, position)[1], position + PageCodec.INT_ITEM.size
+        if tag == PageCodec.FLOAT:
+            return PageCodec.FLOAT_ITEM.unpack_from(data, position)[1], position + PageCodec.FLOAT_ITEM.size
+        if tag == PageCodec.NONE or tag == PageCodec.FALSE or tag == PageCodec.TRUE:
+            return (None, False, True)[tag], position + 1
+
+        size = PageCodec.SIZED_ITEM.unpack_from(data, position)[1]
+        position += PageCodec.SIZED_ITEM.size
+        if tag == PageCodec.STR or tag == PageCodec.BYTES or tag == PageCodec.WIDE_INT:
+            end = position + size
+            if end > len(data):
+                raise IndexError("item runs past the end")
+            chunk = data[position:end]
+            if tag == PageCodec.STR:
+                return chunk.decode('utf-8', 'surrogatepass'), end
+            return (chunk if tag == PageCodec.BYTES else int.from_bytes(chunk, 'little', signed=True)), end
+        if tag == PageCodec.STR_LIST:  # One decode and one split for all the keys of a node.
+            end = position + PageCodec.LENGTH.size + PageCodec.LENGTH.unpack_from(data, position)[0]
+            if end > len(data):
+                raise IndexError("items run past the end")
+            items = data[position + PageCodec.LENGTH.size:end].decode('utf-8', 'surrogatepass').split('\0') if size else []
+            if len(items) != size:
+                raise IndexError("wrong number of items")
+            return items, end
+        if tag == PageCodec.BYTES_LIST:
+            lengths = PageCodec._numbers('I', data, position, size)
+            ends = list(accumulate(lengths, initial=position + lengths.itemsize * size))
+            if ends[-1] > len(data):
+                raise IndexError("items run past the end")
+            return [data[start:end] for start, end in zip(ends, ends[1:])], ends[-1]
+        if tag == PageCodec.INT_LIST:
+            numbers = PageCodec._numbers('q', data, position, size)
+            return numbers.tolist(), position + numbers.itemsize * size
+        if tag == PageCodec.DICT:
+            result = {}
+            for _ in range(size):
+                key, position = PageCodec._decode(data, position)
+                result[key], position = PageCodec._decode(data, position)
+            return result, position
+        if tag not in (PageCodec.LIST, PageCodec.TUPLE, PageCodec.SET, PageCodec.FROZENSET):
+            raise TypeError(f"unknown tag {tag}")
+
+        items = []
+        for _ in range(size):
+            item, position = PageCodec._decode(data, position)
+            items.append(item)
+        if tag == PageCodec.LIST:
+            return items, position
+        return (tuple if tag == PageCodec.TUPLE else set if tag == PageCodec.SET else frozenset)(items), position
+
+
+class PageFile:
+    """
+    A single file of fixed-size pages accessed through mmap.
+
+    Page 0 holds the header (format version, page size, tree order, root page and free list).
+    Every other page starts with its kind, two page links and the length of its payload.
+    Freed pages are chained into a free list and handed out again before the file grows.
+    """
+    MAGIC = b'NABPTREE'
+    VERSION = 2  # 2: PageCodec payloads instead of pickles.
+    HEADER = struct.Struct('<8sHIIqqq')  # Magic, version, page size, order, page count, root, free list head.
+    PAGE = struct.Struct('<BqqI')  # Kind, previous page, next page, payload length.
+
+    FREE, INNER, LEAF, OVERFLOW = range(4)
+
+    def __init__(self, path, page_size=4096, order=64):
+        exists = os.path.isfile(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'r+b' if exists else 'w+b')
+
+        if exists:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            magic, version, self.page_size, self.order, self.page_count, self.root, self.free_head = \
+                self.HEADER.unpack_from(self.map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                self.close()
+                raise ValueError(f"{path} is not a version {self.VERSION} tree page file.")
+        else:
+            if page_size < 256:
+                self.file.close()
+                raise ValueError("page_size must be at least 256 bytes.")
+            self.page_size, self.order = page_size, order
+            self.file.truncate(page_size * 16)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            self.reset()
+
+        self.capacity = self.page_size - self.PAGE.size  # Payload bytes that fit in one page.
+
+    def reset(self):
+        """
+        Forgets every page but the header. The file keeps its size and is reused from the start.
+        """
+        self.page_count, self.root, self.free_head = 1, -1, -1
+        self.writeHeader()
+
+    def writeHeader(self):
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.page_size, self.order,
+                              self.page_count, self.root, self.free_head)
+
+    def allocate(self) -> int:
+        """
+        Returns the number of an unused page, taken from the free list or appended to the file.
+        """
+        if self.free_head >= 0:
+            page_no = self.free_head
+            self.free_head = self.PAGE.unpack_from(self.map, page_no * self.page_size)[2]
+            return page_no
+
+        page_no = self.page_count
+        self.page_count += 1
+        if self.page_count * self.page_size > len(self.map):  # Grow the file by doubling it.
+            size = len(self.map) * 2
+            self.map.close()
+            self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        return page_no
+
+    def free(self, page_no):
+        self.PAGE.pack_into(self.map, page_no * self.page_size, self.FREE, -1, self.free_head, 0)
+        self.free_head = page_no
+
+    def read(self, page_no):
+        """
+        Returns (kind, previous page, next page, payload) of a page.
+        """
+        offset = page_no * self.page_size
+        kind, prev, next_page, length = self.PAGE.unpack_from(self.map, offset)
+        offset += self.PAGE.size
+        return kind, prev, next_page, self.map[offset:offset + length]
+
+    def write(self, page_no, kind, prev, next_page, payload):
+        if len(payload) > self.capacity:
+            raise ValueError(f"A payload of {len(payload)} bytes does not fit in a {self.page_size} byte page.")
+        offset = page_no * self.page_size
+        self.PAGE.pack_into(self.map, offset, kind, prev, next_page, len(payload))
+        offset += self.PAGE.size
+        self.map[offset:offset + len(payload)] = payload
+
+    def writeChain(self, data) -> int:
+        """
+        Stores data that is too long for a leaf in a chain of overflow pages and returns the first page.
+        """
+        chunks = [data[i:i + self.capacity] for i in range(0, len(data), self.capacity)]
+        pages = [self.allocate() for _ in chunks]
+        for i, chunk in enumerate(chunks):
+            self.write(pages[i], self.OVERFLOW, -1, pages[i + 1] if i + 1 < len(pages) else -1, chunk)
+        return pages[0]
+
+    def readChain(self, page_no) -> bytes:
+        chunks = []
+        while page_no >= 0:
+            kind, prev, page_no, chunk = self.read(page_no)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def freeChain(self, page_no):
+        while page_no >= 0:
+            next_page = self.PAGE.unpack_from(self.map, page_no * self.page_size)[2]
+            self.free(page_no)
+            page_no = next_page
+
+    def flush(self):
+        self.writeHeader()
+        self.map.flush()
+
+    def close(self):
+        if not self.map.closed:
+            self.flush()
+            self.map.close()
+        self.file.close()
+
+
+class BufferPool:
+    """
+    A bounded cache of decoded pages between a DiskBPlusTree and its PageFile, with LRU eviction.
+
+    The capacity is a number of pages, a number of bytes of page payload, or both. Pinned pages are never
+    evicted, so the pool may briefly hold more while an operation pins its path. A dirty page keeps
+    the payload it was last stored with, which is written to the file when it is evicted or flushed.
+
+    Attributes:
+        hits, misses, evictions, writes (int): Counters since the pool was created or reset_counters().
+    """
+    def __init__(self, read, write, capacity_pages=1024, capacity_bytes=None):
+        if capacity_pages is None and capacity_bytes is None:
+            raise ValueError("The buffer pool needs a capacity in pages or in bytes.")
+        self.read = read  # page number -> (node, payload bytes)
+        self.write = write  # (node, payload) -> None
+        self.capacity_pages = capacity_pages
+        self.capacity_bytes = capacity_bytes
+
+        self.frames = OrderedDict()  # Page number -> node, least recently used first.
+        self.sizes = {}
+        self.dirty = {}  # Page number -> payload still to be written.
+        self.pins = {}
+        self.bytes = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = self.misses = self.evictions = self.writes = 0
+
+    def get(self, page_no):
+        node = self.frames.get(page_no)
+        if node is not None:
+            self.hits += 1
+            self.frames.move_to_end(page_no)
+            return node
+
+        self.misses += 1
+        node, size = self.read(page_no)
+        self._admit(node, size)
+        return node
+
+    def put(self, node, payload):
+        """
+        Caches node as the newest version of its page and marks it dirty.
+        """
+        self.dirty[node.page] = payload
+        self._admit(node, len(payload))
+
+    def _admit(self, node, size):
+        page_no = node.page
+        if page_no in self.frames:
+            self.bytes -= self.sizes[page_no]
+            self.frames.move_to_end(page_no)
+        self.frames[page_no] = node
+        self.sizes[page_no] = size
+        self.bytes += size
+        self._evict()
+
+    def _isOver(self) -> bool:
+        return (self.capacity_pages is not None and len(self.frames) > self.capacity_pages) or \
+            (self.capacity_bytes is not None and self.bytes > self.capacity_bytes)
+
+    def _evict(self):
+        while self._isOver():
+            page_no = next((page_no for page_no in self.frames if page_no not in self.pins), None)
+            if page_no is None:  # Everything left is pinned.
+                return
+            node = self.frames.pop(page_no)
+            self.bytes -= self.sizes.pop(page_no)
+            self.evictions += 1
+            if page_no in self.dirty:
+                self.write(node, self.dirty.pop(page_no))
+                self.writes += 1
+
+    def pin(self, page_no):
+        self.pins[page_no] = self.pins.get(page_no, 0) + 1
+
+    def unpin(self, page_no):
+        count = self.pins.pop(page_no, 0) - 1
+        if count > 0:
+            self.pins[page_no] = count
+        elif page_no in self.frames:
+            self._evict()
+
+    def discard(self, page_no):
+        """
+        Drops a freed page without writing it back.
+        """
+        if page_no in self.frames:
+            del self.frames[page_no]
+            self.bytes -= self.sizes.pop(page_no)
+        self.dirty.pop(page_no, None)
+
+    def clear(self):
+        self.frames.clear()
+        self.sizes.clear()
+        self.dirty.clear()
+        self.bytes = 0
+
+    def flush(self):
+        """
+        Writes every dirty page back; the pages stay cached.
+        """
+        for page_no, payload in self.dirty.items():
+            self.write(self.frames[page_no], payload)
+            self.writes += 1
+        self.dirty.clear()
 
-    def insert(self, key, value):
-        node = self.root
 
-        while not isinstance(node, LeafNode):  # While we are in internal nodes... search for leafs.
-            node, index = self._find(node, key)
+class PageNode:
+    """
+    A node decoded from its page. Children are page numbers instead of objects, and a leaf keeps
+    every value encoded (or as an (overflow page, length) pair) until it is asked for.
+    """
+    __slots__ = ('page', 'leaf', 'keys', 'values', 'prevLeaf', 'nextLeaf')
 
-        # Node is now guaranteed a LeafNode!
-        node.add(key, value)
+    def __init__(self, page, leaf):
+        self.page: int = page
+        self.leaf: bool = leaf
+        self.keys = []
+        self.values = []
+        self.prevLeaf: int = -1
+        self.nextLeaf: int = -1
 
-        while len(node.keys) == node.order:  # 1 over full
-            if not node.isRoot():
-                parent = node.parent
-                node = node.split()  # Split & Set node as the 'top' node.
-                jnk, index = self._find(parent, node.keys[0])
-                self._mergeUp(parent, node, index)
-                node = parent
-            else:
-                node = node.split()  # Split & Set node as the 'top' node.
-                self.root = node  # Re-assign (first split must change the root!)
 
-    def retrieve(self, key):
-        node = self.root
+class DiskBPlusTree:
+    """
+    BPlusTree whose nodes are fixed-size pages of one file, read through mmap.
+
+    It offers the insert/upsert/retrieve/delete/items API of BPlusTree, but only the pages on the path of
+    an operation are decoded, so a tree larger than RAM can be opened and queried. Decoded pages are kept
+    in a BufferPool of cache_pages pages and/or cache_bytes bytes of payload. A node splits when it
+    reaches the order or outgrows its page; values longer than a quarter page move to overflow pages.
+    Keys and values are written with PageCodec, so they must be made of the plain types it knows.
+    An existing file is reopened with the order it was built with. Call close() (or use a with block) to
+    write the dirty pages and the header back.
+    """
+    def __init__(self, path, order=64, page_size=4096, cache_pages=1024, cache_bytes=None):
+        if order < 3:
+            raise ValueError("order must be at least 3.")
+        self.pages = PageFile(path, page_size, order)
+        self.pool = BufferPool(self._read, self._writeBack, cache_pages, cache_bytes)
+        self.order: int = self.pages.order
+        self.spill_size = self.pages.page_size // 4  # Longer encoded values go to overflow pages.
+        if self.pages.root < 0:
+            root = PageNode(self.pages.allocate(), True)
+            self._write(root)
+            self.pages.root = root.page
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def flush(self):
+        self.pool.flush()
+        self.pages.flush()
+
+    def close(self):
+        if not self.pages.map.closed:
+            self.pool.flush()
+        self.pages.close()
+
+    def _load(self, page_no) -> PageNode:
+        return self.pool.get(page_no)
+
+    def _read(self, page_no):
+        kind, prev, next_page, payload = self.pages.read(page_no)
+        node = PageNode(page_no, kind == PageFile.LEAF)
+        node.keys, node.values = PageCodec.decode(payload)
+        node.prevLeaf, node.nextLeaf = prev, next_page
+        return node, len(payload)
+
+    def _encode(self, node: PageNode) -> bytes:
+        return PageCodec.encode([node.keys, node.values])
+
+    def _write(self, node: PageNode, payload=None):
+        payload = payload or self._encode(node)
+        if len(payload) > self.pages.capacity:
+            raise ValueError(f"A payload of {len(payload)} bytes does not fit in a {self.pages.page_size} byte page.")
+        self.pool.put(node, payload)
+
+    def _writeBack(self, node: PageNode, payload):
+        kind = PageFile.LEAF if node.leaf else PageFile.INNER
+        self.pages.write(node.page, kind, node.prevLeaf, node.nextLeaf, payload)
+
+    def _free(self, page_no):
+        self.pool.discard(page_no)
+        self.pages.free(page_no)
+
+    def _value(self, leaf: PageNode, index):
+        value = leaf.values[index]
+        return PageCodec.decode(value if isinstance(value, bytes) else self.pages.readChain(value[0]))
+
+    def _setValue(self, leaf: PageNode, index, value):
+        old = leaf.values[index]
+        if isinstance(old, tuple):
+            self.pages.freeChain(old[0])
+
+        data = PageCodec.encode(value)
+        leaf.values[index] = data if len(data) <= self.spill_size else (self.pages.writeChain(data), len(data))
+
+    def _store(self, node: PageNode):
+        """
+        Writes node back to its page. A node that reached the order or outgrew its page is split
+        first; returns the (separator, page) pairs that its parent must add right after it.
+        """
+        payload = self._encode(node)
+        if len(node.keys) < self.order and len(payload) <= self.pages.capacity:
+            self._write(node, payload)
+            return []
+        if len(node.keys) < (2 if node.leaf else 3):
+            raise ValueError(f"A key is too large for a {self.pages.page_size} byte page.")
+
+        mid = len(node.keys) // 2
+        right = PageNode(self.pages.allocate(), node.leaf)
+        if node.leaf:
+            right.keys, right.values = node.keys[mid:], node.values[mid:]
+            separator = right.keys[0]
+            right.prevLeaf, right.nextLeaf = node.page, node.nextLeaf
+            if node.nextLeaf >= 0:
+                nextLeaf = self._load(node.nextLeaf)
+                nextLeaf.prevLeaf = right.page
+                self._write(nextLeaf)
+            node.nextLeaf = right.page
+            node.values = node.values[:mid]
+        else:
+            separator = node.keys[mid]
+            right.keys, right.values = node.keys[mid + 1:], node.values[mid + 1:]
+            node.values = node.values[:mid + 1]
+        node.keys = node.keys[:mid]
 
-        while not isinstance(node, LeafNode):
-            node, index = self._find(node, key)
+        tail = self._store(right)  # Right first: a further split of node relinks right's prevLeaf on disk.
+        return self._store(node) + [(separator, right.page)] + tail
 
-        for i, item in enumerate(node.keys):
-            if key == item:
-                return node.values[i]
+    @staticmethod
+    def _adopt(node: PageNode, index, pieces):
+        for offset, (separator, page) in enumerate(pieces):
+            node.keys.insert(index + offset, separator)
+            node.values.insert(index + offset + 1, page)
 
-        return None
+    def _rebalance(self, parent: PageNode, index, child: PageNode):
+        """
+        Merges an underflowing child with a sibling. When the two do not fit in one page the merged
+        node is split back evenly by _store, which amounts to borrowing from the sibling.
+        """
+        if index > 0:
+            left, right, index = self._load(parent.values[index - 1]), child, index - 1
+        else:
+            left, right = child, self._load(parent.values[index + 1])
 
-    def delete(self, key):
-        node = self.root
+        separator = parent.keys.pop(index)
+        parent.values.pop(index + 1)
+        self.pool.pin(left.page)
+        try:
+            if left.leaf:
+                left.nextLeaf = right.nextLeaf
+                if right.nextLeaf >= 0:
+                    nextLeaf = self._load(right.nextLeaf)
+                    nextLeaf.prevLeaf = left.page
+                    self._write(nextLeaf)
+            else:
+                left.keys.append(separator)  # Inner merges pull down the parent key.
+            left.keys += right.keys
+            left.values += right.values
+            self._free(right.page)
 
-        while not isinstance(node, LeafNode):
-            node, parentIndex = self._find(node, key)
+            self._adopt(parent, index, self._store(left))
+        finally:
+            self.pool.unpin(left.page)
 
-        if key not in node.keys:
+    def _descend(self, page_no, key, change):
+        """
+        Applies change to the leaf of key and rebalances on the way back up.
+        Returns None when change left the leaf untouched, else (pieces, node) for the caller.
+        """
+        node = self._load(page_no)
+        self.pool.pin(page_no)  # Stays cached until its children have been rebalanced.
+        try:
+            if node.leaf:
+                if not change(node):
+                    return None
+            else:
+                i = bisect_right(node.keys, key)
+                result = self._descend(node.values[i], key, change)
+                if result is None:
+                    return None
+
+                pieces, child = result
+                if pieces:
+                    self._adopt(node, i, pieces)
+                elif len(child.keys) < self.order // 2 and len(node.values) > 1:
+                    self._rebalance(node, i, child)
+
+            return self._store(node), node
+        finally:
+            self.pool.unpin(page_no)
+
+    def _apply(self, key, change) -> bool:
+        result = self._descend(self.pages.root, key, change)
+        if result is None:
             return False
 
-        index = node.keys.index(key)
-        node.values[index].pop()  # Remove the last inserted data.
+        pieces, root = result
+        while pieces:  # The root split: grow the tree by one level.
+            root = PageNode(self.pages.allocate(), False)
+            root.keys = [separator for separator, _ in pieces]
+            root.values = [self.pages.root] + [page for _, page in pieces]
+            self.pages.root = root.page
+            pieces = self._store(root)
 
-        if len(node.values[index]) == 0:
-            node.values.pop(index)  # Remove the list element.
-            node.keys.pop(index)
+        while not root.leaf and len(root.values) == 1:  # The root lost its last separator.
+            self._free(root.page)
+            root = self._load(root.values[0])
+            self.pages.root = root.page
+        return True
 
-            while node.isUnderflow() and not node.isRoot():
-                # Borrow attempt:
-                prevSibling = BPlusTree.getPrevSibling(node)
-                nextSibling = BPlusTree.getNextSibling(node)
-                jnk, parentIndex = self._find(node.parent, key)
+    def insert(self, key, value):
+        def change(leaf):
+            i = bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:  # Key found => Append Value
+                values = self._value(leaf, i)
+                values.append(value)
+                self._setValue(leaf, i, values)
+            else:
+                leaf.keys.insert(i, key)
+                leaf.values.insert(i, None)
+                self._setValue(leaf, i, [value])
+            return True
 
-                if prevSibling and not prevSibling.isNearlyUnderflow():
-                    self._borrowLeft(node, prevSibling, parentIndex)
-                elif nextSibling and not nextSibling.isNearlyUnderflow():
-                    self._borrowRight(node, nextSibling, parentIndex)
-                elif prevSibling and prevSibling.isNearlyUnderflow():
-                    self._mergeOnDelete(prevSibling, node)
-                elif nextSibling and nextSibling.isNearlyUnderflow():
-                    self._mergeOnDelete(node, nextSibling)
+        self._apply(key, change)
 
-                node = node.parent
+    def upsert(self, key, value, merge=None):
+        """
+        Stores value under key. See BPlusTree.upsert.
+        """
+        def change(leaf):
+            i = bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:
+                self._setValue(leaf, i, merge(self._value(leaf, i), value) if merge else value)
+            else:
+                leaf.keys.insert(i, key)
+                leaf.values.insert(i, None)
+                self._setValue(leaf, i, value)
+            return True
 
-            if node.isRoot() and not isinstance(node, LeafNode) and len(node.values) == 1:
-                self.root = node.values[0]
-                self.root.parent = None
+        self._apply(key, change)
 
-    @staticmethod
-    def _borrowLeft(node: Node, sibling: Node, parentIndex):
-        if isinstance(node, LeafNode):  # Leaf Redistribution
-            key = sibling.keys.pop(-1)
-            data = sibling.values.pop(-1)
-            node.keys.insert(0, key)
-            node.values.insert(0, data)
+    def delete(self, key) -> bool:
+        """
+        Removes the last inserted value of key, and key itself once it has no values left.
+        Returns False when key is not in the tree.
+        """
+        def change(leaf):
+            i = bisect_left(leaf.keys, key)
+            if i == len(leaf.keys) or leaf.keys[i] != key:
+                return False
+
+            values = self._value(leaf, i)
+            values.pop()  # Remove the last inserted data.
+            if values:
+                self._setValue(leaf, i, values)
+            else:
+                if isinstance(leaf.values[i], tuple):
+                    self.pages.freeChain(leaf.values[i][0])
+                leaf.keys.pop(i)
+                leaf.values.pop(i)
+            return True
+
+        return self._apply(key, change)
+
+    def _findLeaf(self, key) -> PageNode:
+        node = self._load(self.pages.root)
+        while not node.leaf:
+            node = self._load(node.values[bisect_right(node.keys, key)])
+        return node
 
-            node.parent.keys[parentIndex - 1] = key  # Update Parent (-1 is important!)
-        else:  # Inner Node Redistribution (Push-Through)
-            parent_key = node.parent.keys.pop(-1)
-            sibling_key = sibling.keys.pop(-1)
-            data: Node = sibling.values.pop(-1)
-            data.parent = node
+    def _edgeLeaf(self, last) -> PageNode:
+        node = self._load(self.pages.root)
+        while not node.leaf:
+            node = self._load(node.values[-1 if last else 0])
+        return node
 
-            node.parent.keys.insert(0, sibling_key)
-            node.keys.insert(0, parent_key)
-            node.values.insert(0, data)
+    def retrieve(self, key):
+        node = self._findLeaf(key)
+        i = bisect_left(node.keys, key)
+        return self._value(node, i) if i < len(node.keys) and node.keys[i] == key else None
 
-    @staticmethod
-    def _borrowRight(node: LeafNode, sibling: LeafNode, parentIndex):
-        if isinstance(node, LeafNode):  # Leaf Redistribution
-            key = sibling.keys.pop(0)
-            data = sibling.values.pop(0)
-            node.keys.append(key)
-            node.values.append(data)
-            node.parent.keys[parentIndex] = sibling.keys[0]  # Update Parent
-        else:  # Inner Node Redistribution (Push-Through)
-            parent_key = node.parent.keys.pop(0)
-            sibling_key = sibling.keys.pop(0)
-            data: Node = sibling.values.pop(0)
-            data.parent = node
+    def items(self, start=None, stop=None, reverse=False):
+        """
+        Lazily yields (key, values) pairs with start <= key < stop, in key order or reversed. See BPlusTree.items.
+        """
+        if not reverse:
+            if start is None:
+                node, i = self._edgeLeaf(False), 0
+            else:
+                node = self._findLeaf(start)
+                i = bisect_left(node.keys, start)
+
+            while True:
+                while i < len(node.keys):
+                    if stop is not None and not node.keys[i] < stop:
+                        return
+                    yield node.keys[i], self._value(node, i)
+                    i += 1
+                if node.nextLeaf < 0:
+                    return
+                node, i = self._load(node.nextLeaf), 0
+        else:
+            if stop is None:
+                node = self._edgeLeaf(True)
+                i = len(node.keys) - 1
+            else:
+                node = self._findLeaf(stop)
+                i = bisect_left(node.keys, stop) - 1
+
+            while True:
+                while i >= 0:
+                    if start is not None and node.keys[i] < start:
+                        return
+                    yield node.keys[i], self._value(node, i)
+                    i -= 1
+                if node.prevLeaf < 0:
+                    return
+                node = self._load(node.prevLeaf)
+                i = len(node.keys) - 1
+
+    def keys(self, start=None, stop=None, reverse=False):
+        for key, _ in self.items(start, stop, reverse):
+            yield key
+
+    def values(self, start=None, stop=None, reverse=False):
+        for _, values in self.items(start, stop, reverse):
+            yield values
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        """
+        Builds the tree bottom-up from (key, values) pairs sorted by key, like BPlusTree.bulk_load.
 
-            node.parent.keys.append(sibling_key)
-            node.keys.append(parent_key)
-            node.values.append(data)
+        sorted_items may be any iterable: leaves are written as they fill up, and only the first key and
+        page number of every node of the level being built are kept in memory. Any previous content of
+        the tree is discarded.
+        """
+        if not 0 < fill_factor <= 1:
+            raise ValueError("fill_factor must be in the range (0, 1].")
+
+        self.pool.clear()
+        self.pages.reset()
+        room = int((self.pages.capacity - 64) * fill_factor)  # Leaves slack for the list headers.
+        per_leaf = max(self.order // 2, min(self.order - 1, int((self.order - 1) * fill_factor)))
+        per_node = max(-(-self.order // 2), min(self.order, int(self.order * fill_factor)))
+
+        level = []  # (smallest key, page) of every node in the current level.
+        leaf = PageNode(self.pages.allocate(), True)
+        size = 0
+        previous_key = _NO_KEY
+        for key, values in sorted_items:
+            if previous_key is not _NO_KEY and not previous_key < key:
+                raise ValueError("bulk_load expects items sorted by strictly increasing key.")
+            previous_key = key
+
+            leaf.keys.append(key)
+            leaf.values.append(None)
+            self._setValue(leaf, -1, values)
+            entry = len(PageCodec.encode(key)) + 16
+            entry += len(leaf.values[-1]) if isinstance(leaf.values[-1], bytes) else 32
+
+            if len(leaf.keys) > 1 and (len(leaf.keys) > per_leaf or size + entry > room):
+                key, value = leaf.keys.pop(), leaf.values.pop()
+                nextLeaf = PageNode(self.pages.allocate(), True)
+                nextLeaf.prevLeaf, leaf.nextLeaf = leaf.page, nextLeaf.page
+                self._write(leaf)
+                level.append((leaf.keys[0], leaf.page))
+
+                leaf = nextLeaf
+                leaf.keys.append(key)
+                leaf.values.append(value)
+                size = 0
+            size += entry
+
+        self._write(leaf)
+        level.append((leaf.keys[0] if leaf.keys else None, leaf.page))
+        self._spreadTail(level)
+
+        while len(level) > 1:
+            parents = []
+            node = None
+            for low, page in level:
+                entry = len(PageCodec.encode(low)) + 16
+                if node is None or len(node.values) == per_node or size + entry > room:
+                    if node is not None:
+                        self._write(node)
+                    node = PageNode(self.pages.allocate(), False)
+                    node.values.append(page)
+                    parents.append((low, node.page))
+                    size = 0
+                else:
+                    node.keys.append(low)  # First key of every right subtree.
+                    node.values.append(page)
+                size += entry
+            self._write(node)
+            self._spreadTail(parents)
+            level = parents
+
+        self.pages.root = level[0][1]
+        return self
+
+    def _spreadTail(self, level):
+        """
+        Evens out the last two nodes of a level built by bulk_load when the last one ended up under the
+        minimum, as BPlusTree._pack_sizes does: they are merged, and _store splits them back in two halves
+        when they do not fit in one page.
+        """
+        if len(level) < 2:
+            return
+        (_, left_page), (low, right_page) = level[-2:]
+        right = self._load(right_page)
+        if len(right.keys) >= self.order // 2:
+            return
 
-    @staticmethod
-    def _mergeOnDelete(l_node: Node, r_node: Node):
-        parent = l_node.parent
+        left = self._load(left_page)
+        if left.leaf:
+            left.nextLeaf = right.nextLeaf
+        else:
+            left.keys.append(low)  # First key of the right subtree.
+        left.keys += right.keys
+        left.values += right.values
+        self._free(right.page)
+        level[-1:] = self._store(left)
 
-        jnk, index = BPlusTree._find(parent, l_node.keys[0])  # Reset pointer to child
-        parent_key = parent.keys.pop(index)
-        parent.values.pop(index)
-        parent.values[index] = l_node
 
-        if isinstance(l_node, LeafNode) and isinstance(r_node, LeafNode):
-            l_node.nextLeaf = r_node.nextLeaf  # Change next leaf pointer
-        else:
-            l_node.keys.append(parent_key)  # TODO Verify this
-            for r_node_child in r_node.values:
-                r_node_child.parent = l_node
+class WriteAheadLog:
+    """
+    Append-only log of tree updates with group commit.
 
-        l_node.keys += r_node.keys
-        l_node.values += r_node.values
+    Every record is its length and CRC-32 followed by the pickled update. Records are written to the
+    file at once but only fsync'ed every sync_every records, or sync_interval seconds after the first
+    unsynced one by a background thread, so many updates share one fsync. A torn record at the end
+    of the file (a crash in the middle of a write) is cut off when the log is opened.
 
-    @staticmethod
-    def getPrevSibling(node: Node) -> Node:
-        if node.isRoot() or not node.keys:
-            return None
-        jnk, index = BPlusTree._find(node.parent, node.keys[0])
-        return node.parent.values[index - 1] if index - 1 >= 0 else None
+    Attributes:
+        syncs (int): Number of fsync calls so far.
+    """
+    RECORD = struct.Struct('<II')  # Payload length, CRC-32 of the payload.
+
+    def __init__(self, path, sync_every=64, sync_interval=0.01):
+        if sync_every < 1:
+            raise ValueError("sync_every must be at least 1.")
+        self.path = path
+        self.sync_every = sync_every
+        self.records = self._readRecords()
+        self.file = open(path, 'ab')
+        self.pending = 0
+        self.syncs = 0
+        self.lock = threading.Lock()
+
+        self.closed = threading.Event()
+        self.syncer = None
+        if sync_interval is not None:
+            self.syncer = threading.Thread(target=self._syncLoop, args=(sync_interval,), daemon=True)
+            self.syncer.start()
+
+    def _readRecords(self):
+        """
+        Returns the updates in the log and truncates the file after the last complete one.
+        """
+        if not os.path.isfile(self.path):
+            return []
 
-    @staticmethod
-    def getNextSibling(node: Node) -> Node:
-        if node.isRoot() or not node.keys:
-            return None
-        jnk, index = BPlusTree._find(node.parent, node.keys[0])
+        with open(self.path, 'rb') as file:
+            data = file.read()
 
-        return node.parent.values[index + 1] if index + 1 < len(node.parent.values) else None
+        records = []
+        position = 0
+        while position + self.RECORD.size <= len(data):
+            length, checksum = self.RECORD.unpack_from(data, position)
+            payload = data[position + self.RECORD.size:position + self.RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            records.append(pickle.loads(payload))
+            position += self.RECORD.size + length
+
+        if position < len(data):
+            with open(self.path, 'r+b') as file:
+                file.truncate(position)
+        return records
+
+    def append(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.file.write(self.RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.pending += 1
+            if self.pending >= self.sync_every:
+                self._sync()
+
+    def sync(self):
+        """
+        Makes every appended record durable now.
+        """
+        with self.lock:
+            if self.pending:
+                self._sync()
 
-    def printTree(self):
-        if self.root.isEmpty():
-            print('The bpt+ Tree is empty!')
-            return
-        queue = [self.root, 0]  # Node, Height... Not systematic but it works
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.syncs += 1
 
-        while len(queue) > 0:
-            node = queue.pop(0)
-            height = queue.pop(0)
+    def _syncLoop(self, interval):
+        while not self.closed.wait(interval):
+            self.sync()
 
-            if not isinstance(node, LeafNode):
-                queue += self.intersperse(node.values, height + 1)
-            print('Level ' + str(height), '|'.join(map(str, node.keys)), ' -->\t current -> ', node.uid,
-                  '\t parent -> ',
-                  node.parent.uid if node.parent else None)
+    def truncate(self):
+        """
+        Empties the log, once its updates are part of a checkpoint.
+        """
+        with self.lock:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.records = []
+
+    def close(self):
+        self.closed.set()
+        if self.syncer is not None:
+            self.syncer.join()
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+class DurableBPlusTree:
+    """
+    BPlusTree whose insert/upsert/insert_many/delete calls (delete_value, delete_many and delete_range too)
+    are logged to a WriteAheadLog once they have been applied; an update that raises is not logged.
+    bulk_load replaces the whole tree, so it is followed by a checkpoint instead.
+
+    The tree lives in memory. checkpoint() saves it as a snapshot (path) and empties the log
+    (path + '.wal'). Opening the same path loads the snapshot and replays the log, so every update
+    that reached an fsync survives a crash. Both files carry the checkpoint number: a log left over
+    from a checkpoint that crashed after its snapshot was written is not replayed twice.
+    The snapshot records the class of the tree, which comes back as the same class; a tree passed
+    in when opening an existing path gives its class instead.
+
+    The read methods in READS go straight to the tree. Anything else that could change it is not
+    forwarded: call it on .tree, knowing that the log will not see it.
+    """
+    MERGES = {None: None, 'extend': BPlusTree.merge_extend, 'update': BPlusTree.merge_update}
+    READS = frozenset({'order', 'retrieve', 'retrieve_many', 'cursor', 'items', 'prefix_scan', 'keys', 'values',
+                       'rank', 'select', 'count_range', 'value_count', 'value_count_range', 'stats', 'save',
+                       'getLeftmostLeaf', 'getRightmostLeaf', 'printTree', 'showAllData', 'showAllDataReverse'})
+    TREES = {tree_class.__name__: tree_class for tree_class in
+             (BPlusTree, IntBPlusTree, PrefixBPlusTree, LazyDeleteBPlusTree, ConcurrentBPlusTree)}
+
+    def __init__(self, path, tree=None, sync_every=64, sync_interval=0.01):
+        self.path = path
+        self.log = None
+        if os.path.isfile(path):
+            snapshot = BinarySnapshot.load(path)
+            tree_class = type(tree) if tree is not None else self.TREES.get(snapshot.get('class'), BPlusTree)
+            self.tree = tree_class._fromSnapshot(snapshot['tree'])
+            self.generation = snapshot['generation']
+        else:
+            self.tree = tree if tree is not None else BPlusTree()
+            self.generation = -1
+
+        log = WriteAheadLog(path + '.wal', sync_every, sync_interval)
+        records = log.records
+        if records and records[0] == ('checkpoint', self.generation, None, None):
+            for operation, key, value, merge in records[1:]:
+                self._apply(operation, key, value, merge)
+        self.log = log
+        if self.generation < 0 or not records or records[0][1] != self.generation:
+            self.checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):  # retrieve, items, keys, ... read the tree directly.
+        if name not in self.READS:
+            raise AttributeError(f"{type(self).__name__} has no attribute {name!r}: only reads are passed to the tree.")
+        return getattr(self.tree, name)
+
+    def _apply(self, operation, key, value, merge):
+        if operation == 'insert':
+            self.tree.insert(key, value)
+        elif operation == 'upsert':
+            self.tree.upsert(key, value, self.MERGES[merge])
+        elif operation == 'insert_many':
+            self.tree.insert_many(key)
+        elif operation == 'delete_value':
+            self.tree.delete_value(key, value)
+        elif operation == 'delete_many':
+            self.tree.delete_many(key)
+        elif operation == 'delete_range':
+            self.tree.delete_range(key, value)  # key and value hold lo and hi.
+        else:
+            self.tree.delete(key)
 
-    def getLeftmostLeaf(self):
-        if not self.root:
-            return None
+    def insert(self, key, value):
+        self.tree.insert(key, value)
+        self.log.append(('insert', key, value, None))
 
-        node = self.root
-        while not isinstance(node, LeafNode):
-            node = node.values[0]
+    def upsert(self, key, value, merge=None):
+        """
+        See BPlusTree.upsert. Only the merge policies in MERGES can be logged.
+        """
+        name = next((name for name, policy in self.MERGES.items() if policy is merge), _NO_KEY)
+        if name is _NO_KEY:
+            raise ValueError("Only BPlusTree.merge_extend and BPlusTree.merge_update can be logged.")
+        self.tree.upsert(key, value, merge)
+        self.log.append(('upsert', key, value, name))
+
+    def insert_many(self, pairs):
+        pairs = list(pairs)
+        self.tree.insert_many(pairs)
+        self.log.append(('insert_many', pairs, None, None))
+
+    def bulk_load(self, sorted_items, fill_factor=1.0):
+        self.tree.bulk_load(sorted_items, fill_factor)
+        self.checkpoint()
+        return self
+
+    # Deletes that find nothing to remove are not logged.
+    def delete(self, key):
+        deleted = self.tree.delete(key)
+        if deleted:
+            self.log.append(('delete', key, None, None))
+        return deleted
+
+    def delete_value(self, key, value):
+        deleted = self.tree.delete_value(key, value)
+        if deleted:
+            self.log.append(('delete_value', key, value, None))
+        return deleted
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        deleted = self.tree.delete_many(keys)
+        if deleted:
+            self.log.append(('delete_many', keys, None, None))
+        return deleted
+
+    def delete_range(self, lo=None, hi=None):
+        deleted = self.tree.delete_range(lo, hi)
+        if deleted:
+            self.log.append(('delete_range', lo, hi, None))
+        return deleted
+
+    def sync(self):
+        self.log.sync()
+
+    def checkpoint(self):
+        """
+        Saves the tree and starts an empty log, so that opening it no longer replays those updates.
+        """
+        self.log.sync()
+        self.generation += 1
+        BinarySnapshot.save(self.path, {'generation': self.generation, 'class': type(self.tree).__name__,
+                                        'tree': self.tree._snapshot()})
+        self.log.truncate()
+        self.log.append(('checkpoint', self.generation, None, None))
+        self.log.sync()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
 
-        return node
+#############################################BplustreeEnd##############################################
 
-    def getRightmostLeaf(self):
-        if not self.root:
-            return None
+#################################################MainStart#############################################
 
-        node = self.root
-        while not isinstance(node, LeafNode):
-            node = node.values[-1]
+class ReadFiles:
+    # Tokens are interned: a document id or term that appears in several files (and so in several
+    # dictionaries and trees) is then a single str object instead of one per occurrence.
+    intern_tokens = True
+    # The values of every key are staged as Postings, so C queries count them without building a set.
+    count_values = True
 
-    def showAllData(self):
-        node = self.getLeftmostLeaf()
-        if not node:
-            return None
+    @staticmethod
+    def _parse_pairs(file_name, keys):
+        """
+        Yields the (tree key, tree value) pair of every line in the file and fills the keys dictionary on the way.
+        """
+        already_inserted = set()
+        intern = sys.intern if ReadFiles.intern_tokens else str
 
-        while node:
-            for node_data in node.values:
-                print('[{}]'.format(', '.join(map(str, node_data))), end=' -> ')
+        with open(file_name, 'r', encoding = "latin1") as file:
+            for line in file:
+                # '\n' is a newline,'\t' is a tab,'\v' is a vertical tab,'\b' is a backspace,'\0' is a null character.
+                if line[0] in ['#', '%', '^', '_', '!', '@', '$', '*', ' ' , '\n', '\t', '\v', '\b', '\0']:
+                    continue
+                else:
+                    elements = line.split()
+                    if len(elements) >= 2:
+                        if ":" in line:
+                            document_id, *term = [intern(elements[0])] + [intern(element.split(':')[0]) for element in elements[1:] if ':' in element]
+
+                            if document_id in already_inserted:
+                                keys[document_id].update(term)
+                            else:
+                                already_inserted.add(document_id)
+                                keys[document_id] = term
 
-            node = node.nextLeaf
-        print('Last node')
+                            yield document_id, term
 
-    def showAllDataReverse(self):
-        node = self.getRightmostLeaf()
-        if not node:
-            return None
+                        else:
+                            key, value = intern(elements[0]), intern(elements[1])
 
-        while node:
-            for node_data in reversed(node.values):
-                print('[{}]'.format(', '.join(map(str, node_data))), end=' <- ')
+                            if key in already_inserted:
+                                keys[key].add(value)
+                            else:
+                                already_inserted.add(key)
+                                keys[key] = {value}
 
-            node = node.prevLeaf
-        print()
+                            yield value, {key}
 
     @staticmethod
-    def intersperse(lst, item):
-        result = [item] * (len(lst) * 2)
-        result[0::2] = lst
-        return result
-
-#############################################BplustreeEnd##############################################
+    def _stage_pairs(pairs):
+        """
+        Groups (tree key, tree value) pairs into {tree key: [tree values]} and tells whether the keys arrived sorted.
+        """
+        staged = {}
+        in_order = True
+        last_key = None
+        values_class = Postings if ReadFiles.count_values else list
+
+        for tree_key, tree_value in pairs:
+            if tree_key in staged:
+                staged[tree_key].append(tree_value)
+            else:
+                if last_key is not None and tree_key < last_key:
+                    in_order = False
+                last_key = tree_key
+                staged[tree_key] = values_class([tree_value])
 
-#################################################MainStart#############################################
+        return staged, in_order
 
-class ReadFiles:
+    @staticmethod
+    def _is_integer(key):
+        """
+        Checks that a key is the canonical text of a 64-bit integer, so it can be stored as one and back.
+        """
+        try:
+            number = int(key)
+        except ValueError:
+            return False
+        return str(number) == key and -2 ** 63 <= number < 2 ** 63
 
     @staticmethod
     def read_pairs_from_file(file_name, bpt_instance):
@@ -391,51 +4005,92 @@ class ReadFiles:
             print(f"An error occurred: {e}")
 
         keys = {}
-        already_inserted = set()
-        bplus_set = set()
 
         try:
-            with open(file_name, 'r', encoding = "latin1") as file:
-                for line in file:
-                    # '\n' is a newline,'\t' is a tab,'\v' is a vertical tab,'\b' is a backspace,'\0' is a null character.
-                    if line[0] in ['#', '%', '^', '_', '!', '@', '$', '*', ' ' , '\n', '\t', '\v', '\b', '\0']:
-                        continue
-                    else:
-                        elements = line.split()
-                        if len(elements) >= 2:
-                            if ":" in line:
-                                document_id, *term = [elements[0]] + [element.split(':')[0] for element in elements[1:] if ':' in element]
+            pairs = ReadFiles._parse_pairs(file_name, keys)
+
+            if bpt_instance.root.isEmpty():
+                # An empty tree is built in one pass by bulk_load, so stage its (key, values) pairs first.
+                staged, in_order = ReadFiles._stage_pairs(pairs)
+                if staged:
+                    # Input that is already sorted skips the sort entirely.
+                    bpt_instance.bulk_load(list(staged.items()) if in_order else sorted(staged.items()))
+            else:
+                values_class = Postings if ReadFiles.count_values else list
+                for tree_key, tree_value in pairs:
+                    bpt_instance.upsert(tree_key, values_class([tree_value]), BPlusTree.merge_extend)
 
-                                if document_id in already_inserted:
-                                    keys[document_id].update(term)
-                                    bpt_instance.retrieve(document_id).append(term) if document_id in bplus_set \
-                                    else bplus_set.add(document_id) or bpt_instance.insert(document_id, term)
+        except IOError:
+            print(f"Could not read file: {file_name}")
 
-                                else:
-                                    already_inserted.add(document_id)
-                                    keys[document_id] = term
-                                    bpt_instance.retrieve(document_id).append(term) if document_id in bplus_set \
-                                    else bplus_set.add(document_id) or bpt_instance.insert(document_id, term)
+        print("Files have been stored")
+        return keys
 
-                            else:
-                                key, value = elements[0], elements[1]
+    @staticmethod
+    def read_tree_from_file(file_name, order):
+        """
+        Reads pairs from a file into a new tree and returns the keys dictionary together with the tree.
+        When every tree key is an integer the tree is an IntBPlusTree, otherwise a BPlusTree.
+        """
+
+        try:
+            if not isinstance(file_name, str) or not os.path.isfile(file_name):
+                raise ValueError(f"The file {file_name} must be a valid string path.")
+        except Exception as e:
+            print(f"An error occurred: {e}")
 
-                                if key in already_inserted:
-                                    keys[key].add(value)
-                                    bpt_instance.retrieve(key).add(value) if value in bplus_set \
-                                    else bpt_instance.insert(value, {key})
+        keys = {}
+        bpt_instance = BPlusTree(order)
 
-                                else:
-                                    already_inserted.add(key)
-                                    keys[key] = {value}
-                                    bpt_instance.retrieve(value).add(key) if value in bplus_set \
-                                    else bpt_instance.insert(value, {key})
+        try:
+            staged, in_order = ReadFiles._stage_pairs(ReadFiles._parse_pairs(file_name, keys))
+
+            if staged and all(ReadFiles._is_integer(tree_key) for tree_key in staged):
+                bpt_instance = IntBPlusTree(order)
+                bpt_instance.bulk_load(sorted((int(tree_key), values) for tree_key, values in staged.items()))
+            elif staged:
+                bpt_instance.bulk_load(list(staged.items()) if in_order else sorted(staged.items()))
 
         except IOError:
             print(f"Could not read file: {file_name}")
 
         print("Files have been stored")
-        return keys
+        return keys, bpt_instance
+
+    @staticmethod
+    def read_tree_with_snapshot(file_name, order, snapshot_name=None):
+        """
+        Like read_tree_from_file, but keeps the keys dictionary and the tree in a BinarySnapshot next to
+        the file (file_name + '.snapshot' unless snapshot_name is given). The snapshot is used while the
+        size and modification time of the file match the ones it was made from, and rebuilt otherwise.
+        """
+        snapshot_name = snapshot_name or file_name + '.snapshot'
+
+        try:
+            stat = os.stat(file_name)
+            source = [os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns]
+        except OSError as e:
+            print(f"An error occurred: {e}")
+            return ReadFiles.read_tree_from_file(file_name, order)
+
+        try:
+            snapshot = BinarySnapshot.load(snapshot_name)
+            if snapshot['source'] == source and snapshot['tree']['order'] == order:
+                print("Files have been loaded from the snapshot")
+                if ReadFiles.count_values:
+                    snapshot['tree']['values'] = [Postings(values) for values in snapshot['tree']['values']]
+                return snapshot['keys'], BPlusTree._fromSnapshot(snapshot['tree'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # No snapshot yet, or one of another version: read the text file again.
+
+        keys, bpt_instance = ReadFiles.read_tree_from_file(file_name, order)
+
+        try:
+            BinarySnapshot.save(snapshot_name, {'source': source, 'keys': keys, 'tree': bpt_instance._snapshot()})
+        except OSError as e:
+            print(f"Could not write snapshot: {e}")
+
+        return keys, bpt_instance
 
 class WriteFiles:
     def __init__(self, file_name, data_to_write, type_of_file):
@@ -515,7 +4170,7 @@ class WriteFiles:
 
 
 class JaccardIndex:
-    def __init__(self, category, term, stem):
+    def __init__(self, category, term, stem, tree_order=10):
         """
         Constructs an object of the jaccard_index class
         """
@@ -523,6 +4178,7 @@ class JaccardIndex:
         self.term = term
         self.stem = stem
         self.jaccard_index = {}
+        self.category_rankings = BPlusTree(tree_order)  # Category -> [(stem, jaccard index)], best first.
 
     def calculate_jaccard_index(self):
         """
@@ -531,12 +4187,20 @@ class JaccardIndex:
         term_docs_dict = {stem_key: set(self.get_term_docs(term_value)) for stem_key, term_value in self.stem.items()}
         category_docs_dict = {category_key: set(category_docs) for category_key, category_docs in self.category.items()}
 
+        rankings = {category_key: [] for category_key in category_docs_dict}
+
         for stem_key, term_docs in term_docs_dict.items():
             self.jaccard_index[stem_key] = {}
             for category_key, category_docs_set in category_docs_dict.items():
                 intersection = len(term_docs & category_docs_set)
                 union = len(term_docs) + len(category_docs_set) - intersection
                 self.jaccard_index[stem_key][category_key] = float(intersection) / union
+                if intersection:
+                    rankings[category_key].append((stem_key, self.jaccard_index[stem_key][category_key]))
+
+        for ranking in rankings.values():
+            ranking.sort(key=lambda item: item[1], reverse=True)
+        self.category_rankings.bulk_load(sorted(rankings.items()))
         return self.jaccard_index
 
     def get_term_docs(self, term_value):
@@ -567,6 +4231,33 @@ class JaccardIndex:
 
         return top_k_stems
 
+    def get_most_relevant_stems_for_category_prefix(self, prefix, k):
+        """
+        Gets the k most relevant stems across every category that starts with prefix.
+        For a single category it answers like get_most_relevant_stems_for_category, zero scores included.
+        """
+        rankings = [ranking for _, ranking in self.category_rankings.prefix_scan(prefix)]
+
+        if not rankings:
+            print(f"No category starting with {prefix} found in jaccard_index.")
+            return []
+
+        # The rankings are already sorted, so merge them and keep the first k distinct stems
+        top_k_stems = []
+        for stem, _ in heapq.merge(*rankings, key=lambda item: item[1], reverse=True):
+            if len(top_k_stems) == k:
+                break
+            if stem not in top_k_stems:
+                top_k_stems.append(stem)
+
+        # The rankings only hold stems that share a document with the category: like '@', fill up with
+        # the stems that score zero, in the order the stems were read
+        if len(top_k_stems) < k:
+            chosen = set(top_k_stems)
+            top_k_stems.extend(islice((stem for stem in self.jaccard_index if stem not in chosen), k - len(top_k_stems)))
+
+        return top_k_stems
+
     def get_most_relevant_categories_for_stem(self, stem, k):
         """
         Gets the top k categories for the given stem
@@ -586,6 +4277,10 @@ class JaccardIndex:
 
 
 class MainConsole:
+    # Bloom filters in front of the three trees answer unknown ids in P and C without walking a tree, but nearly
+    # double the cost of every hit, and the queries are mostly hits. Off unless started with --bloom.
+    use_bloom = False
+
     @staticmethod
     def main():
         print("Welcome to our application!")
@@ -599,15 +4294,16 @@ class MainConsole:
 
 
         order_of_tree = 10
-        bpt_categories = BPlusTree(order_of_tree)
-        bpt__term = BPlusTree(order_of_tree)
-        bpt_stems = BPlusTree(order_of_tree)
 
-
-        returned_data_categories = ReadFiles.read_pairs_from_file(file_to_read_categories, bpt_categories) # Calling the method and storing the return value
-        returned_data_term = ReadFiles.read_pairs_from_file(file_to_read_term, bpt__term)
-        returned_data_stems = ReadFiles.read_pairs_from_file(file_to_read_stems, bpt_stems)
-        jaccard_instance =JaccardIndex(returned_data_categories, returned_data_term, returned_data_stems)
+        # Each tree is an IntBPlusTree when its key column (document or term ids) is numeric.
+        # Later starts read the binary snapshot saved next to each file instead of parsing the text again.
+        returned_data_categories, bpt_categories = ReadFiles.read_tree_with_snapshot(file_to_read_categories, order_of_tree) # Calling the method and storing the return value
+        returned_data_term, bpt__term = ReadFiles.read_tree_with_snapshot(file_to_read_term, order_of_tree)
+        returned_data_stems, bpt_stems = ReadFiles.read_tree_with_snapshot(file_to_read_stems, order_of_tree)
+        if MainConsole.use_bloom:
+            for bpt_instance in (bpt_categories, bpt__term, bpt_stems):
+                bpt_instance.enable_bloom()
+        jaccard_instance =JaccardIndex(returned_data_categories, returned_data_term, returned_data_stems, order_of_tree)
         jaccard_index_value = jaccard_instance.calculate_jaccard_index()
         print("Jaccard Index has been calculated")
 
@@ -631,6 +4327,15 @@ class MainConsole:
                 most_relevant_stems = jaccard_instance.get_most_relevant_stems_for_category(category, k)
                 print(f"The top {k} stems for category {category} are: {most_relevant_stems}")
                 logger.info(user_input)
+            elif operation == '%':
+                prefix = parameters[0]
+                k = int(parameters[1])
+                if k <= 0:
+                    print("Invalid value for k. Please enter a positive integer.")
+                    continue
+                most_relevant_stems = jaccard_instance.get_most_relevant_stems_for_category_prefix(prefix, k)
+                print(f"The top {k} stems for categories starting with {prefix} are: {most_relevant_stems}")
+                logger.info(user_input)
             elif operation == '#':
                     stem = parameters[0]
                     k = int(parameters[1])
@@ -678,16 +4383,15 @@ class MainConsole:
                             if result is None:
                                 print(f"Document {did} does not exist")
                                 continue
+                            sub_terms = []
                             for term in result:
                                 if isinstance(term, list): #This if statement is used to handle the case where a document has more than one term
-                                    for sub_term in term:
-                                        stem_to_print = bpt_stems.retrieve(sub_term)
-                                        if stem_to_print is not None:
-                                            stem_collection.extend(stem_to_print)
+                                    sub_terms.extend(term)
                                 else:
-                                    stem_to_print = bpt_stems.retrieve(term)
-                                    if stem_to_print is not None:
-                                        stem_collection.extend(stem_to_print)
+                                    sub_terms.append(term)
+                            for stem_to_print in bpt_stems.retrieve_many(sub_terms): # One sweep instead of a descent per term
+                                if stem_to_print is not None:
+                                    stem_collection.extend(stem_to_print)
                             print(f"The stems for document {did} are: {stem_collection}")
                             logger.info(user_input)
             elif operation == 'C':
@@ -699,22 +4403,19 @@ class MainConsole:
                         continue
                     else:
                         if option == '-c':
-                            #Remove dupliates by using set
-                            stem_collection = set()
-                            result = bpt__term.retrieve(did)
-                            if result is None:
+                            # Unique terms are counted as the tree stores them (see Postings).
+                            term_count = bpt__term.value_count(did)
+                            if term_count is None:
                                 print(f"Document {did} does not exist")
                                 continue
-                            for stem in result:
-                                stem_collection.update(stem)
-                            print(f"The count of unique terms for document {did} is: {len(stem_collection)}")
+                            print(f"The count of unique terms for document {did} is: {term_count}")
                             logger.info(user_input)
                         else:
-                            categories_set = bpt_categories.retrieve(did)
-                            if categories_set is None:
+                            category_count = bpt_categories.value_count(did)
+                            if category_count is None:
                                 print(f"Document {did} does not exist")
                                 continue
-                            print(f"The count of categories for document {did} is: {len(categories_set)}")
+                            print(f"The count of categories for document {did} is: {category_count}")
                             logger.info(user_input)
             elif operation == 'Q': # Exit the program.Not available to the user but its a nice feature to have
                     print("So you found my little secret....Terminating the program....")
@@ -735,6 +4436,7 @@ class MainConsole:
 
         print("Enter the operation you want to perform:")
         print("@ <category> <k> : Retrieve and display the <k> most relevant stems (based on Jaccard Index) for a specific category.")
+        print("% <prefix> <k> : Retrieve and display the <k> most relevant stems across all categories starting with <prefix>.")
         print("# <stem> <k> : Display the <k> most relevant categories (based on Jaccard Index) for a specific stem.")
         print("$ <stem> <category>: Provides the Jaccard Index for a given pair (stem, category).")
         print("* <filename>.<filetype> : Saves all (category, stem) pairs along with their Jaccard Index in a format (stem category Jaccard_Index) to the specified file.")
@@ -744,6 +4446,7 @@ class MainConsole:
         print("C <did> -t : Calculate and display the count of categories assigned to the document with the code id")
 
 if __name__ == "__main__":
+    MainConsole.use_bloom = "--bloom" in sys.argv[1:]
     MainConsole.main()
 
 #################################################MainEnd#############################################
\ No newline at end of file
@@ -1,10 +1,18 @@
 import sys
 import os
 import unittest
+import random
+import shutil
+import tempfile
+import threading
+import time
 import json
+import contextlib
+import io
 from openpyxl import load_workbook
 from mock import patch
-from Project import ReadFiles, WriteFiles, JaccardIndex, BPlusTree
+import Benchmark_Phase
+from Final_Code import ReadFiles, WriteFiles, JaccardIndex, BloomFilter, BPlusTree, IntBPlusTree, ConcurrentBPlusTree, CopyOnWriteBPlusTree, DiskBPlusTree, DurableBPlusTree, LazyDeleteBPlusTree, PageCodec, PageFile, PrefixBPlusTree, PrefixKeys, Postings, LeafNode
 
 
 class TestReadFile(unittest.TestCase):
@@ -44,6 +52,50 @@ class TestReadFile(unittest.TestCase):
         result = ReadFiles.read_pairs_from_file(file_to_read_categories_name, self.bpt_instance)
         self.assertEqual(result, expected_result)
 
+    def test_intern_tokens(self):
+        small_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SmallTestFiles")
+        returned_data_term, bpt__term = ReadFiles.read_tree_from_file(os.path.join(small_files, "docID_term.txt"), 10)
+        returned_data_stems, bpt_stems = ReadFiles.read_tree_from_file(os.path.join(small_files, "stem_term.txt"), 10)
+
+        # Test case 1: A term read from both files is one str object
+        term = returned_data_term["1"][0]
+        self.assertEqual(term, "term1")
+        self.assertIs(next(iter(returned_data_stems["stem1"])), term)
+        self.assertIs(next(bpt_stems.keys("term1")), term)  # The stems tree is keyed by term.
+
+        # Test case 2: Without interning every file has its own copy
+        ReadFiles.intern_tokens = False
+        self.addCleanup(setattr, ReadFiles, "intern_tokens", True)
+        returned_data_stems, bpt_stems = ReadFiles.read_tree_from_file(os.path.join(small_files, "stem_term.txt"), 10)
+        self.assertIsNot(next(iter(returned_data_stems["stem1"])), term)
+
+    def test_value_counts(self):
+        small_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SmallTestFiles")
+        returned_data_categories, bpt_categories = ReadFiles.read_tree_from_file(os.path.join(small_files, "category_docId.txt"), 10)
+        returned_data_term, bpt__term = ReadFiles.read_tree_from_file(os.path.join(small_files, "docID_term.txt"), 10)
+
+        # Test case 1: Distinct values per document and over a range of documents
+        self.assertEqual(bpt_categories.value_count("1"), 3)
+        self.assertEqual(bpt_categories.value_count("10"), None)
+        self.assertEqual(bpt_categories.value_count_range("1", "5"), 6)
+        self.assertEqual(bpt__term.value_count("1"), 4)
+
+        # Test case 2: The stored Postings count as they change
+        postings = bpt__term.retrieve("1")
+        self.assertIsInstance(postings, Postings)
+        postings.append(["term1", "term99"])
+        self.assertEqual(bpt__term.value_count("1"), 5)
+        postings.pop()
+        self.assertEqual(postings.distinct(), 4)
+        self.assertEqual(Postings(["a", "a", "b"]).count("a"), 2)  # Still list.count.
+        self.assertEqual(Postings.count_distinct([["a", "b"], "b"]), 2)
+
+        # Test case 3: Plain lists are counted too
+        ReadFiles.count_values = False
+        self.addCleanup(setattr, ReadFiles, "count_values", True)
+        returned_data_categories, bpt_categories = ReadFiles.read_tree_from_file(os.path.join(small_files, "category_docId.txt"), 10)
+        self.assertNotIsInstance(bpt_categories.retrieve("1"), Postings)
+        self.assertEqual(bpt_categories.value_count("1"), 3)
 
 
 class TestJaccardIndex(unittest.TestCase):
@@ -127,6 +179,23 @@ class TestJaccardIndex(unittest.TestCase):
         expected_result = []
         self.assertEqual(result, expected_result)
 
+    def test_get_most_relevant_stems_for_category_prefix(self):
+        jaccard_instance = JaccardIndex({'Category_A': ['1', '2'], 'Category_B': ['3']},
+                                        {'1': ['10', '11'], '2': ['11'], '3': ['12'], '4': ['13']},
+                                        {'stem1': ['10'], 'stem2': ['11'], 'stem3': ['12'], 'stem4': ['13']})
+        jaccard_instance.calculate_jaccard_index()
+
+        # Test case 1: For one category '%' and '@' agree, also past the stems that score above zero
+        for category in ('Category_A', 'Category_B'):
+            for k in (1, 2, 3, 10):
+                self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix(category, k),
+                                 jaccard_instance.get_most_relevant_stems_for_category(category, k))
+        self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix('Category_B', 3), ['stem3', 'stem1', 'stem2'])
+
+        # Test case 2: Several categories merge their rankings, each stem once
+        self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix('Category_', 4), ['stem2', 'stem3', 'stem1', 'stem4'])
+        self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix('Category_X', 4), [])
+
     def test_get_most_relevant_categories_for_stem(self):
         # Test case 1: Existing category value
         self.jaccard_instance.calculate_jaccard_index()
@@ -233,5 +302,745 @@ class TestWriteFiles(unittest.TestCase):
         self.assertFalse(expected_result)
 
 
+class TestBPlusTree(unittest.TestCase):
+
+    def setUp(self):
+        print("setUp was called before the unit test")
+        self.pairs = [(str(doc_id), [f"Category_{doc_id % 7}"]) for doc_id in range(1000)]
+
+    def tearDown(self):
+        print("tearDown was called after the unit test")
+
+    def leaves(self, bpt_instance):
+        node = bpt_instance.getLeftmostLeaf()
+        while node:
+            yield node
+            node = node.nextLeaf
+
+    def test_bulk_load(self):
+        # Test case 1: Every key can be retrieved and the leaf chain is sorted
+        bpt_instance = BPlusTree(10).bulk_load(sorted(self.pairs))
+        for key, values in self.pairs:
+            self.assertEqual(bpt_instance.retrieve(key), values)
+        chained_keys = [key for leaf in self.leaves(bpt_instance) for key in leaf.keys]
+        self.assertEqual(chained_keys, sorted(key for key, _ in self.pairs))
+
+        # Test case 2: Packed leaves by default, and the tree keeps working after more inserts and deletes
+        self.assertTrue(all(len(leaf.keys) >= 8 for leaf in self.leaves(bpt_instance)))
+        bpt_instance.insert("5000", "Category_X")
+        self.assertEqual(bpt_instance.retrieve("5000"), ["Category_X"])
+        for key, _ in self.pairs[:500]:
+            bpt_instance.delete(key)
+        self.assertIsNone(bpt_instance.retrieve("10"))
+        self.assertEqual(bpt_instance.retrieve("999"), ["Category_5"])
+
+        # Test case 3: Unsorted input is rejected
+        with self.assertRaises(ValueError):
+            BPlusTree(10).bulk_load([("b", [1]), ("a", [2])])
+
+    def test_large_order(self):
+        # Test case 1: Wide nodes keep every key reachable through insert, retrieve and delete
+        keys = [key for key, _ in self.pairs]
+        random.Random(7).shuffle(keys)
+        for order in (4, 128, 1024):
+            bpt_instance = BPlusTree(order)
+            for key in keys:
+                bpt_instance.insert(key, key)
+            self.assertEqual([key for leaf in self.leaves(bpt_instance) for key in leaf.keys], sorted(keys))
+            self.assertTrue(all(bpt_instance.retrieve(key) == [key] for key in keys))
+
+            # Test case 2: Deleted keys disappear while the rest stay in place
+            for key in keys[:700]:
+                self.assertIsNot(bpt_instance.delete(key), False)
+            self.assertTrue(all(bpt_instance.retrieve(key) is None for key in keys[:700]))
+            self.assertTrue(all(bpt_instance.retrieve(key) == [key] for key in keys[700:]))
+
+    def test_items(self):
+        bpt_instance = BPlusTree(5)
+        for doc_id in range(0, 200, 2):
+            bpt_instance.insert(doc_id, f"Category_{doc_id}")
+
+        # Test case 1: Full scans in both directions
+        self.assertEqual(list(bpt_instance.keys()), list(range(0, 200, 2)))
+        self.assertEqual(list(bpt_instance.keys(reverse=True)), list(range(198, -1, -2)))
+
+        # Test case 2: Half-open ranges whose bounds are not stored keys
+        self.assertEqual(list(bpt_instance.items(51, 57)), [(52, ["Category_52"]), (54, ["Category_54"]), (56, ["Category_56"])])
+        self.assertEqual(list(bpt_instance.keys(51, 57, reverse=True)), [56, 54, 52])
+        self.assertEqual(list(bpt_instance.values(196)), [["Category_196"], ["Category_198"]])
+
+        # Test case 3: Empty ranges
+        self.assertEqual(list(bpt_instance.keys(300)), [])
+        self.assertEqual(list(bpt_instance.keys(stop=0, reverse=True)), [])
+        self.assertEqual(list(BPlusTree(5).items()), [])
+
+    def test_prefix_scan(self):
+        bpt_instance = BPlusTree(4)
+        for stem in ["econ", "econom", "economi", "ecolog", "edit", "eco", "econs", "e"]:
+            bpt_instance.insert(stem, stem.upper())
+
+        # Test case 1: Only the keys that start with the prefix, in order
+        self.assertEqual([key for key, _ in bpt_instance.prefix_scan("econ")], ["econ", "econom", "economi", "econs"])
+        self.assertEqual(list(bpt_instance.prefix_scan("econ", limit=2)), [("econ", ["ECON"]), ("econom", ["ECONOM"])])
+        self.assertEqual(list(bpt_instance.prefix_scan("x")), [])
+
+        # Test case 2: Top k stems across every category under a prefix
+        categories = {"E11": {"1", "2"}, "E12": {"3"}, "G15": {"1", "3"}}
+        terms = {"1": ["t1"], "2": ["t1", "t2"], "3": ["t3"]}
+        stems = {"stem1": {"t1"}, "stem2": {"t2"}, "stem3": {"t3"}}
+        jaccard_instance = JaccardIndex(categories, terms, stems)
+        jaccard_instance.calculate_jaccard_index()
+        self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix("E1", 2), ["stem1", "stem3"])
+        self.assertEqual(jaccard_instance.get_most_relevant_stems_for_category_prefix("Z", 2), [])
+
+    def test_retrieve_many(self):
+        bpt_instance = BPlusTree(4).bulk_load(sorted(self.pairs))
+
+        # Test case 1: Results follow the probe order, with None for missing keys and repeated keys answered twice
+        probes = ["999", "12", "missing", "0", "12", "5000"]
+        expected_result = [bpt_instance.retrieve(key) for key in probes]
+        self.assertEqual(bpt_instance.retrieve_many(probes), expected_result)
+        self.assertEqual(expected_result[2], None)
+
+        # Test case 2: Every stored key in random order
+        keys = [key for key, _ in self.pairs]
+        random.Random(3).shuffle(keys)
+        self.assertEqual(bpt_instance.retrieve_many(keys), [bpt_instance.retrieve(key) for key in keys])
+        self.assertEqual(BPlusTree(4).retrieve_many(["1", "2"]), [None, None])
+
+    def test_insert_many(self):
+        # Test case 1: A batch gives the same tree content as inserting its pairs one by one
+        batch = [(str(doc_id % 300), f"Category_{doc_id}") for doc_id in range(900)]
+        random.Random(5).shuffle(batch)
+        expected_instance = BPlusTree(6)
+        for key, value in self.pairs[:200] + batch:
+            expected_instance.insert(key, value)
+
+        bpt_instance = BPlusTree(6)
+        bpt_instance.insert_many(self.pairs[:200])
+        bpt_instance.insert_many(batch)
+        self.assertEqual(list(bpt_instance.items()), list(expected_instance.items()))
+        self.assertEqual(list(bpt_instance.keys(reverse=True)), list(expected_instance.keys(reverse=True)))
+
+        # Test case 2: No node is left over capacity after a large batch
+        nodes = [bpt_instance.root]
+        while nodes:
+            node = nodes.pop()
+            self.assertLess(len(node.keys), 6)
+            if not isinstance(node, LeafNode):
+                nodes.extend(node.values)
+
+    def test_upsert(self):
+        bpt_instance = BPlusTree(4)
+
+        # Test case 1: New keys store the value as given, existing keys merge into it
+        for doc_id in range(50):
+            bpt_instance.upsert(str(doc_id % 10), {f"Category_{doc_id}"}, BPlusTree.merge_update)
+        self.assertEqual(bpt_instance.retrieve("3"), {f"Category_{doc_id}" for doc_id in range(3, 50, 10)})
+        self.assertEqual(list(bpt_instance.keys()), [str(doc_id) for doc_id in range(10)])
+
+        # Test case 2: List extension and plain replacement
+        bpt_instance.upsert("terms", ["term1"], BPlusTree.merge_extend)
+        bpt_instance.upsert("terms", ["term2", "term3"], BPlusTree.merge_extend)
+        self.assertEqual(bpt_instance.retrieve("terms"), ["term1", "term2", "term3"])
+        bpt_instance.upsert("terms", ["term4"])
+        self.assertEqual(bpt_instance.retrieve("terms"), ["term4"])
+
+    def test_sequential_insert(self):
+        # Test case 1: In-order document ids fill the leaves almost completely
+        bpt_instance = BPlusTree(10)
+        for doc_id in range(1000):
+            bpt_instance.insert(doc_id, f"Category_{doc_id % 7}")
+        leaves = list(self.leaves(bpt_instance))
+        self.assertEqual(sum(len(leaf.keys) for leaf in leaves[:-1]), 9 * (len(leaves) - 1))
+        self.assertEqual([key for leaf in leaves for key in leaf.keys], list(range(1000)))
+
+        # Test case 2: Out-of-order keys still land in the right place afterwards
+        bpt_instance.insert(500, "Category_X")
+        bpt_instance.insert(-1, "Category_Y")
+        self.assertEqual(bpt_instance.retrieve(500), ["Category_3", "Category_X"])
+        self.assertEqual(list(bpt_instance.keys(stop=2)), [-1, 0, 1])
+
+    def test_integer_keys(self):
+        # Test case 1: Numeric order instead of text order, with the leaf keys packed in arrays
+        bpt_instance = IntBPlusTree(4)
+        for doc_id in ["9", "10", "2", "100", "11"]:
+            bpt_instance.insert(doc_id, f"Category_{doc_id}")
+        self.assertEqual(list(bpt_instance.keys()), [2, 9, 10, 11, 100])
+        self.assertEqual(list(bpt_instance.keys("9", "12")), [9, 10, 11])
+        self.assertTrue(all(leaf.keys.typecode == 'q' for leaf in self.leaves(bpt_instance)))
+
+        # Test case 2: Same retrieve/delete API, with text keys converted and non-numbers not found
+        self.assertEqual(bpt_instance.retrieve("10"), ["Category_10"])
+        self.assertEqual(bpt_instance.retrieve("Category_A"), None)
+        self.assertEqual(bpt_instance.retrieve_many(["100", "x", 2]), [["Category_100"], None, ["Category_2"]])
+        bpt_instance.delete("10")
+        self.assertEqual(bpt_instance.retrieve(10), None)
+        self.assertEqual(bpt_instance.delete("x"), False)
+
+        # Test case 3: The loader picks the tree from the key column
+        small_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SmallTestFiles")
+        _, bpt_categories = ReadFiles.read_tree_from_file(os.path.join(small_files, "category_docId.txt"), 10)
+        returned_data_stems, bpt_stems = ReadFiles.read_tree_from_file(os.path.join(small_files, "stem_term.txt"), 10)
+        self.assertIsInstance(bpt_categories, IntBPlusTree)
+        self.assertEqual(list(bpt_categories.keys()), list(range(1, 10)))
+        self.assertNotIsInstance(bpt_stems, IntBPlusTree)
+        self.assertEqual(bpt_stems.retrieve("term1"), [{"stem1"}])
+        self.assertEqual(returned_data_stems["stem1"], {"term1"})
+
+    def test_disk_tree(self):
+        path = os.path.join(tempfile.mkdtemp(), "categories.bpt")
+        self.addCleanup(os.remove, path)
+
+        # Test case 1: Same insert/retrieve/delete behaviour as the in-memory tree
+        with DiskBPlusTree(path, 5, 512) as bpt_instance:
+            bpt_instance.bulk_load(sorted(self.pairs))
+            bpt_instance.insert("500", "Category_X")
+            bpt_instance.insert("abc", "Category_Y" * 100)  # Longer than a quarter page: stored in overflow pages
+            self.assertEqual(bpt_instance.retrieve("500"), ["Category_3", "Category_X"])
+            self.assertEqual(bpt_instance.retrieve("abc"), ["Category_Y" * 100])
+            self.assertEqual(bpt_instance.retrieve("1000"), None)
+
+            for key in [str(doc_id) for doc_id in range(0, 1000, 2)]:
+                bpt_instance.delete(key)
+            self.assertEqual(bpt_instance.delete("0"), False)
+            self.assertEqual(bpt_instance.retrieve("500"), ["Category_3"])
+
+        # Test case 2: Reopening the file gives back the same tree and order
+        expected = sorted([(key, values) for key, values in self.pairs if int(key) % 2] + [("500", ["Category_3"])])
+        with DiskBPlusTree(path) as bpt_instance:
+            self.assertEqual(bpt_instance.order, 5)
+            self.assertEqual(list(bpt_instance.items(stop="abc")), expected)
+            self.assertEqual(list(bpt_instance.keys(reverse=True))[:2], ["abc", "999"])
+            root, page_size = bpt_instance.pages.root, bpt_instance.pages.page_size
+
+        # Test case 3: Pages are decoded, not unpickled: a damaged page is an error, never code to run
+        value = [{"Category_0"}, ("a", 1), {"k": [2 ** 70, 1.5, None, True, b"x"]}, frozenset({"b"}), ["a\0b", "c"]]
+        self.assertEqual(PageCodec.decode(PageCodec.encode(value)), value)
+        with open(path, "r+b") as file:
+            file.seek(root * page_size + PageFile.PAGE.size)
+            file.write(bytes([255]))
+        with DiskBPlusTree(path) as bpt_instance:
+            self.assertRaises(ValueError, bpt_instance.retrieve, "500")
+
+        # Test case 4: bulk_load leaves no page but the root under the minimum, also just past a full page
+        for size in (5, 9, 21, 101, 126):
+            os.remove(path)
+            with DiskBPlusTree(path, 5, 512) as bpt_instance:
+                pairs = [(f"{key:03}", ["Category_0"]) for key in range(size)]
+                bpt_instance.bulk_load(pairs)
+                level = [bpt_instance._load(bpt_instance.pages.root)]
+                while not level[0].leaf:
+                    level = [bpt_instance._load(page) for node in level for page in node.values]
+                    self.assertTrue(all(len(node.keys) >= 2 for node in level), size)
+                self.assertEqual([node.nextLeaf for node in level], [node.page for node in level[1:]] + [-1])
+                self.assertEqual(list(bpt_instance.items()), pairs)
+
+    def test_buffer_pool(self):
+        path = os.path.join(tempfile.mkdtemp(), "categories.bpt")
+        self.addCleanup(os.remove, path)
+
+        # Test case 1: The pool stays within its capacity and dirty pages are written back on eviction
+        with DiskBPlusTree(path, 5, 512, cache_pages=8) as bpt_instance:
+            for key, values in self.pairs:
+                bpt_instance.insert(key, values[0])
+            self.assertLessEqual(len(bpt_instance.pool.frames), 8)
+            self.assertGreater(bpt_instance.pool.writes, 0)
+
+            # Test case 2: Repeated lookups of one key are served from the pool
+            bpt_instance.retrieve("7")
+            bpt_instance.pool.reset_counters()
+            for _ in range(10):
+                self.assertEqual(bpt_instance.retrieve("7"), ["Category_0"])
+            self.assertEqual(bpt_instance.pool.misses, 0)
+            self.assertGreater(bpt_instance.pool.hits, 0)
+
+        # Test case 3: A capacity in bytes; the file holds every page written before closing
+        with DiskBPlusTree(path, cache_pages=None, cache_bytes=1024) as bpt_instance:
+            self.assertEqual(list(bpt_instance.items()), sorted(self.pairs))
+            self.assertLessEqual(bpt_instance.pool.bytes, 1024)
+
+    def test_snapshot(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # Test case 1: save/load round trip, keeping the order and the integer keys
+        bpt_instance = IntBPlusTree(4)
+        for key, values in self.pairs:
+            bpt_instance.insert(key, set(values))
+        bpt_instance.save(os.path.join(directory, "tree.snapshot"))
+        loaded = BPlusTree.load(os.path.join(directory, "tree.snapshot"))
+        self.assertIsInstance(loaded, IntBPlusTree)
+        self.assertEqual(loaded.order, 4)
+        self.assertEqual(list(loaded.items()), list(bpt_instance.items()))
+
+        # Test case 2: The snapshot of a data file is used until the file changes
+        small_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SmallTestFiles")
+        file_name = shutil.copy(os.path.join(small_files, "docID_term.txt"), directory)
+        expected_keys, expected_tree = ReadFiles.read_tree_from_file(file_name, 10)
+        ReadFiles.read_tree_with_snapshot(file_name, 10)
+        self.assertTrue(os.path.exists(file_name + ".snapshot"))
+
+        with patch("Final_Code.ReadFiles.read_tree_from_file") as read_tree_from_file:
+            returned_data_term, bpt__term = ReadFiles.read_tree_with_snapshot(file_name, 10)
+            read_tree_from_file.assert_not_called()
+        self.assertEqual(returned_data_term, expected_keys)
+        self.assertEqual(list(bpt__term.items()), list(expected_tree.items()))
+        document_id = next(bpt__term.keys())
+        self.assertIs(bpt__term.retrieve(document_id)[0], returned_data_term[str(document_id)])  # Still shared
+
+        with open(file_name, "a") as file:
+            file.write("\n99 term99:1.0\n")
+        returned_data_term, bpt__term = ReadFiles.read_tree_with_snapshot(file_name, 10)
+        self.assertEqual(bpt__term.retrieve("99"), [["term99"]])
+
+    def test_write_ahead_log(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "tree.snapshot")
+
+        # Test case 1: Updates since the last checkpoint are replayed when the tree is opened again
+        durable_tree = DurableBPlusTree(path, BPlusTree(4), sync_every=1000, sync_interval=None)
+        for key, values in self.pairs[:100]:
+            durable_tree.insert(key, values)
+        durable_tree.checkpoint()
+        for key, values in self.pairs[100:200]:
+            durable_tree.insert(key, values)
+        durable_tree.delete("5")
+        durable_tree.upsert("7", ["Category_1"], BPlusTree.merge_extend)
+        durable_tree.sync()
+        expected = list(durable_tree.items())
+        durable_tree.log.file.close()  # Crash: nothing else is written.
+
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(list(durable_tree.items()), expected)
+            self.assertEqual(durable_tree.order, 4)
+
+        # Test case 2: A torn record at the end of the log is dropped
+        with open(path + ".wal", "ab") as file:
+            file.write(b"\x20\x00\x00\x00torn")
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(list(durable_tree.items()), expected)
+            durable_tree.insert("1000", ["Category_0"])
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(durable_tree.retrieve("1000"), [["Category_0"]])
+
+            # Test case 3: A checkpoint empties the log, also if it stops before truncating it
+            durable_tree.checkpoint()
+            log_size = os.path.getsize(path + ".wal")
+            durable_tree.insert("1001", ["Category_0"])
+            durable_tree.sync()
+            with patch.object(durable_tree.log, "truncate"):
+                durable_tree.checkpoint()
+        self.assertGreater(os.path.getsize(path + ".wal"), log_size)
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(durable_tree.retrieve("1001"), [["Category_0"]])
+            self.assertEqual(os.path.getsize(path + ".wal"), log_size)
+
+        with self.assertRaises(ValueError):
+            durable_tree.upsert("1", ["Category_0"], lambda current, value: value)
+
+        # Test case 4: insert_many and bulk_load reach the log too; updates that raise and other mutators do not
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            durable_tree.insert_many([("1002", ["Category_2"]), ("1003", ["Category_3"])])
+            with self.assertRaises(TypeError):
+                durable_tree.insert(1004, ["Category_4"])
+            with self.assertRaises(AttributeError):
+                durable_tree.enable_ranks()
+            self.assertFalse(durable_tree.delete("1004"))
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(durable_tree.retrieve("1003"), [["Category_3"]])
+            durable_tree.bulk_load([("0", ["Category_0"])])
+            durable_tree.log.file.close()  # Crash right after bulk_load.
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(list(durable_tree.items()), [("0", ["Category_0"])])
+
+        # Test case 5: The tree comes back as the class it was saved from
+        prefix_path = os.path.join(directory, "prefix.snapshot")
+        with DurableBPlusTree(prefix_path, PrefixBPlusTree(4), sync_interval=None) as durable_tree:
+            durable_tree.insert("category", "1")
+        with DurableBPlusTree(prefix_path, sync_interval=None) as durable_tree:
+            self.assertIsInstance(durable_tree.tree, PrefixBPlusTree)
+            self.assertEqual(durable_tree.retrieve("category"), ["1"])
+
+    def test_prefix_keys(self):
+        stems = [f"categor{suffix}" for suffix in ("i", "ies", "y", "ize", "ized", "izes", "izing")] + ["cat", "catalog", "dog"]
+
+        # Test case 1: PrefixKeys behaves like the sorted list of keys it stores
+        prefix_keys = PrefixKeys(sorted(stems[:7]))
+        self.assertEqual(prefix_keys.prefix, "categor")
+        self.assertEqual(list(prefix_keys), sorted(stems[:7]))
+        self.assertEqual(prefix_keys.search("categorize"), (2, True))
+        self.assertEqual(prefix_keys.search("categorz"), (7, False))
+        prefix_keys.insert(0, "cat")
+        self.assertEqual(prefix_keys.prefix, "cat")
+        self.assertEqual(prefix_keys.pop(1), "categori")
+        self.assertEqual(prefix_keys[1:3].prefix, "categori")
+        self.assertEqual(list(prefix_keys + ["dog"]), ["cat"] + sorted(stems[:7])[1:] + ["dog"])
+
+        # Test case 2: A PrefixBPlusTree holds the same data as a BPlusTree
+        bpt_instance = BPlusTree(4)
+        prefix_tree = PrefixBPlusTree(4)
+        for doc_id, stem in enumerate(stems * 3):
+            bpt_instance.insert(stem, doc_id)
+            prefix_tree.insert(stem, doc_id)
+        for stem in stems[::2] * 3:
+            bpt_instance.delete(stem)
+            prefix_tree.delete(stem)
+        self.assertEqual(list(prefix_tree.items()), list(bpt_instance.items()))
+        self.assertEqual(prefix_tree.retrieve("categories"), [1, 11, 21])
+        self.assertIsNone(prefix_tree.retrieve("categor"))
+        self.assertEqual(list(prefix_tree.keys(start="categorize", stop="d")), ["categorize", "categorizes"])
+
+    def test_bloom_filter(self):
+        # Test case 1: No false negatives, and about fp_rate false positives
+        bloom = BloomFilter(1000, 0.01)
+        for key, values in self.pairs:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key, values in self.pairs))
+        false_positives = sum(str(doc_id) in bloom for doc_id in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+        # Test case 2: Missing keys are answered by the filter and new keys are added to it
+        bpt_instance = BPlusTree(4).bulk_load(sorted((key, values) for key, values in self.pairs[:500])).enable_bloom()
+        self.assertIsNone(bpt_instance.retrieve("1500"))
+        self.assertEqual(bpt_instance.retrieve_many(["1", "1501", "1502"]), [["Category_1"], None, None])
+        self.assertEqual(bpt_instance.bloom.avoided + bpt_instance.bloom.false_positives, 3)
+        for key, values in self.pairs[500:]:
+            bpt_instance.insert(key, values[0])
+        self.assertGreaterEqual(bpt_instance.bloom.capacity, 1000)  # Rebuilt for the new keys.
+        self.assertEqual(bpt_instance.retrieve("999"), ["Category_5"])
+
+        # Test case 3: bulk_load rebuilds the filter for the new keys
+        bpt_instance.bulk_load([("a", ["Category_0"])])
+        self.assertNotIn("999", bpt_instance.bloom)
+        self.assertEqual(bpt_instance.retrieve("a"), ["Category_0"])
+
+        with self.assertRaises(ValueError):
+            ConcurrentBPlusTree(4).enable_bloom()
+
+    def test_stats_and_counters(self):
+        # Test case 1: stats() describes the shape of a packed tree
+        bpt_instance = BPlusTree(4).bulk_load(sorted(self.pairs))
+        stats = bpt_instance.stats()
+        self.assertEqual(stats["keys"], 1000)
+        self.assertEqual(stats["leaves"], len(list(self.leaves(bpt_instance))))
+        self.assertEqual(stats["height"], len(stats["levels"]))
+        self.assertEqual(stats["levels"][0]["nodes"], 1)
+        self.assertGreater(stats["levels"][-1]["fill"], 0.99)
+        self.assertEqual(stats["nodes"], sum(level["nodes"] for level in stats["levels"]))
+        self.assertGreater(stats["bytes"], 0)
+
+        # Test case 2: Counters per operation
+        counters = bpt_instance.enable_counters()
+        bpt_instance.retrieve("1")
+        self.assertEqual(counters.counts["retrieve"]["visits"], stats["height"])
+        bpt_instance.insert("1000", "Category_0")  # Every leaf is full.
+        self.assertGreaterEqual(counters.counts["insert"]["splits"], 1)
+        for key, values in self.pairs[:300]:
+            bpt_instance.delete(key)
+        self.assertGreater(counters.counts["delete"]["merges"] + counters.counts["delete"]["borrows"], 0)
+        self.assertLessEqual(counters.per_call()["delete"]["visits"], bpt_instance.stats()["height"])
+        counters.reset_counters()
+        self.assertEqual(counters.counts, {})
+
+    def test_cursor(self):
+        bpt_instance = BPlusTree(4).bulk_load(sorted((key, list(values)) for key, values in self.pairs))
+        keys = sorted(key for key, values in self.pairs)
+
+        # Test case 1: Paging forwards from a seek, and back again
+        cursor = bpt_instance.cursor()
+        self.assertEqual(cursor.seek("500"), ("500", ["Category_3"]))
+        start = keys.index("500")
+        page = [cursor.current()] + [cursor.next() for _ in range(99)]
+        self.assertEqual([key for key, values in page], keys[start:start + 100])
+        self.assertEqual(cursor.skip(-99), ("500", ["Category_3"]))
+        self.assertEqual(cursor.prev()[0], keys[start - 1])
+        self.assertEqual(cursor.skip(250)[0], keys[start + 249])
+
+        # Test case 2: Off either end, and back onto the tree
+        self.assertEqual(bpt_instance.cursor("9999a").current(), None)
+        cursor = bpt_instance.cursor()
+        self.assertEqual(cursor.prev(), None)
+        self.assertEqual(cursor.next()[0], keys[0])
+        self.assertEqual(cursor.skip(2000), None)
+        self.assertEqual(cursor.prev()[0], keys[-1])
+
+        # Test case 3: The cursor follows its key through writes
+        cursor = bpt_instance.cursor("500")
+        for key in keys[:400]:
+            bpt_instance.delete(key)
+        self.assertEqual(cursor.current()[0], "500")
+        bpt_instance.delete("500")
+        self.assertEqual(cursor.current()[0], keys[start + 1])
+
+        # Test case 4: Integer keys
+        int_instance = IntBPlusTree(4).bulk_load(sorted((int(key), values) for key, values in self.pairs))
+        self.assertEqual(int_instance.cursor("10").skip(5), (15, ["Category_1"]))
+
+    def test_ranks(self):
+        bpt_instance = BPlusTree(4).enable_ranks()
+        for key, values in self.pairs:
+            bpt_instance.insert(key, values[0])
+        keys = sorted(key for key, values in self.pairs)
+
+        # Test case 1: rank, select and count_range agree with the sorted keys
+        self.assertEqual(bpt_instance.rank("500"), keys.index("500"))
+        self.assertEqual(bpt_instance.rank("500a"), keys.index("500") + 1)
+        self.assertEqual(bpt_instance.select(0), ("0", ["Category_0"]))
+        self.assertEqual(bpt_instance.select(-1)[0], keys[-1])
+        self.assertEqual(bpt_instance.select(500)[0], keys[500])
+        self.assertEqual(bpt_instance.count_range("2", "3"), len([key for key in keys if "2" <= key < "3"]))
+        self.assertEqual(bpt_instance.count_range(), 1000)
+        with self.assertRaises(IndexError):
+            bpt_instance.select(1000)
+
+        # Test case 2: The counts follow deletes through merges and borrows
+        for key in keys[::3]:
+            bpt_instance.delete(key)
+        keys = [key for i, key in enumerate(keys) if i % 3]
+        self.assertEqual(bpt_instance.count_range(), len(keys))
+        self.assertEqual([bpt_instance.select(i)[0] for i in range(0, len(keys), 50)], keys[::50])
+        self.assertEqual(bpt_instance.rank(keys[400]), 400)
+
+        # Test case 3: Trees without counts refuse, until enable_ranks() swaps their inner nodes for counted ones
+        plain_instance = BPlusTree(4).bulk_load(sorted(self.pairs))
+        self.assertFalse(hasattr(plain_instance.root, "count"))
+        with self.assertRaises(ValueError):
+            plain_instance.rank("500")
+        self.assertEqual(plain_instance.enable_ranks().count_range("1", "2"), 111)
+        self.assertTrue(all(hasattr(leaf.parent, "count") for leaf in self.leaves(plain_instance)))
+        plain_instance.insert("1000", "Category_0")
+        self.assertEqual(plain_instance.count_range("1", "2"), 112)
+
+    def test_batch_deletes(self):
+        bpt_instance = BPlusTree(4).bulk_load(sorted((key, list(values)) for key, values in self.pairs))
+        keys = sorted(key for key, values in self.pairs)
+
+        # Test case 1: One value out of several
+        bpt_instance.insert("10", "Category_5")
+        self.assertTrue(bpt_instance.delete_value("10", "Category_3"))
+        self.assertEqual(bpt_instance.retrieve("10"), ["Category_5"])
+        self.assertFalse(bpt_instance.delete_value("10", "Category_3"))
+        self.assertTrue(bpt_instance.delete_value("10", "Category_5"))
+        self.assertEqual(bpt_instance.retrieve("10"), None)
+        keys.remove("10")
+
+        # Test case 2: A range goes with a few merges, not one rebalance per key
+        counters = bpt_instance.enable_counters()
+        self.assertEqual(bpt_instance.delete_range("2", "5"), 333)
+        self.assertLess(counters.counts["delete_range"]["merges"], 20)
+        keys = [key for key in keys if not "2" <= key < "5"]
+        self.assertEqual(list(bpt_instance.keys()), keys)
+        self.assertEqual(bpt_instance.delete_range("2", "5"), 0)
+
+        # Test case 3: Many keys at once, missing ones included
+        self.assertEqual(bpt_instance.delete_many(keys[::2] + ["missing"]), len(keys[::2]))
+        keys = keys[1::2]
+        self.assertEqual(list(bpt_instance.keys()), keys)
+        self.assertEqual([key for leaf in self.leaves(bpt_instance) for key in leaf.keys], keys)
+        self.assertTrue(all(len(leaf.keys) >= 2 for leaf in self.leaves(bpt_instance)))
+        self.assertEqual(bpt_instance.delete_range(), len(keys))
+        self.assertEqual(list(bpt_instance.items()), [])
+
+        # Test case 4: Logged like the other deletes
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "tree.snapshot")
+        with DurableBPlusTree(path, BPlusTree(4), sync_interval=None) as durable_tree:
+            for key, values in self.pairs[:100]:
+                durable_tree.insert(key, values[0])
+            durable_tree.delete_range("1", "3")
+            durable_tree.delete_many(["50", "60"])
+            durable_tree.delete_value("70", "Category_0")
+            expected = list(durable_tree.items())
+        with DurableBPlusTree(path, sync_interval=None) as durable_tree:
+            self.assertEqual(list(durable_tree.items()), expected)
+            self.assertEqual(durable_tree.retrieve("70"), None)
+
+    def test_lazy_delete(self):
+        lazy_tree = LazyDeleteBPlusTree(4, max_ratio=0.5, chunk=200)
+        for key, values in self.pairs:
+            lazy_tree.insert(key, values[0])
+        counters = lazy_tree.enable_counters()
+        keys = sorted(key for key, values in self.pairs)
+
+        # Test case 1: Deletes leave tombstones that reads skip, without restructuring
+        for key in keys[:300]:
+            self.assertTrue(lazy_tree.delete(key))
+        self.assertFalse(lazy_tree.delete(keys[0]))
+        self.assertEqual(counters.counts["delete"]["merges"] + counters.counts["delete"]["borrows"], 0)
+        self.assertEqual(lazy_tree.stats()["tombstones"], 300)
+        self.assertEqual(lazy_tree.retrieve(keys[0]), None)
+        self.assertEqual(list(lazy_tree.keys()), keys[300:])
+        cursor = lazy_tree.cursor()
+        self.assertEqual(cursor.current()[0], keys[300])
+        self.assertEqual(cursor.skip(5)[0], keys[305])
+        self.assertEqual(cursor.skip(-6), None)
+
+        # Test case 2: Inserting a deleted key brings it back
+        lazy_tree.insert(keys[0], "Category_0")
+        self.assertEqual(lazy_tree.retrieve(keys[0]), ["Category_0"])
+
+        # Test case 3: Compaction by hand; deletes past max_ratio only flag it
+        self.assertEqual(lazy_tree.compact(), 299)
+        self.assertEqual(lazy_tree.stats()["keys"], 701)
+        self.assertEqual(lazy_tree.total, 701)
+        self.assertFalse(lazy_tree.needs_compaction())
+        for key in keys[300:700]:
+            lazy_tree.delete(key)
+        self.assertEqual(counters.counts["delete"]["merges"] + counters.counts["delete"]["borrows"], 0)
+        self.assertEqual(lazy_tree.compactions, 1)
+        self.assertTrue(lazy_tree.needs_compaction())
+        removed = lazy_tree.compact(lazy_tree.chunk)  # The tombstones of one chunk of leaves.
+        self.assertLess(removed, 400)
+        tombstones = 400 - removed
+        self.assertEqual(lazy_tree.stats()["tombstones"], tombstones)
+        self.assertEqual(lazy_tree.total, 701 - removed)
+        self.assertFalse(lazy_tree.needs_compaction())
+        live = [keys[0]] + keys[700:]
+        self.assertEqual(list(lazy_tree.keys()), live)
+
+        # Test case 4: Ranks step over the tombstones without compacting
+        lazy_tree.enable_ranks()
+        self.assertEqual(lazy_tree.rank(keys[701]), 2)
+        self.assertEqual([lazy_tree.select(i)[0] for i in range(len(live))], live)
+        self.assertEqual(lazy_tree.select(-1)[0], keys[-1])
+        self.assertRaises(IndexError, lazy_tree.select, len(live))
+        self.assertEqual(lazy_tree.count_range(keys[300], keys[702]), 2)
+        self.assertEqual(lazy_tree.count_range(), len(live))
+        self.assertEqual(lazy_tree.stats()["tombstones"], tombstones)
+
+        # Test case 5: A background thread compacts
+        with LazyDeleteBPlusTree(4, max_ratio=1.0, interval=0.001) as lazy_tree:
+            for key, values in self.pairs:
+                lazy_tree.insert(key, values[0])
+            for key in keys[::2]:
+                lazy_tree.delete(key)
+            for _ in range(1000):
+                if not lazy_tree.tombstoned:
+                    break
+                time.sleep(0.001)
+            self.assertEqual(lazy_tree.stats()["keys"], 500)
+            self.assertEqual(list(lazy_tree.keys()), keys[1::2])
+
+        # Test case 6: Passing max_ratio wakes the thread long before its interval
+        with LazyDeleteBPlusTree(4, max_ratio=0.25, interval=60) as lazy_tree:
+            for key, values in self.pairs:
+                lazy_tree.insert(key, values[0])
+            for key in keys[::2]:
+                lazy_tree.delete(key)
+            for _ in range(1000):
+                if not lazy_tree.needs_compaction():
+                    break
+                time.sleep(0.001)
+            self.assertGreater(lazy_tree.compactions, 0)
+            self.assertFalse(lazy_tree.needs_compaction())
+            self.assertEqual(list(lazy_tree.keys()), keys[1::2])
+
+    def test_concurrent_writers(self):
+        concurrent_tree = ConcurrentBPlusTree(4)
+        for key in ("a", "b", "c"):
+            concurrent_tree.insert(key, "Category_0")
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # Switch threads as often as possible.
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def writer(share):
+            for key, values in share:
+                concurrent_tree.insert(key, values[0])
+                concurrent_tree.insert(key, "Category_7")
+            for key, values in share[::2]:
+                concurrent_tree.delete(key)
+                concurrent_tree.delete(key)
+
+        misses = []
+        writing = threading.Event()
+
+        def reader():
+            while writing.is_set():
+                for key in ("a", "b", "c"):
+                    if concurrent_tree.retrieve(key) != ["Category_0"]:
+                        misses.append(key)
+
+        # Test case 1: Four threads insert and delete at once; the tree ends up as if they had taken turns
+        writing.set()
+        readers = [threading.Thread(target=reader) for _ in range(2)]
+        threads = [threading.Thread(target=writer, args=(self.pairs[i::4],)) for i in range(4)]
+        for thread in readers + threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writing.clear()
+        for thread in readers:
+            thread.join()
+
+        expected = sorted((key, [values[0], "Category_7"]) for key, values in self.pairs if int(key) % 8 >= 4)
+        self.assertEqual(list(concurrent_tree.items())[:-3], expected)
+        self.assertEqual(concurrent_tree.retrieve("4"), ["Category_4", "Category_7"])
+        self.assertIsNone(concurrent_tree.retrieve("0"))
+
+        # Test case 2: Readers, which take no latch, never saw a half-done split or merge
+        self.assertEqual(misses, [])
+
+        # Test case 3: No latch is left held
+        for node in [concurrent_tree.root] + list(self.leaves(concurrent_tree)):
+            self.assertFalse(node.latch.locked())
+            self.assertEqual(node.version % 2, 0)
+
+    def test_copy_on_write(self):
+        bpt_instance = BPlusTree(4)
+        cow_tree = CopyOnWriteBPlusTree(4)
+        for key, values in self.pairs:
+            bpt_instance.insert(key, values[0])
+            cow_tree.insert(key, values[0])
+
+        # Test case 1: A snapshot does not see later updates, not even to the value lists it holds
+        snapshot = cow_tree.snapshot()
+        expected = [(key, list(values)) for key, values in snapshot.items()]
+        for key, values in self.pairs[::3]:
+            bpt_instance.insert(key, "Category_7")
+            cow_tree.insert(key, "Category_7")
+        for key, values in self.pairs[::2]:
+            bpt_instance.delete(key)
+            cow_tree.delete(key)
+        self.assertEqual([(key, list(values)) for key, values in snapshot.items()], expected)
+        self.assertEqual(snapshot.retrieve("3"), ["Category_3"])
+
+        # Test case 2: The tree itself holds the same data as an in-place BPlusTree
+        self.assertEqual(list(cow_tree.items()), list(bpt_instance.items()))
+        self.assertEqual(list(cow_tree.keys("2", "3", reverse=True)), list(bpt_instance.keys("2", "3", reverse=True)))
+        self.assertEqual(cow_tree.retrieve("3"), ["Category_3", "Category_7"])
+        self.assertIsNone(cow_tree.retrieve("4"))
+        self.assertFalse(cow_tree.delete("4"))
+        bpt_instance.upsert("set", {"a", "b"})
+        cow_tree.upsert("set", {"a", "b"})
+        snapshot = cow_tree.snapshot()
+        self.assertTrue(bpt_instance.delete("set"))
+        self.assertTrue(cow_tree.delete("set"))
+        self.assertEqual(cow_tree.retrieve("set"), bpt_instance.retrieve("set"))
+        self.assertEqual(len(cow_tree.retrieve("set")), 1)
+        self.assertEqual(snapshot.retrieve("set"), {"a", "b"})
+
+        # Test case 3: bulk_load publishes a new version as well
+        snapshot = cow_tree.snapshot()
+        cow_tree.bulk_load(sorted((key, [values]) for key, values in self.pairs))
+        self.assertEqual(list(snapshot.items()), list(bpt_instance.items()))
+        self.assertEqual(cow_tree.retrieve("4"), [["Category_4"]])
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_benchmarks_run(self):
+        # Every benchmark runs to the end on tiny inputs, so that a change to the tree cannot break one unnoticed
+        for name in sorted(Benchmark_Phase.BENCHMARKS):
+            arguments = Benchmark_Phase.make_parser().parse_args([
+                name, "--sizes", "300", "--order", "5", "--orders", "5", "--terms-per-document", "3",
+                "--batch-sizes", "10", "--page-sizes", "10", "--cache-pages", "4", "--threads", "2",
+                "--fp-rates", "0.1", "--sync-every", "4"])
+            with self.subTest(benchmark=name), contextlib.redirect_stdout(io.StringIO()):
+                Benchmark_Phase.BENCHMARKS[name](arguments)
+
+
 if __name__ == '__main__':
     sys.exit(unittest.main())